@@ -0,0 +1,165 @@
+"""
+Recent-activity feed.
+
+Pages are keyset-paginated over ``(created, id)``, newest first. The cursor is
+``"<created in µs>.<id>"``, so the next page is a single index range scan
+however deep the reader goes, and the query selects the user and room rows it
+renders.
+
+The unfiltered feed is also kept in Redis as a capped list (``activity:feed``)
+of ready-to-render JSON entries, newest first. Message writes prepend to it
+(``LPUSHX``, so a missing list stays missing rather than half-filled) and
+the first read after an expiry or invalidation rebuilds it from the database.
+Message deletes drop the list. Searches (``q``) always go to the database.
+"""
+import json
+import logging
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import avatars, search
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+FEED_KEY = "activity:feed"
+ACTIVITY_PAGE_SIZE = 20
+
+
+def _micros(created: datetime) -> int:
+    return int(created.timestamp() * 1_000_000)
+
+
+def encode_cursor(entry: dict) -> str:
+    return f"{entry['created_us']}.{entry['id']}"
+
+
+def decode_cursor(cursor: str | None) -> tuple[int, int] | None:
+    try:
+        created_us, message_id = cursor.split(".")
+        return int(created_us), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def avatar_url(user) -> str:
+    # Socket users (base.ws_auth.TicketUser) carry the URL instead of the image field.
+    url = getattr(user, "avatar_url", None)
+    if url is not None:
+        return url
+    return avatars.url_for(user, "small")
+
+
+def make_entry(message_id: int, body: str, created, user, room) -> dict:
+    if isinstance(created, str):
+        created = parse_datetime(created)
+    return {
+        "id": message_id,
+        "body": body,
+        "created_us": _micros(created),
+        "user_id": user.id,
+        "username": user.username,
+        "avatar_url": avatar_url(user),
+        "room_id": room.id,
+        "room_name": room.name,
+    }
+
+
+def entry_for_message(m: Message) -> dict:
+    return make_entry(m.id, m.body, m.created, m.user, m.room)
+
+
+def render_entry(entry: dict) -> dict:
+    """Shape an entry for activity_component.html."""
+    return {
+        "id": entry["id"],
+        "body": entry["body"],
+        "created": datetime.fromtimestamp(entry["created_us"] / 1_000_000, tz=dt_timezone.utc),
+        "user": {"id": entry["user_id"], "username": entry["username"], "avatar_url": entry["avatar_url"]},
+        "room": {"id": entry["room_id"], "name": entry["room_name"]},
+    }
+
+
+def from_messages(messages) -> list[dict]:
+    return [render_entry(entry_for_message(m)) for m in messages]
+
+
+async def push(r, entry: dict):
+    """Prepend a new message to the cached feed, if the feed is cached."""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.lpushx(FEED_KEY, json.dumps(entry))
+        pipe.ltrim(FEED_KEY, 0, settings.CHAT_ACTIVITY_FEED_SIZE - 1)
+        await pipe.execute()
+
+
+async def drop(r):
+    await r.delete(FEED_KEY)
+
+
+async def _read_feed(r) -> list[dict] | None:
+    raw = await r.lrange(FEED_KEY, 0, -1)
+    return [json.loads(e) for e in raw] if raw else None
+
+
+async def fill_feed(r, entries: list[dict]):
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(FEED_KEY)
+        if entries:
+            pipe.rpush(FEED_KEY, *[json.dumps(e) for e in entries])
+        pipe.expire(FEED_KEY, settings.CHAT_ACTIVITY_FEED_TTL)
+        await pipe.execute()
+
+
+def _query(q: str, after: tuple[int, int] | None, limit: int) -> list[dict]:
+    qs = Message.objects.select_related("user", "room").order_by("-created", "-id")
+    if q:
+        qs = qs.filter(room_id__in=search.search_rooms(q).values("pk"))
+    if after:
+        created = datetime.fromtimestamp(after[0] / 1_000_000, tz=dt_timezone.utc)
+        qs = qs.filter(Q(created__lt=created) | Q(created=created, id__lt=after[1]))
+    return [entry_for_message(m) for m in qs[:limit]]
+
+
+def latest_entries() -> list[dict]:
+    """The newest entries, enough to fill ``activity:feed``."""
+    return _query("", None, settings.CHAT_ACTIVITY_FEED_SIZE)
+
+
+def _page_from_feed(feed: list[dict], after: tuple[int, int] | None, limit: int) -> list[dict] | None:
+    # A list shorter than the cap holds every message, so a short page is the end.
+    complete = len(feed) < settings.CHAT_ACTIVITY_FEED_SIZE
+    if after:
+        feed = [e for e in feed if (e["created_us"], e["id"]) < after]
+    if len(feed) >= limit or complete:
+        return feed[:limit]
+    return None
+
+
+def page(r, q: str = "", cursor: str | None = None, limit: int = ACTIVITY_PAGE_SIZE):
+    """Return ``(entries ready for the template, next cursor or None)``."""
+    after = decode_cursor(cursor)
+    entries = None
+
+    if not q:
+        try:
+            feed = async_to_sync(_read_feed)(r)
+            if feed is None and after is None:
+                feed = latest_entries()
+                async_to_sync(fill_feed)(r, feed)
+            if feed is not None:
+                entries = _page_from_feed(feed, after, limit + 1)
+        except Exception as e:
+            logger.warning(f"Activity feed cache unavailable: {e}")
+
+    # One entry past the page tells whether there is another page.
+    if entries is None:
+        entries = _query(q, after, limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    next_cursor = encode_cursor(entries[-1]) if has_more and entries else None
+    return [render_entry(e) for e in entries], next_cursor
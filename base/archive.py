@@ -0,0 +1,160 @@
+"""
+Cold storage for old messages.
+
+``manage.py archive_messages`` moves each room's messages older than
+``CHAT_ARCHIVE_AFTER_DAYS`` out of ``base_message`` into ``MessageArchive``
+segments. A segment holds up to ``CHAT_ARCHIVE_SEGMENT_SIZE`` consecutive
+messages as zlib-compressed JSON rows of ``[id, user_id, body, created]``.
+Each room is archived up to the newest message older than the cutoff, so
+every archived ID is below every ID still in the hot table. Readers can
+therefore page through the hot table first and continue into the archive
+with the same ``before_id``/``after_id`` cursors.
+
+That relies on message IDs following posting order within a room. Both the
+ORM and ``base.write_behind`` take IDs from the table's sequence one message
+at a time, so they do. An allocator that hands out ID blocks per worker would
+not: a later message could get a lower ID than an archived one.
+
+The hot table keeps only recent rows, so its indexes stay small. The archive
+has one index row per segment. ``history.fetch_messages_db`` and
+``fetch_messages_after_db`` read through both tiers, so ``load_more`` and
+the history API page past the boundary unchanged.
+
+Archived messages are read-only. The hot rows are deleted while
+:func:`is_archiving` is true for their room, and the ``Message`` delete
+handlers skip their counter and cache bookkeeping for it.
+``Room.message_count`` therefore still counts archived messages
+(``counters.rebuild`` adds the segment counts). Usernames are looked up at read time, and messages whose
+author has since been deleted are skipped.
+"""
+import json
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+
+from .models import Message, MessageArchive, User
+
+# Rooms whose messages are being moved; their deletes skip per-message bookkeeping.
+_archiving_rooms = set()
+
+
+def pack_rows(rows: list) -> bytes:
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode())
+
+
+def unpack_rows(data) -> list:
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def is_archiving(room_id) -> bool:
+    return room_id in _archiving_rooms
+
+
+def _to_messages(room_id, rows: list) -> list[Message]:
+    """Unsaved ``Message`` instances for ``serialize_message``, oldest first."""
+    users = User.objects.only("id", "username").in_bulk({row[1] for row in rows})
+    return [
+        Message(id=message_id, room_id=room_id, user=users[user_id], body=body, created=parse_datetime(created))
+        for message_id, user_id, body, created in rows
+        if user_id in users
+    ]
+
+
+def fetch_before(room_id, before_id: int | None, limit: int) -> list[Message]:
+    """Up to ``limit`` archived messages older than ``before_id``, oldest first."""
+    rows = []
+    bound = before_id
+    while len(rows) < limit:
+        segments = MessageArchive.objects.filter(room_id=room_id).order_by("-last_id")
+        if bound is not None:
+            segments = segments.filter(first_id__lt=bound)
+        segment = segments.first()
+        if segment is None:
+            break
+        older = [row for row in unpack_rows(segment.data) if bound is None or row[0] < bound]
+        rows[:0] = older[-(limit - len(rows)):]
+        bound = segment.first_id
+    return _to_messages(room_id, rows)
+
+
+def fetch_after(room_id, after_id: int, limit: int) -> list[Message]:
+    """Up to ``limit`` archived messages newer than ``after_id``, oldest first."""
+    rows = []
+    bound = after_id
+    while len(rows) < limit:
+        segment = (
+            MessageArchive.objects.filter(room_id=room_id, last_id__gt=bound)
+            .order_by("last_id")
+            .first()
+        )
+        if segment is None:
+            break
+        newer = [row for row in unpack_rows(segment.data) if row[0] > bound]
+        rows.extend(newer[:limit - len(rows)])
+        bound = segment.last_id
+    return _to_messages(room_id, rows)
+
+
+def _write_segment(room_id, rows: list, replaces: MessageArchive | None = None):
+    with transaction.atomic():
+        if replaces is not None:
+            replaces.delete()
+        MessageArchive.objects.create(
+            room_id=room_id,
+            first_id=rows[0][0],
+            last_id=rows[-1][0],
+            first_created=parse_datetime(rows[0][3]),
+            last_created=parse_datetime(rows[-1][3]),
+            message_count=len(rows),
+            data=pack_rows(rows),
+        )
+        # The messages still exist, just elsewhere, so the delete handlers stand down.
+        hot_ids = [row[0] for row in rows if replaces is None or row[0] > replaces.last_id]
+        _archiving_rooms.add(room_id)
+        try:
+            Message.objects.filter(pk__in=hot_ids).delete()
+        finally:
+            _archiving_rooms.discard(room_id)
+
+
+def archive_room(room_id, up_to_id: int, segment_size: int) -> int:
+    """Move the room's messages with ``id <= up_to_id`` into segments. Returns the count moved."""
+    # Top up the room's last segment if an earlier run left it short.
+    tail = MessageArchive.objects.filter(room_id=room_id).order_by("-last_id").first()
+    if tail is not None and tail.message_count >= segment_size:
+        tail = None
+
+    moved = 0
+    while True:
+        carried = unpack_rows(tail.data) if tail is not None else []
+        hot = list(
+            Message.objects.filter(room_id=room_id, id__lte=up_to_id)
+            .order_by("id")
+            .values_list("id", "user_id", "body", "created")[:segment_size - len(carried)]
+        )
+        if not hot:
+            return moved
+        rows = carried + [[m_id, user_id, body, created.isoformat()] for m_id, user_id, body, created in hot]
+        _write_segment(room_id, rows, replaces=tail)
+        moved += len(hot)
+        tail = None
+
+
+def archive_before(cutoff, segment_size: int | None = None, room_ids=None) -> dict:
+    """Archive every room's messages created before ``cutoff``."""
+    segment_size = segment_size or settings.CHAT_ARCHIVE_SEGMENT_SIZE
+    boundaries = Message.objects.filter(created__lt=cutoff)
+    if room_ids is not None:
+        boundaries = boundaries.filter(room_id__in=room_ids)
+    boundaries = boundaries.order_by().values("room_id").annotate(up_to_id=Max("id"))
+
+    stats = {"rooms": 0, "messages": 0}
+    for row in list(boundaries):
+        moved = archive_room(row["room_id"], row["up_to_id"], segment_size)
+        if moved:
+            stats["rooms"] += 1
+            stats["messages"] += moved
+    return stats
@@ -0,0 +1,120 @@
+"""
+Avatar size variants.
+
+Pages used to load each user's original upload for every feed row, chat line
+and participant. When ``User.avatar`` changes, the ``User`` signal handlers
+now call :func:`refresh`. It crops and resizes the image to each size in
+``AVATAR_SIZES``, about twice the CSS size of the matching ``avatar--*``
+class, and encodes it as WebP when Pillow supports it, or PNG otherwise. The
+media paths are stored in ``User.avatar_variants``.
+
+Variant files are named after a hash of their contents
+(``avatars/<sha256 prefix>-<px>.<ext>``). A URL therefore never changes
+content and can be cached for a year as ``immutable``. With ``DEBUG`` on,
+:func:`serve` sends them with that ``Cache-Control``. In production the web
+server or storage serves ``MEDIA_ROOT/avatars/`` and should send the same
+header. Templates pick a size with the ``{{ user|avatar:'small' }}`` filter
+from ``base.templatetags.avatars``. Users without variants, such as the
+default SVG or an upload Pillow can't read, fall back to the original.
+
+Identical uploads share their variant files. When an avatar is replaced, the
+old variants are deleted unless another user still refers to them.
+
+``manage.py backfill_avatars`` builds variants for avatars uploaded before
+this existed.
+"""
+import hashlib
+import io
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.views.static import serve as static_serve
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+AVATAR_DIR = "avatars"
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def _format() -> tuple[str, str]:
+    return ("WEBP", "webp") if features.check("webp") else ("PNG", "png")
+
+
+def render_variants(fp) -> dict[str, tuple[str, bytes]]:
+    """``{size name: (file name, encoded bytes)}`` for an open image file."""
+    with Image.open(fp) as original:
+        image = ImageOps.exif_transpose(original)
+        alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if alpha else "RGB")
+    fmt, ext = _format()
+
+    variants = {}
+    for name, px in settings.AVATAR_SIZES.items():
+        out = io.BytesIO()
+        ImageOps.fit(image, (px, px), Image.Resampling.LANCZOS).save(out, fmt, quality=85, method=4)
+        data = out.getvalue()
+        digest = hashlib.sha256(data).hexdigest()[:20]
+        variants[name] = (f"{AVATAR_DIR}/{digest}-{px}.{ext}", data)
+    return variants
+
+
+def build(avatar) -> dict[str, str]:
+    """Write the variants of an ``ImageField`` file and return their media paths."""
+    if not avatar or avatar.name.lower().endswith(".svg"):
+        return {}
+    try:
+        with avatar.open("rb") as fp:
+            variants = render_variants(fp)
+    except Exception as e:  # missing file or not an image Pillow can read
+        logger.warning(f"Avatar variants for {avatar.name} failed: {e}")
+        return {}
+
+    paths = {}
+    for name, (path, data) in variants.items():
+        if not default_storage.exists(path):
+            path = default_storage.save(path, ContentFile(data))
+        paths[name] = path
+    return paths
+
+
+def _delete_unused(model, paths, exclude_pk):
+    """Delete variant files that no user other than ``exclude_pk`` refers to."""
+    for path in paths:
+        shared = Q()
+        for name in settings.AVATAR_SIZES:
+            shared |= Q(**{f"avatar_variants__{name}": path})
+        if model.objects.filter(shared).exclude(pk=exclude_pk).exists():
+            continue
+        try:
+            default_storage.delete(path)
+        except Exception as e:
+            logger.warning(f"Deleting avatar variant {path} failed: {e}")
+
+
+def refresh(user) -> dict[str, str]:
+    """Rebuild ``user``'s variants and store them without another ``post_save``."""
+    variants = build(user.avatar)
+    previous = user.avatar_variants or {}
+    if variants != previous:
+        type(user).objects.filter(pk=user.pk).update(avatar_variants=variants)
+        user.avatar_variants = variants
+        _delete_unused(type(user), set(previous.values()) - set(variants.values()), user.pk)
+    return variants
+
+
+def url_for(user, size: str = "small") -> str:
+    path = (getattr(user, "avatar_variants", None) or {}).get(size)
+    if path:
+        return default_storage.url(path)
+    return user.avatar.url if user.avatar else ""
+
+
+def serve(request, path):
+    """Serve a variant with far-future caching; its name changes whenever its content does."""
+    response = static_serve(request, path, document_root=settings.MEDIA_ROOT / AVATAR_DIR)
+    response["Cache-Control"] = IMMUTABLE
+    return response
@@ -1,98 +1,108 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
+import asyncio
 import json
-from django.utils import timezone
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from channels.db import database_sync_to_async
 from .models import Room, Message, User
+from . import activity, history, membership, metrics, room_cache, unread, wire, ws_auth
+from .outbox import DROP_ORDER, Outbox, SlowConsumer
+from .presence import get_presence
+from .ratelimit import get_rate_limiter
+from .redis_pool import get_redis
+from .typing_indicators import get_typing_aggregator
+from .write_behind import get_write_behind, write_behind_enabled
 import logging
-import redis.asyncio as redis
-import os
-import pickle  # serialize Python objects for Redis
 
 logger = logging.getLogger(__name__)
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-MESSAGE_HISTORY_LIMIT = 50
-MESSAGE_CACHE_TTL = 60 * 5  # 5 minutes
+MESSAGE_HISTORY_LIMIT = history.HISTORY_PAGE_SIZE
+EVENT_TYPES = {"chat_message", "load_more", "mark_read", "typing"}
+ROOM_DELETED_CLOSE_CODE = 4404
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
 
     async def _get_redis(self):
-        """Get a Redis connection."""
-        if not hasattr(self, "_redis"):
-            self._redis = await redis.from_url(REDIS_URL, decode_responses=False)
-        return self._redis
+        """Get the process-wide pooled Redis client."""
+        return get_redis()
 
-    @database_sync_to_async
-    def _aget_room(self, room_id: int) -> Room:
-        return Room.objects.get(id=room_id)
+    async def _aget_room(self, room_id: int) -> Room:
+        with metrics.timer("chat_ws_db_seconds", op="get_room"):
+            room = await room_cache.aget(await self._get_redis(), room_id)
+        if room is None:
+            raise Room.DoesNotExist(f"Room {room_id} does not exist")
+        return room
 
     @database_sync_to_async
     def _acreate_message(self, user: User, room: Room, body: str) -> Message:
-        return Message.objects.create(user=user, room=room, body=body)
+        with metrics.timer("chat_ws_db_seconds", op="create_message"):
+            return Message.objects.create(user_id=user.id, room=room, body=body)
 
     @database_sync_to_async
     def _aadd_participant(self, room: Room, user: User):
-        room.participants.add(user)
+        room.participants.add(user.id)
 
-    @database_sync_to_async
-    def _afetch_messages_db(self, limit: int = 50, before_id: int | None = None):
-        qs = (
-            Message.objects.filter(room_id=self.room_id)
-            .select_related("user")
-            .order_by("-id")
-        )
-        if before_id:
-            qs = qs.filter(id__lt=before_id)
-        items = list(qs[:limit])
-        items.reverse()
-        return items
-
-    async def _afetch_messages(self, limit: int = 50, before_id: int | None = None):
-        """Fetch from Redis cache first, fallback to DB."""
+    async def _afetch_messages(self, limit: int = 50, before_id: int | None = None) -> list[str]:
+        """Ready-to-send JSON entries, from the shared history window or the DB."""
         redis = await self._get_redis()
-        cache_key = f"room:{self.room_id}:history:{before_id or 'latest'}"
-        cached = await redis.get(cache_key)
-        if cached:
-            try:
-                return pickle.loads(cached)
-            except Exception as e:
-                logger.warning(f"Cache decode failed: {e}")
-
-        # Fallback to DB
-        msgs = await self._afetch_messages_db(limit, before_id)
-        await redis.setex(cache_key, MESSAGE_CACHE_TTL, pickle.dumps(msgs))
-        return msgs
-
-    def _serialize_message(self, m: Message) -> dict:
-        return {
-            "message_id": m.id,
-            "user_id": m.user.id if m.user else None,
-            "username": m.user.username if m.user else "Unknown",
-            "message": m.body,
-            "timestamp": self._iso(m.created),
-        }
-
-    def _iso(self, dt):
-        if not dt:
-            return None
-        if timezone.is_naive(dt):
-            dt = timezone.make_aware(dt, timezone.get_current_timezone())
-        return dt.isoformat()
+        with metrics.timer("chat_ws_db_seconds", op="fetch_messages"):
+            return await history.load(redis, self.room_id, limit, before_id)
+
+    async def queue_send(self, kind: str, text_data=None, bytes_data=None):
+        """Hand a frame to the writer task; see ``base.outbox`` for the drop policy."""
+        if self._outbox is None:
+            return
+        try:
+            await self._outbox.put(kind, text_data=text_data, bytes_data=bytes_data)
+        except SlowConsumer:
+            logger.info(f"Closing slow consumer {self.channel_name} in room {self.room_id}")
+            metrics.inc("chat_slow_consumer_disconnects_total")
+            self._outbox.close()
+            self._outbox = None
+            await self.close(code=settings.CHAT_SLOW_CONSUMER_CLOSE_CODE)
 
     async def send_json(self, data: dict):
-        await self.send(text_data=json.dumps(data))
+        kind = data.get("type", "control")
+        if self.binary:
+            await self.queue_send(kind, bytes_data=wire.pack(data))
+        else:
+            await self.queue_send(kind, text_data=json.dumps(data))
+
+    async def send_history(self, direction: str, entries: list[str]):
+        if self.binary:
+            await self.queue_send("message_history", bytes_data=wire.pack({
+                "type": "message_history",
+                "direction": direction,
+                "messages": [json.loads(entry) for entry in entries],
+            }))
+            return
+        # Entries are already JSON, so splice them in rather than re-encoding.
+        await self.queue_send("message_history", text_data=(
+            f'{{"type": "message_history", "direction": "{direction}", '
+            f'"messages": [{", ".join(entries)}]}}'
+        ))
+
+    async def group_send_frame(self, data: dict):
+        """Encode ``data`` once here; every recipient forwards the bytes as-is."""
+        metrics.inc("chat_fanout_sends_total", kind=data["type"])
+        await self.channel_layer.group_send(self.room_group_name, wire.group_event(data))
 
     async def connect(self):
         self.user = self.scope.get("user")
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
         self.room_group_name = f"chat_{self.room_id}"
+        self._is_participant = False
+        self.binary = False
+        self._pending = []
+        self._flush_task = None
+        self._outbox = None
 
         if not self.user or not self.user.is_authenticated:
             await self.close(code=401)
             return
 
+        room_cache.ensure_listening()
         try:
             self.room = await self._aget_room(self.room_id)
         except ObjectDoesNotExist:
@@ -100,50 +110,89 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
-
-        history = await self._afetch_messages(limit=MESSAGE_HISTORY_LIMIT)
-        await self.send_json({
-            "type": "message_history",
-            "direction": "latest",
-            "messages": [self._serialize_message(m) for m in history],
-        })
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "presence_event",
-                "event": "user_joined",
-                "user_id": self.user.id,
-                "username": self.user.username,
-            },
+        subprotocols = self.scope.get("subprotocols", [])
+        if wire.SUBPROTOCOL_MSGPACK in subprotocols:
+            self.binary = True
+            await self.accept(wire.SUBPROTOCOL_MSGPACK)
+        elif ws_auth.SUBPROTOCOL_AUTH in subprotocols:
+            # Credentials sent as protocols need one echoed back; see base.ws_auth.
+            await self.accept(ws_auth.SUBPROTOCOL_AUTH)
+        else:
+            await self.accept()
+        metrics.inc("chat_ws_connects_total")
+        self._outbox = Outbox(
+            self.send, settings.CHAT_SEND_QUEUE_SIZE, settings.CHAT_SLOW_CONSUMER_POLICY
         )
+        self._outbox.start()
+
+        latest = await self._afetch_messages(limit=MESSAGE_HISTORY_LIMIT)
+        await self.send_history("latest", latest)
+
+        online = await get_presence().join(
+            self.room_id, self.room_group_name, self.channel_name, self.user.id, self.user.username
+        )
+        await self.send_json({"type": "presence_roster", "users": online})
 
     async def disconnect(self, close_code):
+        metrics.inc("chat_ws_disconnects_total", code=close_code)
+        if getattr(self, "_flush_task", None) is not None:
+            self._flush_task.cancel()
+        if getattr(self, "_outbox", None) is not None:
+            self._outbox.close()
         if hasattr(self, "room_group_name"):
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "presence_event",
-                    "event": "user_left",
-                    "user_id": getattr(self.user, "id", None),
-                    "username": getattr(self.user, "username", None),
-                },
-            )
+            if getattr(self.user, "is_authenticated", False):
+                # Another tab in the room may still be typing; leave its indicator alone.
+                if not await get_presence().leave(self.room_id, self.channel_name):
+                    get_typing_aggregator().note(
+                        self.room_id, self.room_group_name, self.user.id, self.user.username, False
+                    )
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data or "{}")
+            data = wire.unpack(bytes_data) if bytes_data is not None else json.loads(text_data or "{}")
         except json.JSONDecodeError:
             await self.send_json({"type": "error", "message": "Invalid JSON"})
             return
+        except Exception:
+            await self.send_json({"type": "error", "message": "Invalid MessagePack"})
+            return
+        if not isinstance(data, dict):
+            await self.send_json({"type": "error", "message": "Expected an object"})
+            return
 
         if not self.user or not self.user.is_authenticated:
             await self.send_json({"type": "error", "message": "Authentication required"})
             return
 
+        if data.get("type") == "batch":
+            events = data.get("events")
+            for event in events[:wire.MAX_INBOUND_BATCH] if isinstance(events, list) else []:
+                if isinstance(event, dict):
+                    await self.handle_event(event)
+            return
+        await self.handle_event(data)
+
+    async def handle_event(self, data: dict):
         evt_type = data.get("type")
+        metrics.inc("chat_ws_events_total", type=evt_type if evt_type in EVENT_TYPES else "unknown")
+
+        if evt_type in EVENT_TYPES:
+            verdict = await get_rate_limiter().check(
+                await self._get_redis(), evt_type, self.user.id, self.room_id
+            )
+            if not verdict.allowed:
+                metrics.inc("chat_rate_limited_total", type=evt_type, scope=verdict.scope)
+                if evt_type != "typing":  # typing is best-effort; drop it quietly
+                    await self.send_json({
+                        "type": "error",
+                        "code": "rate_limited",
+                        "event": evt_type,
+                        "scope": verdict.scope,
+                        "retry_after": verdict.retry_after,
+                        "message": "Too many requests, slow down",
+                    })
+                return
 
         if evt_type == "chat_message":
             body = (data.get("message") or "").strip()
@@ -153,72 +202,93 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.send_json({"type": "error", "message": "Message too long"})
                 return
 
-            msg_obj = await self._acreate_message(self.user, self.room, body)
-            await self._aadd_participant(self.room, self.user)
-
-            # Invalidate Redis cache for latest messages
-            redis = await self._get_redis()
-            await redis.delete(f"room:{self.room_id}:history:latest")
-
-            payload = {
-                "type": "chat_message",
-                "message": body,
-                "timestamp": self._iso(msg_obj.created),
+            if write_behind_enabled():
+                row = await get_write_behind().submit(self.user.id, self.room_id, body)
+                message_id, created = row["id"], row["created"]
+            else:
+                msg_obj = await self._acreate_message(self.user, self.room, body)
+                if not self._is_participant:
+                    await membership.ensure(
+                        await self._get_redis(), self.room_id, self.user.id,
+                        lambda: self._aadd_participant(self.room, self.user),
+                    )
+                    self._is_participant = True
+                message_id, created = msg_obj.id, history.iso(msg_obj.created)
+
+            entry = {
+                "message_id": message_id,
                 "user_id": self.user.id,
                 "username": self.user.username,
-                "message_id": msg_obj.id,
+                "message": body,
+                "timestamp": created,
             }
-            await self.channel_layer.group_send(self.room_group_name, payload)
+            redis = await self._get_redis()
+            await history.append(redis, self.room_id, message_id, json.dumps(entry))
+            await unread.bump(redis, self.room_id)
+            await activity.push(
+                redis, activity.make_entry(message_id, body, created, self.user, self.room)
+            )
+
+            await self.group_send_frame({"type": "chat_message", **entry})
 
         elif evt_type == "load_more":
             before_id = data.get("before_id")
-            if before_id is not None and not isinstance(before_id, int):
+            if before_id is not None and (not isinstance(before_id, int) or isinstance(before_id, bool)):
                 return
             older = await self._afetch_messages(limit=MESSAGE_HISTORY_LIMIT, before_id=before_id)
-            await self.send_json({
-                "type": "message_history",
-                "direction": "older",
-                "messages": [self._serialize_message(m) for m in older],
-            })
+            await self.send_history("older", older)
+
+        elif evt_type == "mark_read":
+            message_id = data.get("message_id")
+            if not isinstance(message_id, int) or isinstance(message_id, bool):
+                return
+            try:
+                state = await unread.mark_read(await self._get_redis(), self.user.id, self.room_id, message_id)
+            except Room.DoesNotExist:
+                # Deleted while the socket was open; its room_deleted event may not have arrived yet.
+                await self.close(code=ROOM_DELETED_CLOSE_CODE)
+                return
+            await self.send_json({"type": "read_state", **state})
 
         elif evt_type == "typing":
-            is_typing = bool(data.get("is_typing"))
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "typing_event",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_typing": is_typing,
-                },
+            get_typing_aggregator().note(
+                self.room_id, self.room_group_name, self.user.id, self.user.username,
+                bool(data.get("is_typing")),
             )
 
         else:
             await self.send_json({"type": "error", "message": f"Unknown event type: {evt_type}"})
 
-    async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-        user_id = event['user_id']
-
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username,
-            'user_id': user_id
-        }))
-
-    async def presence_event(self, event):
-        await self.send_json({
-            "type": "presence",
-            "event": event.get("event"),
-            "user_id": event.get("user_id"),
-            "username": event.get("username"),
-        })
-
-    async def typing_event(self, event):
-        await self.send_json({
-            "type": "typing",
-            "user_id": event.get("user_id"),
-            "username": event.get("username"),
-            "is_typing": event.get("is_typing", False),
-        })
+    async def room_deleted(self, event):
+        await self.close(code=ROOM_DELETED_CLOSE_CODE)
+
+    async def broadcast_frame(self, event):
+        metrics.inc("chat_fanout_deliveries_total", kind=event.get("kind", "unknown"))
+        kind = event.get("kind", "unknown")
+        if not self.binary:
+            await self.queue_send(kind, text_data=event["frame"])
+            return
+        self._pending.append((kind, wire.packed_frame(event)))
+        if len(self._pending) >= settings.CHAT_MSGPACK_BATCH_MAX or settings.CHAT_MSGPACK_BATCH_DELAY <= 0:
+            await self._flush_pending()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(settings.CHAT_MSGPACK_BATCH_DELAY)
+        self._flush_task = None
+        await self._flush_pending()
+
+    async def _flush_pending(self):
+        """Send queued live events: alone as-is, or several as one batch frame."""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        if len(pending) == 1:
+            await self.queue_send(pending[0][0], bytes_data=pending[0][1])
+            return
+        # A batch is only as droppable as the least droppable event in it.
+        kinds = {kind for kind, _ in pending}
+        droppable = [k for k in DROP_ORDER if k in kinds]
+        kind = droppable[-1] if len(droppable) == len(kinds) else "batch"
+        await self.queue_send(kind, bytes_data=wire.pack_batch([packed for _, packed in pending]))
@@ -0,0 +1,126 @@
+"""
+Denormalized counters shown on list pages.
+
+``Topic.room_count``, ``Room.participant_count`` and ``Room.message_count``
+let the topic sidebar and feed cards render without a COUNT per row. They are
+adjusted with ``F()`` updates from the signal handlers in ``base.signals`` and
+from the write-behind flusher. ``manage.py rebuild_counters`` recomputes them
+from scratch if they drift (e.g. after raw SQL or queryset bulk deletes,
+which send no signals). ``Room.message_count`` includes archived messages.
+``Room.message_seq`` only ever grows and is not rebuilt.
+
+Per-message changes go through :func:`defer` instead of :func:`adjust`. An
+``UPDATE base_room`` per message would queue every writer of a busy room
+behind that row's lock. Deferred deltas are summed per process once their
+transaction commits, and a daemon thread applies them with
+:func:`adjust_many` every ``CHAT_COUNTER_FLUSH_INTERVAL`` seconds, with a
+final flush at exit. The counters therefore trail by up to one interval.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Message, MessageArchive, Room, Topic
+
+logger = logging.getLogger(__name__)
+
+_pending = Counter()  # (model, fields, pk) -> delta
+_pending_lock = threading.Lock()
+_flusher = None
+
+
+def _fields(field) -> tuple:
+    return (field,) if isinstance(field, str) else tuple(field)
+
+
+def adjust(model, pk, field, delta: int):
+    """Add ``delta`` to ``field`` (a name, or a tuple of names updated together)."""
+    if pk is None or not delta:
+        return
+    model.objects.filter(pk=pk).update(**{f: F(f) + delta for f in _fields(field)})
+
+
+def adjust_many(model, deltas: dict, field):
+    """Apply ``{pk: delta}`` to ``field``, one UPDATE per distinct delta."""
+    by_delta = {}
+    for pk, delta in deltas.items():
+        if pk is not None and delta:
+            by_delta.setdefault(delta, []).append(pk)
+    for delta, pks in by_delta.items():
+        model.objects.filter(pk__in=pks).update(**{f: F(f) + delta for f in _fields(field)})
+
+
+def defer(model, pk, field, delta: int):
+    """Like :func:`adjust`, but batched with other deltas and applied only if the transaction commits."""
+    if pk is None or not delta:
+        return
+    if settings.CHAT_COUNTER_FLUSH_INTERVAL <= 0:
+        adjust(model, pk, field, delta)
+        return
+    transaction.on_commit(lambda: _queue(model, pk, _fields(field), delta))
+
+
+def _queue(model, pk, fields: tuple, delta: int):
+    with _pending_lock:
+        _pending[(model, fields, pk)] += delta
+        _ensure_started()
+
+
+def flush():
+    """Apply every queued delta. Failed groups are queued again for the next flush."""
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+    grouped = {}
+    for (model, fields, pk), delta in pending.items():
+        grouped.setdefault((model, fields), {})[pk] = delta
+    for (model, fields), deltas in grouped.items():
+        try:
+            adjust_many(model, deltas, fields)
+        except Exception as e:
+            logger.warning(f"Counter flush of {len(deltas)} {model.__name__} rows failed: {e}")
+            with _pending_lock:
+                for pk, delta in deltas.items():
+                    _pending[(model, fields, pk)] += delta
+
+
+def _run():
+    while True:
+        time.sleep(settings.CHAT_COUNTER_FLUSH_INTERVAL)
+        close_old_connections()
+        flush()
+
+
+def _ensure_started():
+    global _flusher
+    if _flusher is None:
+        _flusher = threading.Thread(target=_run, name="counter-flusher", daemon=True)
+        _flusher.start()
+        atexit.register(flush)
+
+
+def _count_subquery(qs, group_field: str):
+    counted = qs.filter(**{group_field: OuterRef("pk")}).order_by().values(group_field)
+    return Coalesce(Subquery(counted.annotate(c=Count("*")).values("c")[:1]), Value(0))
+
+
+def _archived_subquery():
+    archived = MessageArchive.objects.filter(room=OuterRef("pk")).order_by().values("room")
+    return Coalesce(Subquery(archived.annotate(c=Sum("message_count")).values("c")[:1]), Value(0))
+
+
+def rebuild():
+    """Recompute every counter from the source tables."""
+    Participant = Room.participants.through
+    Topic.objects.update(room_count=_count_subquery(Room.objects.all(), "topic"))
+    Room.objects.update(
+        message_count=_count_subquery(Message.objects.all(), "room") + _archived_subquery(),
+        participant_count=_count_subquery(Participant.objects.all(), "room"),
+    )
@@ -0,0 +1,95 @@
+"""
+Generation-keyed template fragment caching.
+
+``home.html`` and ``profile.html`` wrap the topic list, the room list and the
+recent-activity panel in ``{% cache %}`` blocks, and ``feed_component.html``
+wraps each room card. Each block's key includes generation counters kept in
+the default Django cache:
+
+* ``topics``: the topic list and its room counts
+* ``feed``: the home page room list, including every card on it
+* ``room:<id>``: one room card (name, host, participant count)
+* ``topic:<id>``: the topic name shown on that topic's room cards
+
+The signal handlers in ``base.signals`` bump the counters when the data
+behind a fragment changes. A bumped counter gives the fragment a new key, so
+a stale copy is never served and simply expires. The activity panel is keyed
+by the ids of the entries it shows, which come from the Redis feed anyway.
+
+A counter missing from the cache starts at the current time in nanoseconds
+rather than zero, so an evicted counter can't bring back an old fragment.
+Fragments live for ``CHAT_FRAGMENT_CACHE_TTL`` seconds, which also bounds how
+far a cached "5 minutes ago" can drift. Set it to 0 to render everything
+fresh.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+logger = logging.getLogger(__name__)
+
+TOPICS = "topics"
+FEED = "feed"
+
+
+def room_gen(room_id) -> str:
+    return f"room:{room_id}"
+
+
+def topic_gen(topic_id) -> str:
+    return f"topic:{topic_id}"
+
+
+def _key(name: str) -> str:
+    return f"fragment:gen:{name}"
+
+
+def generations(*names) -> dict[str, int]:
+    """Current counter for each name, starting any that are missing."""
+    keys = {_key(name): name for name in names}
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        fresh = time.time_ns()
+        for key in missing:
+            cache.add(key, fresh, timeout=None)
+        found.update(cache.get_many(missing))
+        for key in missing:
+            found.setdefault(key, fresh)
+    return {keys[key]: value for key, value in found.items()}
+
+
+def bump(*names):
+    """Retire every fragment keyed on these counters."""
+    for name in names:
+        try:
+            cache.incr(_key(name))
+        except ValueError:  # not started yet; the next read starts it fresh
+            pass
+        except Exception as e:
+            logger.warning(f"Fragment generation bump failed for {name}: {e}")
+
+
+def annotate_rooms(rooms) -> list:
+    """Give each room the ``fragment_key`` its card is cached under."""
+    rooms = list(rooms)
+    names = {room_gen(room.id) for room in rooms} | {topic_gen(room.topic_id) for room in rooms}
+    gens = generations(*names)
+    for room in rooms:
+        room.fragment_key = f"{gens[room_gen(room.id)]}.{gens[topic_gen(room.topic_id)]}"
+    return rooms
+
+
+def activity_key(entries) -> str:
+    return ".".join(str(entry["id"]) for entry in entries)
+
+
+def context(request):
+    """Template context processor: the fragment TTL and the global counters, read on first use."""
+    return {
+        "fragment_ttl": settings.CHAT_FRAGMENT_CACHE_TTL,
+        "fragment_gens": SimpleLazyObject(lambda: generations(TOPICS, FEED)),
+    }
@@ -0,0 +1,321 @@
+"""
+Shared per-room message history store.
+
+Every room keeps its most recent ``CHAT_HISTORY_WINDOW`` messages in a Redis
+sorted set (``room:<id>:history``), scored by message ID. Each member is the
+ready-to-send JSON for one message, the same shape ``ChatConsumer`` puts on
+the wire. New messages are appended on write and the set is trimmed to the
+window, so an active room's history stays warm instead of being invalidated
+by every message.
+
+A companion key (``room:<id>:history:floor``) records the lowest message ID
+from which the set is known to be complete. ``0`` means the set holds the
+whole room. Without a floor the set is only a partial tail (e.g. messages
+appended after an expiry), and reads fall back to the database, which then
+fills the set and sets the floor.
+
+The WebSocket consumer and the HTTP views both read through :func:`load`.
+Misses are coalesced: concurrent loads of the same page in one process share
+a single database query. With ``CHAT_HISTORY_LOCK`` enabled, a short Redis
+lock also lets one process fill the window while the others wait for it. The
+lock holds a random token and is released only by its holder, even if the
+fill fails. :func:`stats` counts the queries saved and is exported through
+``base.metrics``.
+"""
+import asyncio
+import json
+import logging
+import secrets
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from . import archive, metrics
+from .models import Message
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 50
+LOCK_POLL_INTERVAL = 0.05  # seconds
+
+_flights = SingleFlight()
+_lock_waits_served = 0
+
+# KEYS: history, floor. ARGV: message id, entry, window, ttl
+APPEND_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+local complete = redis.call('EXISTS', KEYS[2]) == 1
+if excess > 0 then
+  redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+  if complete then
+    local lowest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    redis.call('SET', KEYS[2], lowest[2])
+  end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if complete then
+  redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+"""
+
+# KEYS: history, floor. ARGV: floor, window, ttl, then (message id, entry) pairs
+FILL_SCRIPT = """
+for i = 4, #ARGV, 2 do
+  if redis.call('ZCOUNT', KEYS[1], ARGV[i], ARGV[i]) == 0 then
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+  end
+end
+local floor = ARGV[1]
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[2])
+if excess > 0 then
+  redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+  floor = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')[2]
+end
+redis.call('SET', KEYS[2], floor, 'EX', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+"""
+
+
+# KEYS: lock. ARGV: token. Deletes the lock only if it still holds our token.
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def history_key(room_id) -> str:
+    return f"room:{room_id}:history"
+
+
+def floor_key(room_id) -> str:
+    return f"room:{room_id}:history:floor"
+
+
+def lock_key(room_id) -> str:
+    return f"room:{room_id}:history:lock"
+
+
+def stats() -> dict:
+    """How many history queries went to the database and how many were saved."""
+    return {
+        "db_queries": _flights.calls - _lock_waits_served,
+        "coalesced": _flights.coalesced,
+        "lock_waits_served": _lock_waits_served,
+        "saved": _flights.coalesced + _lock_waits_served,
+    }
+
+
+@metrics.register
+def _collect() -> dict:
+    return {f"chat_history_{name}_total": value for name, value in stats().items()}
+
+
+def iso(dt):
+    if not dt:
+        return None
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_current_timezone())
+    return dt.isoformat()
+
+
+def serialize_message(m: Message) -> dict:
+    return {
+        "message_id": m.id,
+        "user_id": m.user.id if m.user else None,
+        "username": m.user.username if m.user else "Unknown",
+        "message": m.body,
+        "timestamp": iso(m.created),
+    }
+
+
+def _decode(entry) -> str:
+    return entry.decode() if isinstance(entry, bytes) else entry
+
+
+def fetch_messages_db(room_id, limit: int = HISTORY_PAGE_SIZE, before_id: int | None = None) -> list[Message]:
+    """Oldest-first page of messages from the database, continuing into the archive."""
+    qs = (
+        Message.objects.filter(room_id=room_id)
+        .select_related("user")
+        .order_by("-id")
+    )
+    if before_id:
+        qs = qs.filter(id__lt=before_id)
+    items = list(qs[:limit])
+    items.reverse()
+    if len(items) < limit:
+        older = archive.fetch_before(room_id, items[0].id if items else before_id, limit - len(items))
+        items = older + items
+    return items
+
+
+def fetch_messages_after_db(room_id, after_id: int, limit: int = HISTORY_PAGE_SIZE) -> list[Message]:
+    """Oldest-first messages newer than ``after_id``."""
+    items = archive.fetch_after(room_id, after_id, limit)
+    if len(items) < limit:
+        qs = (
+            Message.objects.filter(room_id=room_id, id__gt=after_id)
+            .select_related("user")
+            .order_by("id")
+        )
+        items += list(qs[:limit - len(items)])
+    return items
+
+
+afetch_messages_db = database_sync_to_async(fetch_messages_db)
+afetch_messages_after_db = database_sync_to_async(fetch_messages_after_db)
+
+
+async def append(r, room_id, message_id: int, entry: str):
+    """Add a freshly written message to the room's window."""
+    await r.register_script(APPEND_SCRIPT)(
+        keys=[history_key(room_id), floor_key(room_id)],
+        args=[message_id, entry, settings.CHAT_HISTORY_WINDOW, settings.CHAT_HISTORY_TTL],
+    )
+
+
+async def fill(r, room_id, entries: list[tuple[int, str]], complete: bool):
+    """Seed the window from the database. ``complete`` means the room has no older messages."""
+    floor = 0 if complete or not entries else entries[0][0]
+    args = [floor, settings.CHAT_HISTORY_WINDOW, settings.CHAT_HISTORY_TTL]
+    for message_id, entry in entries:
+        args.extend((message_id, entry))
+    await r.register_script(FILL_SCRIPT)(
+        keys=[history_key(room_id), floor_key(room_id)], args=args
+    )
+
+
+async def remove(r, room_id, message_id: int):
+    await r.zremrangebyscore(history_key(room_id), message_id, message_id)
+
+
+async def drop(r, room_id):
+    await r.delete(history_key(room_id), floor_key(room_id))
+
+
+async def read(r, room_id, limit: int = HISTORY_PAGE_SIZE, before_id: int | None = None) -> list[str] | None:
+    """Oldest-first JSON entries, or ``None`` if the window cannot answer the page."""
+    upper = f"({before_id}" if before_id else "+inf"
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.get(floor_key(room_id))
+        pipe.zrevrangebyscore(history_key(room_id), upper, "-inf", start=0, num=limit, withscores=True)
+        floor, entries = await pipe.execute()
+
+    if floor is None:
+        return None
+    floor = int(floor)
+    if len(entries) < limit:
+        if floor != 0:
+            return None
+    elif entries[-1][1] < floor:
+        return None
+    return [_decode(entry) for entry, _ in reversed(entries)]
+
+
+async def read_after(r, room_id, after_id: int, limit: int = HISTORY_PAGE_SIZE) -> list[str] | None:
+    """Oldest-first JSON entries newer than ``after_id``, or ``None`` on a window miss."""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.get(floor_key(room_id))
+        pipe.zrangebyscore(history_key(room_id), f"({after_id}", "+inf", start=0, num=limit)
+        floor, entries = await pipe.execute()
+
+    if floor is None:
+        return None
+    floor = int(floor)
+    if floor != 0 and floor > after_id + 1:
+        return None
+    return [_decode(entry) for entry in entries]
+
+
+async def load_after(r, room_id, after_id: int, limit: int = HISTORY_PAGE_SIZE) -> list[str]:
+    """Messages newer than ``after_id``, from the window when it reaches back that far."""
+    try:
+        cached = await read_after(r, room_id, after_id, limit)
+    except Exception as e:
+        logger.warning(f"History read failed: {e}")
+        cached = None
+    if cached is not None:
+        metrics.inc("chat_history_cache_total", result="hit")
+        return cached
+
+    metrics.inc("chat_history_cache_total", result="miss")
+
+    async def from_db():
+        msgs = await afetch_messages_after_db(room_id, after_id, limit)
+        return [json.dumps(serialize_message(m)) for m in msgs]
+
+    return await _flights.do((str(room_id), limit, "after", after_id), from_db)
+
+
+async def load(r, room_id, limit: int = HISTORY_PAGE_SIZE, before_id: int | None = None) -> list[str]:
+    """Read a page of history from the window, falling back to the database."""
+    try:
+        cached = await read(r, room_id, limit, before_id)
+    except Exception as e:
+        logger.warning(f"History read failed: {e}")
+        cached = None
+    if cached is not None:
+        metrics.inc("chat_history_cache_total", result="hit")
+        return cached
+
+    metrics.inc("chat_history_cache_total", result="miss")
+    return await _flights.do(
+        (str(room_id), limit, before_id), lambda: _load_miss(r, room_id, limit, before_id)
+    )
+
+
+async def _wait_for_fill(r, room_id, limit: int) -> list[str] | None:
+    """Poll the window while another process holds the fill lock."""
+    for _ in range(int(settings.CHAT_HISTORY_LOCK_TTL / LOCK_POLL_INTERVAL)):
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        cached = await read(r, room_id, limit)
+        if cached is not None:
+            return cached
+        if not await r.exists(lock_key(room_id)):
+            return None
+    return None
+
+
+async def _unlock(r, room_id, token: str):
+    try:
+        await r.register_script(UNLOCK_SCRIPT)(keys=[lock_key(room_id)], args=[token])
+    except Exception as e:
+        logger.warning(f"History fill lock release failed: {e}")
+
+
+async def _load_miss(r, room_id, limit: int, before_id: int | None) -> list[str]:
+    global _lock_waits_served
+
+    token = None
+    if before_id is None and settings.CHAT_HISTORY_LOCK:
+        try:
+            candidate = secrets.token_hex(8)
+            if await r.set(lock_key(room_id), candidate, nx=True, px=int(settings.CHAT_HISTORY_LOCK_TTL * 1000)):
+                token = candidate
+            else:
+                cached = await _wait_for_fill(r, room_id, limit)
+                if cached is not None:
+                    _lock_waits_served += 1
+                    return cached
+        except Exception as e:
+            logger.warning(f"History fill lock failed: {e}")
+
+    try:
+        fetch = limit if before_id else max(limit, settings.CHAT_HISTORY_WINDOW)
+        msgs = await afetch_messages_db(room_id, fetch, before_id)
+        entries = [(m.id, json.dumps(serialize_message(m))) for m in msgs]
+
+        if before_id is None:
+            try:
+                await fill(r, room_id, entries, complete=len(msgs) < fetch)
+            except Exception as e:
+                logger.warning(f"History fill failed: {e}")
+        return [entry for _, entry in entries[-limit:]]
+    finally:
+        if token is not None:
+            await _unlock(r, room_id, token)
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from base import activity, archive
+from base.redis_pool import get_redis
+
+
+class Command(BaseCommand):
+    help = "Move messages older than CHAT_ARCHIVE_AFTER_DAYS into compressed per-room archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+                            help="archive messages older than this many days")
+        parser.add_argument("--segment-size", type=int, default=settings.CHAT_ARCHIVE_SEGMENT_SIZE,
+                            help="messages per archive segment")
+        parser.add_argument("--room", type=int, action="append", dest="rooms",
+                            help="only archive this room (repeatable)")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        stats = archive.archive_before(cutoff, options["segment_size"], options["rooms"])
+        if stats["messages"]:
+            try:
+                # The cached feed may still list archived messages.
+                async_to_sync(activity.drop)(get_redis(decode_responses=True))
+            except Exception as e:
+                self.stderr.write(f"Activity feed invalidation failed: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {stats['messages']} messages from {stats['rooms']} rooms (before {cutoff:%Y-%m-%d %H:%M})."
+        ))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from base import avatars
+from base.models import User
+
+
+class Command(BaseCommand):
+    help = "Build resized, content-hashed avatar variants for users uploaded before they existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="rebuild users that already have variants")
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(avatar="").exclude(avatar__isnull=True).exclude(avatar__iendswith=".svg")
+        if not options["force"]:
+            users = users.filter(avatar_variants={})
+
+        built = skipped = 0
+        for user in users.only("id", "avatar", "avatar_variants").iterator():
+            if avatars.refresh(user):
+                built += 1
+            else:
+                skipped += 1
+                self.stderr.write(f"No variants for user {user.id} ({user.avatar.name})")
+        self.stdout.write(self.style.SUCCESS(f"Built avatar variants for {built} users, skipped {skipped}."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from base import counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the room, participant and message counters from the source tables."
+
+    def handle(self, *args, **options):
+        counters.rebuild()
+        self.stdout.write(self.style.SUCCESS("Counters rebuilt."))
@@ -0,0 +1,45 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from base import redis_pool, warmup
+
+
+class Command(BaseCommand):
+    help = "Preload history windows, room metadata and membership into Redis for the busiest rooms."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=1000, help="how many rooms to warm")
+        parser.add_argument("--hours", type=float, default=24, help="rank rooms by messages in this many hours")
+        parser.add_argument("--batch-size", type=int, default=50, help="rooms per query batch and pipeline")
+        parser.add_argument("--concurrency", type=int, default=4, help="batches in flight")
+
+    def handle(self, *args, **options):
+        room_ids = warmup.rank_rooms(options["rooms"], options["hours"])
+        self.stdout.write(f"Warming {len(room_ids)} rooms...")
+
+        def progress(totals):
+            self.stdout.write(
+                f"  {totals['rooms']}/{len(room_ids)} rooms, {totals['messages']} messages, {totals['seconds']}s"
+            )
+
+        async def run():
+            try:
+                return await warmup.warm(
+                    redis_pool.get_redis(decode_responses=True),
+                    room_ids,
+                    batch_size=options["batch_size"],
+                    concurrency=options["concurrency"],
+                    progress=progress,
+                )
+            finally:
+                await redis_pool.close_all()
+
+        totals = asyncio.run(run())
+        if totals["failed_batches"]:
+            self.stderr.write(
+                f"{totals['failed_batches']} batches failed, last error: {totals['last_error']}"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {totals['rooms']} rooms and {totals['messages']} messages in {totals['seconds']}s."
+        ))
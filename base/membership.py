@@ -0,0 +1,56 @@
+"""
+Cached room membership.
+
+``Room.participants`` only ever needs one INSERT per (room, user), but the chat
+paths used to call ``participants.add`` on every message. ``ensure`` checks a
+per-room Redis set (``room:<id>:participants``) first and only touches the M2M
+table for users it has not seen. The set is a positive cache: a missing entry
+just means one extra idempotent ``add``. Entries are dropped by the
+``m2m_changed``/``post_delete`` handlers in ``base.signals`` so a removed
+participant is re-added on their next message.
+"""
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def participants_key(room_id) -> str:
+    return f"room:{room_id}:participants"
+
+
+async def ensure(r, room_id, user_id: int, add):
+    """Make ``user_id`` a participant, calling the async ``add`` only on a cache miss."""
+    key = participants_key(room_id)
+    try:
+        if await r.sismember(key, user_id):
+            return
+    except Exception as e:
+        logger.warning(f"Membership cache read failed: {e}")
+
+    await add()
+
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.sadd(key, user_id)
+            pipe.expire(key, settings.CHAT_MEMBERSHIP_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Membership cache write failed: {e}")
+
+
+async def forget(r, room_id, user_ids=None):
+    """Drop cached members of a room, or the whole set when ``user_ids`` is None."""
+    if user_ids is None:
+        await r.delete(participants_key(room_id))
+    elif user_ids:
+        await r.srem(participants_key(room_id), *user_ids)
+
+
+def prime(pipe, room_id, user_ids):
+    """Queue a room's known participants on ``pipe``."""
+    if user_ids:
+        key = participants_key(room_id)
+        pipe.sadd(key, *user_ids)
+        pipe.expire(key, settings.CHAT_MEMBERSHIP_TTL)
@@ -0,0 +1,341 @@
+"""
+Prometheus metrics for the HTTP views and ``ChatConsumer``.
+
+Recording is lock-free: each thread increments its own ``Counter`` shard, and
+only the first record in a new thread takes a lock, to register the shard. A
+daemon thread sums the shards every ``CHAT_METRICS_FLUSH_INTERVAL`` seconds
+and adds what changed since its last push into one Redis hash
+(``metrics:counters``). The ASGI and WSGI entry points start it with
+:func:`start`, so tests and management commands only record in memory. Every worker process adds into the same hash, so
+``/metrics`` serves totals for the whole deployment. Values only grow, so a
+shard read while another thread is writing it is at most one increment
+behind. The next flush catches up.
+
+Histograms are stored as per-bucket counts plus ``_sum`` and ``_count`` and
+made cumulative when rendered.
+
+Modules that already keep their own running totals (the rate limiter, the
+typing aggregator, ...) :func:`register` a collector instead of recording
+every event twice. Counter fields from collectors are pushed like shard
+totals. Gauge fields are current values, so each process writes its own
+``metrics:gauges:<host>:<pid>`` hash, which expires a few flushes after the
+process stops. ``/metrics`` sums the live ones.
+
+``/metrics`` needs ``Authorization: Bearer <CHAT_METRICS_TOKEN>`` when a
+token is set. Without one, it only answers ``CHAT_METRICS_ALLOWED_IPS``
+(loopback by default).
+"""
+import atexit
+import hmac
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+import redis
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import redis_pool
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "metrics:counters"
+GAUGES_KEY = "metrics:gauges"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+DEPTH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "chat_ws_connects_total": ("counter", "WebSocket connections accepted.", None),
+    "chat_ws_disconnects_total": ("counter", "WebSocket disconnects by close code.", None),
+    "chat_ws_events_total": ("counter", "Client events received by type.", None),
+    "chat_ws_db_seconds": ("histogram", "Consumer database calls.", LATENCY_BUCKETS),
+    "chat_history_cache_total": ("counter", "History window lookups by result.", None),
+    "chat_history_db_queries_total": ("counter", "History pages read from the database.", None),
+    "chat_history_coalesced_total": ("counter", "History misses that shared another caller's query.", None),
+    "chat_history_lock_waits_served_total": ("counter", "History misses served by another process's fill.", None),
+    "chat_history_saved_total": ("counter", "History database queries saved (coalesced plus lock waits).", None),
+    "chat_fanout_sends_total": ("counter", "Frames sent to a room group, by frame type.", None),
+    # deliveries / sends is the mean fan-out size per frame type.
+    "chat_fanout_deliveries_total": ("counter", "Frames delivered to sockets, by frame type.", None),
+    "chat_rate_limited_total": ("counter", "Events refused by a rate limit, by type and bucket scope.", None),
+    "chat_send_queue_depth": ("histogram", "Outbound frames queued per socket, sampled on enqueue.", DEPTH_BUCKETS),
+    "chat_send_dropped_total": ("counter", "Outbound frames dropped from full send queues, by kind.", None),
+    "chat_slow_consumer_disconnects_total": ("counter", "Sockets closed because their send queue filled.", None),
+    "chat_rate_limit_local_refusals_total": ("counter", "Rate-limited events refused without asking Redis.", None),
+    "chat_rate_limit_redis_checks_total": ("counter", "Rate limit checks that went to Redis.", None),
+    "chat_typing_events_total": ("counter", "Typing events received by the aggregator.", None),
+    "chat_typing_broadcasts_total": ("counter", "Typing snapshots broadcast to rooms.", None),
+    "chat_write_behind_batch_size": ("histogram", "Messages persisted per write-behind insert.", DEPTH_BUCKETS),
+    "chat_write_behind_flush_seconds": ("histogram", "Write-behind insert latency.", LATENCY_BUCKETS),
+    "chat_write_behind_failures_total": ("counter", "Write-behind flushes put back for a retry.", None),
+    "chat_write_behind_dead_letters_total": ("counter", "Messages the write-behind flusher could not store.", None),
+    "chat_write_behind_id_blocks_total": ("counter", "Message ID blocks reserved from the database sequence.", None),
+    "chat_redis_pool_connections": ("gauge", "Redis pool connections by state (in_use, idle).", None),
+    "chat_redis_pool_max_connections": ("gauge", "Redis pool connection limit.", None),
+    "http_view_seconds": ("histogram", "View latency.", LATENCY_BUCKETS),
+    "http_view_queries": ("histogram", "Database queries per request.", QUERY_BUCKETS),
+}
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+_pushed = Counter()
+_flush_lock = threading.Lock()
+_flusher = None
+_client = None
+_collectors = []
+
+
+def _shard() -> Counter:
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = Counter()
+        with _shards_lock:
+            _shards.append(shard)
+        return shard
+
+
+def _field(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def inc(name: str, amount: float = 1, **labels):
+    _shard()[_field(name, labels)] += amount
+
+
+def observe(name: str, value: float, **labels):
+    shard = _shard()
+    buckets = METRICS[name][2]
+    le = next((str(b) for b in buckets if value <= b), "+Inf")
+    shard[_field(name + "_bucket", {**labels, "le": le})] += 1
+    shard[_field(name + "_sum", labels)] += value
+    shard[_field(name + "_count", labels)] += 1
+
+
+@contextmanager
+def timer(name: str, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def instrument_view(view_name: str):
+    """Record latency and query count for a view under ``view=<view_name>``."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            queries = 0
+
+            def count(execute, sql, params, many, context):
+                nonlocal queries
+                queries += 1
+                return execute(sql, params, many, context)
+
+            with timer("http_view_seconds", view=view_name), connection.execute_wrapper(count):
+                response = view(request, *args, **kwargs)
+            observe("http_view_queries", queries, view=view_name)
+            return response
+        return wrapper
+    return decorator
+
+
+def register(collect):
+    """Call ``collect()`` on every flush; it returns ``{field: value}`` for this process.
+
+    Counter fields are running totals, gauge fields current values. Usable
+    as a decorator.
+    """
+    _collectors.append(collect)
+    return collect
+
+
+@register
+def _collect_redis_pools() -> dict:
+    # Defined here: redis_pool is imported by this module, so it can't register itself.
+    values = Counter()
+    for pool in redis_pool.stats():
+        decode = str(pool["decode_responses"]).lower()
+        for state in ("in_use", "idle"):
+            values[_field("chat_redis_pool_connections", {"decode": decode, "state": state})] += pool[state]
+        values[_field("chat_redis_pool_max_connections", {"decode": decode})] += pool["max_connections"]
+    return values
+
+
+def _get_client() -> redis.Redis:
+    # Sync client: the flusher runs in its own thread, outside any event loop.
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(redis_pool.REDIS_URL, decode_responses=True)
+    return _client
+
+
+def _snapshot(shard: Counter) -> dict:
+    while True:
+        try:
+            return dict(shard)
+        except RuntimeError:  # another thread added a key mid-copy
+            continue
+
+
+def _gauges_key() -> str:
+    return f"{GAUGES_KEY}:{socket.gethostname()}:{os.getpid()}"
+
+
+def _collect() -> tuple[Counter, dict]:
+    """Counter totals and gauge values from the registered collectors."""
+    totals, gauges = Counter(), {}
+    for collect in list(_collectors):
+        try:
+            values = collect()
+        except Exception as e:  # e.g. a dict resized by another thread mid-read
+            logger.warning(f"Metrics collector {collect.__qualname__} failed: {e}")
+            continue
+        for field, value in values.items():
+            if METRICS[_family(field)][0] == "gauge":
+                gauges[field] = gauges.get(field, 0) + value
+            else:
+                totals[field] += value
+    return totals, gauges
+
+
+def flush():
+    """Push everything recorded since the last flush to Redis."""
+    with _flush_lock:
+        with _shards_lock:
+            shards = list(_shards)
+        total, gauges = _collect()
+        for shard in shards:
+            total.update(_snapshot(shard))
+        delta = {field: value - _pushed[field] for field, value in total.items() if value != _pushed[field]}
+        if not delta and not gauges:
+            return
+        with _get_client().pipeline(transaction=False) as pipe:
+            for field, value in delta.items():
+                pipe.hincrbyfloat(METRICS_KEY, field, value)
+            if gauges:
+                key = _gauges_key()
+                pipe.delete(key)
+                pipe.hset(key, mapping=gauges)
+                pipe.expire(key, int(settings.CHAT_METRICS_FLUSH_INTERVAL * 3) + 1)
+            pipe.execute()
+        _pushed.update(delta)
+
+
+def _run():
+    while True:
+        time.sleep(settings.CHAT_METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.warning(f"Metrics flush failed: {e}")
+
+
+def _flush_at_exit():
+    try:
+        flush()
+        _get_client().delete(_gauges_key())
+    except Exception as e:
+        logger.warning(f"Metrics flush failed: {e}")
+
+
+def start():
+    """Start pushing metrics to Redis from this process. Called by the server entry points."""
+    global _flusher
+    if _flusher is None:
+        _flusher = threading.Thread(target=_run, name="metrics-flusher", daemon=True)
+        _flusher.start()
+        atexit.register(_flush_at_exit)
+
+
+def _family(field: str) -> str:
+    name = field.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+            return name[: -len(suffix)]
+    return name
+
+
+def _cumulative(fields: dict) -> dict:
+    """Turn per-bucket counts into Prometheus' cumulative ``le`` buckets."""
+    series = {}  # labels without le -> {le: count}
+    for field, value in fields.items():
+        labels = field[field.index("{") + 1:-1].split(",")
+        le = next(label for label in labels if label.startswith("le="))
+        rest = ",".join(label for label in labels if label != le)
+        series.setdefault(rest, {})[le[4:-1]] = value
+    result = {}
+    for rest, counts in series.items():
+        prefix, running = (rest + ",") if rest else "", 0.0
+        name = next(iter(fields)).split("{", 1)[0]
+        for bound in [str(b) for b in METRICS[_family(name)][2]] + ["+Inf"]:
+            running += counts.get(bound, 0.0)
+            result[f'{name}{{{prefix}le="{bound}"}}'] = running
+    return result
+
+
+def render(values: dict) -> str:
+    families = {}
+    for field, value in values.items():
+        families.setdefault(_family(field), {})[field] = float(value)
+
+    lines = []
+    for family in sorted(families):
+        fields = families[family]
+        kind, help_text, _ = METRICS.get(family, ("untyped", "", None))
+        lines.append(f"# HELP {family} {help_text}")
+        lines.append(f"# TYPE {family} {kind}")
+        ordered = sorted(fields.items())
+        if kind == "histogram":
+            buckets = {f: v for f, v in fields.items() if f.startswith(family + "_bucket")}
+            ordered = list(_cumulative(buckets).items()) + [(f, v) for f, v in ordered if f not in buckets]
+        for field, value in ordered:
+            lines.append(f"{field} {int(value) if value.is_integer() else value}")
+    return "\n".join(lines) + "\n"
+
+
+def read_all() -> dict:
+    """Deployment-wide counters plus the gauges of every live process, summed."""
+    client = _get_client()
+    values = client.hgetall(METRICS_KEY)
+    keys = list(client.scan_iter(match=f"{GAUGES_KEY}:*", count=100))
+    if keys:
+        with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            for gauges in pipe.execute():
+                for field, value in gauges.items():
+                    values[field] = float(values.get(field, 0)) + float(value)
+    return values
+
+
+def _allowed(request) -> bool:
+    token = settings.CHAT_METRICS_TOKEN
+    if token:
+        return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+    return request.META.get("REMOTE_ADDR") in settings.CHAT_METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    """Prometheus text exposition of the deployment-wide totals."""
+    if not _allowed(request):
+        return HttpResponseForbidden()
+    try:
+        flush()
+        values = read_all()
+    except Exception as e:
+        logger.warning(f"Metrics read failed: {e}")
+        return HttpResponse("metrics unavailable\n", status=503, content_type="text/plain")
+    return HttpResponse(render(values), content_type="text/plain; version=0.0.4; charset=utf-8")
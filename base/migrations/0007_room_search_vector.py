@@ -0,0 +1,61 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:12
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+PG_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS base_room_search_gin ON base_room USING gin (search_vector)",
+    "CREATE INDEX IF NOT EXISTS base_room_name_trgm ON base_room USING gin (name gin_trgm_ops)",
+    """
+    UPDATE base_room SET search_vector =
+        setweight(to_tsvector('english', coalesce(base_room.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT t.name FROM base_topic t WHERE t.id = base_room.topic_id), '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(base_room.description, '')), 'B')
+    """,
+]
+PG_BACKWARD = [
+    "DROP INDEX IF EXISTS base_room_name_trgm",
+    "DROP INDEX IF EXISTS base_room_search_gin",
+]
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS base_room_fts USING fts5(name, description, topic, tokenize='porter unicode61')",
+    """
+    INSERT INTO base_room_fts (rowid, name, description, topic)
+    SELECT r.id, r.name, coalesce(r.description, ''), coalesce(t.name, '')
+    FROM base_room r LEFT JOIN base_topic t ON t.id = r.topic_id
+    """,
+]
+SQLITE_BACKWARD = [
+    "DROP TABLE IF EXISTS base_room_fts",
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        statements = statements_by_vendor.get(schema_editor.connection.vendor, [])
+        with schema_editor.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_alter_user_options_alter_message_created_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(
+            _run({'postgresql': PG_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            _run({'postgresql': PG_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
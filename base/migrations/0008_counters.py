@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:03
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def _count(qs, group_field):
+    counted = qs.filter(**{group_field: OuterRef("pk")}).order_by().values(group_field)
+    return Coalesce(Subquery(counted.annotate(c=Count("*")).values("c")[:1]), Value(0))
+
+
+def populate(apps, schema_editor):
+    Topic = apps.get_model("base", "Topic")
+    Room = apps.get_model("base", "Room")
+    Message = apps.get_model("base", "Message")
+    Participant = Room.participants.through
+    Topic.objects.update(room_count=_count(Room.objects.all(), "topic"))
+    Room.objects.update(
+        message_count=_count(Message.objects.all(), "room"),
+        participant_count=_count(Participant.objects.all(), "room"),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_room_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='room_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='participant_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate, migrations.RunPython.noop),
+    ]
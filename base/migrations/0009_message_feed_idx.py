@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['-created', '-id'], name='base_message_feed_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_message_feed_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id'], name='base_message_room_id_idx'),
+        ),
+    ]
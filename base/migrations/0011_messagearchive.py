@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_message_room_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('first_created', models.DateTimeField()),
+                ('last_created', models.DateTimeField()),
+                ('message_count', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='base.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'last_id'], name='base_archive_room_last_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_message_seq(apps, schema_editor):
+    Room = apps.get_model('base', 'Room')
+    Room.objects.update(message_seq=models.F('message_count'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0011_messagearchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='message_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(seed_message_seq, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.BigIntegerField(default=0)),
+                ('read_seq', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='base.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'room'), name='base_readstate_user_room')],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 
 
 class User(AbstractUser):
@@ -7,6 +8,8 @@ class User(AbstractUser):
     email = models.EmailField(unique=True, null=True, db_index=True)
     bio = models.TextField(null=True, blank=True)
     avatar = models.ImageField(null=True, default="avatar.svg")
+    # Resized copies of avatar, size name -> media path. Maintained by base.avatars.
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username"]
@@ -20,6 +23,7 @@ class User(AbstractUser):
 
 class Topic(models.Model):
     name = models.CharField(max_length=200, unique=True, db_index=True)
+    room_count = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -44,6 +48,13 @@ class Room(models.Model):
     )
     updated = models.DateTimeField(auto_now=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Maintained by base.search; GIN/trigram indexes are created in migration 0007.
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Maintained by base.counters.
+    participant_count = models.IntegerField(default=0, editable=False)
+    message_count = models.IntegerField(default=0, editable=False)
+    # Messages ever posted, never decremented; base.unread derives unread counts from it.
+    message_seq = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ["-updated", "-created"]
@@ -70,7 +81,51 @@ class Message(models.Model):
             models.Index(fields=["updated"]),
             models.Index(fields=["created"]),
             models.Index(fields=["room", "created"]),
+            # Keyset pagination of a room's history by message ID.
+            models.Index(fields=["room", "id"], name="base_message_room_id_idx"),
+            # Keyset pagination for the activity feed.
+            models.Index(fields=["-created", "-id"], name="base_message_feed_idx"),
         ]
 
     def __str__(self):
         return self.body[:50]
+
+
+class MessageArchive(models.Model):
+    """
+    A run of a room's archived messages, ``first_id``..``last_id``, stored as
+    zlib-compressed JSON. Written and read by ``base.archive``.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="archive_segments")
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_created = models.DateTimeField()
+    last_created = models.DateTimeField()
+    message_count = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "last_id"], name="base_archive_room_last_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.room_id}: {self.first_id}-{self.last_id}"
+
+
+class ReadState(models.Model):
+    """How far a user has read a room. Written behind the Redis copy by ``base.unread``."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_states")
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="read_states")
+    last_read_id = models.BigIntegerField(default=0)
+    # Room.message_seq as of last_read_id.
+    read_seq = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "room"], name="base_readstate_user_room"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.room_id} to {self.last_read_id}"
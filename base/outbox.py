@@ -0,0 +1,100 @@
+"""
+Per-connection outbound queue.
+
+Channel-layer handlers hand frames to an ``Outbox`` and return at once. A
+writer task sends them to the socket in order, so a slow client's network
+never stalls the consumer's channel, which would otherwise fill up and start
+losing messages at the channel layer's capacity.
+
+The queue holds ``CHAT_SEND_QUEUE_SIZE`` frames. When it is full, the oldest
+``typing`` frame is dropped first, then the oldest ``presence`` frame. Typing
+frames are full snapshots, so only a stale one is lost. Chat and control
+frames are never dropped. A queue full of them marks a slow consumer. With
+``CHAT_SLOW_CONSUMER_POLICY = "disconnect"`` (the default), ``put`` raises
+:class:`SlowConsumer` and the consumer closes the socket. With ``"block"``,
+``put`` waits for space, which pushes back on the channel as before. A
+writer that has stopped (its socket send failed) frees no more space, so a
+full ``put`` raises :class:`SlowConsumer` then, whatever the policy.
+"""
+import asyncio
+import logging
+from collections import Counter, deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DROP_ORDER = ("typing", "presence")
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class Outbox:
+    def __init__(self, send, size: int, policy: str = "disconnect"):
+        self._send = send
+        self.size = size
+        self.policy = policy
+        self._frames = deque()   # (kind, text_data, bytes_data)
+        self._kinds = Counter()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, kind: str, text_data=None, bytes_data=None):
+        while len(self._frames) >= self.size:
+            victim = next((k for k in DROP_ORDER if self._kinds[k] or k == kind), None)
+            if victim is not None:
+                metrics.inc("chat_send_dropped_total", kind=victim)
+                if not self._kinds[victim]:
+                    return  # the new frame is the least important one
+                self._remove_oldest(victim)
+                break
+            if self.policy != "block" or self._task is None or self._task.done():
+                raise SlowConsumer()
+            self._space.clear()
+            await self._space.wait()
+
+        self._frames.append((kind, text_data, bytes_data))
+        self._kinds[kind] += 1
+        metrics.observe("chat_send_queue_depth", len(self._frames))
+        self._ready.set()
+
+    def _remove_oldest(self, kind: str):
+        for i, frame in enumerate(self._frames):
+            if frame[0] == kind:
+                del self._frames[i]
+                self._kinds[kind] -= 1
+                return
+
+    async def _run(self):
+        while True:
+            while not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+            kind, text_data, bytes_data = self._frames.popleft()
+            self._kinds[kind] -= 1
+            self._space.set()
+            try:
+                await self._send(text_data=text_data, bytes_data=bytes_data)
+            except Exception as e:
+                logger.info(f"Socket send failed, stopping writer: {e}")
+                self._space.set()  # wake blocked put() calls; they raise SlowConsumer
+                return
+
+    def close(self):
+        """Stop the writer and discard anything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._frames.clear()
+        self._kinds.clear()
+        self._space.set()
@@ -0,0 +1,189 @@
+"""
+Per-room presence roster.
+
+Each open socket is one entry in ``room:<id>:presence:conns``, a Redis sorted
+set keyed by channel name and scored by heartbeat expiry. The
+``room:<id>:presence:users`` hash maps each channel to ``"<user_id>:<username>"``,
+so a user with several tabs open counts once and stays online until the last
+tab leaves.
+
+A per-process ``PresenceTracker`` registers sockets as they connect. It sends
+the joining socket a roster snapshot and refreshes heartbeats for its local
+sockets. Every ``CHAT_PRESENCE_TICK`` seconds it runs a diff for its rooms:
+expired sockets (including those of a crashed worker) are removed, and the
+current user set is compared with the last roster broadcast. Any joins and
+leaves go out as one batched ``{"type": "presence", ...}`` frame. The diff is
+atomic, so only one worker broadcasts a given change.
+"""
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import wire
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS: conns, users, last roster. ARGV: now, key ttl.
+# Returns {joined, left} since the last call that saw a change.
+DIFF_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, conn in ipairs(expired) do
+  redis.call('ZREM', KEYS[1], conn)
+  redis.call('HDEL', KEYS[2], conn)
+end
+local current = {}
+for _, user in ipairs(redis.call('HVALS', KEYS[2])) do
+  current[user] = true
+end
+local joined, left = {}, {}
+for user in pairs(current) do
+  if redis.call('SISMEMBER', KEYS[3], user) == 0 then
+    table.insert(joined, user)
+    redis.call('SADD', KEYS[3], user)
+  end
+end
+for _, user in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+  if not current[user] then
+    table.insert(left, user)
+    redis.call('SREM', KEYS[3], user)
+  end
+end
+for i = 1, 3 do
+  redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return {joined, left}
+"""
+
+
+def conns_key(room_id) -> str:
+    return f"room:{room_id}:presence:conns"
+
+
+def users_key(room_id) -> str:
+    return f"room:{room_id}:presence:users"
+
+
+def last_key(room_id) -> str:
+    return f"room:{room_id}:presence:last"
+
+
+def _user(member: str) -> dict:
+    user_id, _, username = member.partition(":")
+    return {"user_id": int(user_id), "username": username}
+
+
+async def roster(r, room_id) -> list[dict]:
+    """Users with at least one live socket in the room."""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zrangebyscore(conns_key(room_id), time.time(), "+inf")
+        pipe.hgetall(users_key(room_id))
+        live, users = await pipe.execute()
+    members = {users[conn] for conn in live if conn in users}
+    return sorted((_user(m) for m in members), key=lambda u: u["username"])
+
+
+class PresenceTracker:
+    def __init__(self, tick: float, ttl: float):
+        self.tick_interval = tick
+        self.ttl = ttl
+        self._conns = {}    # room_id -> {channel_name: member}
+        self._groups = {}   # room_id -> channel group
+        self._dirty = set()
+        self._last_heartbeat = 0.0
+        self._task = None
+
+    async def _get_redis(self):
+        return get_redis(decode_responses=True)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def join(self, room_id, group: str, channel_name: str, user_id: int, username: str) -> list[dict]:
+        """Register a socket and return the room's roster, including this user."""
+        self._ensure_started()
+        member = f"{user_id}:{username}"
+        self._conns.setdefault(room_id, {})[channel_name] = member
+        self._groups[room_id] = group
+        self._dirty.add(room_id)
+
+        r = await self._get_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.zadd(conns_key(room_id), {channel_name: time.time() + self.ttl})
+            pipe.hset(users_key(room_id), channel_name, member)
+            await pipe.execute()
+        return await roster(r, room_id)
+
+    async def leave(self, room_id, channel_name: str) -> bool:
+        """Unregister a socket. Returns whether the user still has another socket in the room."""
+        conns = self._conns.get(room_id, {})
+        member = conns.pop(channel_name, None)
+        self._dirty.add(room_id)
+
+        r = await self._get_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.zrem(conns_key(room_id), channel_name)
+            pipe.hdel(users_key(room_id), channel_name)
+            pipe.hvals(users_key(room_id))
+            _, _, members = await pipe.execute()
+        return member is not None and member in members
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Presence tick failed")
+
+    async def _heartbeat(self, r, now: float):
+        async with r.pipeline(transaction=False) as pipe:
+            for room_id, conns in self._conns.items():
+                if conns:
+                    pipe.zadd(conns_key(room_id), {channel: now + self.ttl for channel in conns})
+            await pipe.execute()
+        self._last_heartbeat = now
+
+    async def tick(self):
+        now = time.time()
+        r = await self._get_redis()
+        if now - self._last_heartbeat >= self.ttl / 3:
+            await self._heartbeat(r, now)
+
+        rooms = self._dirty | {room_id for room_id, conns in self._conns.items() if conns}
+        self._dirty = set()
+        diff = r.register_script(DIFF_SCRIPT)
+        channel_layer = get_channel_layer()
+
+        for room_id in rooms:
+            joined, left = await diff(
+                keys=[conns_key(room_id), users_key(room_id), last_key(room_id)],
+                args=[now, int(self.ttl * 2)],
+            )
+            if not self._conns.get(room_id):
+                self._conns.pop(room_id, None)
+                group = self._groups.pop(room_id, None)
+            else:
+                group = self._groups.get(room_id)
+            if not (joined or left) or group is None:
+                continue
+            await channel_layer.group_send(group, wire.group_event({
+                "type": "presence",
+                "joined": [_user(m) for m in joined],
+                "left": [_user(m) for m in left],
+            }))
+
+
+_tracker = None
+
+
+def get_presence() -> PresenceTracker:
+    global _tracker
+    if _tracker is None:
+        _tracker = PresenceTracker(tick=settings.CHAT_PRESENCE_TICK, ttl=settings.CHAT_PRESENCE_TTL)
+    return _tracker
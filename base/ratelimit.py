@@ -0,0 +1,160 @@
+"""
+Token-bucket rate limits for WebSocket events.
+
+``CHAT_RATE_LIMITS`` maps an event type to its buckets, each a
+``(tokens per second, burst)`` pair. ``"user"`` buckets are per user across
+all of their sockets and rooms. ``"room"`` buckets are shared by everyone in
+the room. An event is allowed only if every bucket it draws from has a token.
+The check and the withdrawal run in one Lua script, so concurrent workers
+can't overdraw a bucket.
+
+Each process also keeps a local copy of every bucket, charged only for the
+events it let through. That copy can never hold fewer tokens than the shared
+bucket, so an empty local bucket is a safe refusal without asking Redis.
+After Redis refuses, the bucket is also blocked locally until the reported
+retry time. A flooding client therefore costs about one Redis call per
+refill rather than one per event. If Redis is unreachable, events are
+allowed.
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# KEYS: bucket hashes. ARGV: now (ms), cost, then rate (tokens/s) and burst per key.
+# Returns {allowed, retry after (ms), 1-based index of the bucket that refused}.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local levels = {}
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[1 + i * 2])
+  local burst = tonumber(ARGV[2 + i * 2])
+  local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(bucket[1]) or burst
+  local ts = tonumber(bucket[2]) or now
+  tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+  if tokens < cost then
+    return {0, math.ceil((cost - tokens) * 1000 / rate), i}
+  end
+  levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[1 + i * 2])
+  local burst = tonumber(ARGV[2 + i * 2])
+  redis.call('HSET', key, 'tokens', tostring(levels[i] - cost), 'ts', tostring(now))
+  redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return {1, 0, 0}
+"""
+
+
+class Verdict(NamedTuple):
+    allowed: bool
+    scope: str | None = None
+    retry_after: float = 0.0  # seconds
+
+
+ALLOWED = Verdict(True)
+
+
+def bucket_key(event: str, scope: str, ident) -> str:
+    return f"ratelimit:{event}:{scope}:{ident}"
+
+
+class _LocalBucket:
+    __slots__ = ("tokens", "ts", "blocked_until")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.ts = now
+        self.blocked_until = 0.0
+
+    def level(self, rate: float, burst: float, now: float) -> float:
+        self.tokens = min(burst, self.tokens + (now - self.ts) * rate)
+        self.ts = now
+        return self.tokens
+
+
+class RateLimiter:
+    def __init__(self, limits: dict, max_local: int = 10_000):
+        self.limits = limits
+        self.max_local = max_local
+        self._local = OrderedDict()  # bucket key -> _LocalBucket
+        self.local_refusals = 0
+        self.redis_checks = 0
+
+    def _bucket(self, key: str, burst: float, now: float) -> _LocalBucket:
+        bucket = self._local.get(key)
+        if bucket is None:
+            bucket = self._local[key] = _LocalBucket(burst, now)
+            if len(self._local) > self.max_local:
+                self._local.popitem(last=False)
+        else:
+            self._local.move_to_end(key)
+        return bucket
+
+    async def check(self, r, event: str, user_id, room_id, cost: float = 1) -> Verdict:
+        buckets = self.limits.get(event)
+        if not buckets:
+            return ALLOWED
+
+        now = time.time()
+        idents = {"user": user_id, "room": room_id}
+        plan = []  # (scope, key, rate, burst, local bucket)
+        for scope, (rate, burst) in buckets.items():
+            key = bucket_key(event, scope, idents[scope])
+            local = self._bucket(key, burst, now)
+            if now < local.blocked_until:
+                self.local_refusals += 1
+                return Verdict(False, scope, round(local.blocked_until - now, 3))
+            if local.level(rate, burst, now) < cost:
+                self.local_refusals += 1
+                return Verdict(False, scope, round((cost - local.tokens) / rate, 3))
+            plan.append((scope, key, rate, burst, local))
+
+        self.redis_checks += 1
+        try:
+            script = r.register_script(TOKEN_BUCKET_SCRIPT)
+            args = [int(now * 1000), cost]
+            for _, _, rate, burst, _ in plan:
+                args += [rate, burst]
+            allowed, retry_ms, index = await script(keys=[key for _, key, *_ in plan], args=args)
+        except Exception as e:
+            logger.warning(f"Rate limit check failed, allowing {event}: {e}")
+            return ALLOWED
+
+        if not allowed:
+            scope, _, _, _, local = plan[int(index) - 1]
+            local.blocked_until = now + int(retry_ms) / 1000
+            return Verdict(False, scope, int(retry_ms) / 1000)
+
+        for *_, local in plan:
+            local.tokens -= cost
+        return ALLOWED
+
+    def stats(self) -> dict:
+        return {"local_refusals": self.local_refusals, "redis_checks": self.redis_checks}
+
+
+_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(settings.CHAT_RATE_LIMITS)
+    return _limiter
+
+
+@metrics.register
+def _collect() -> dict:
+    if _limiter is None:
+        return {}
+    return {f"chat_rate_limit_{name}_total": value for name, value in _limiter.stats().items()}
@@ -0,0 +1,125 @@
+"""
+Process-wide Redis connection pools.
+
+Every Redis user in the app (views, ``ChatConsumer``, the history, presence,
+typing and write-behind modules, signal handlers) calls :func:`get_redis`
+instead of building its own client. An asyncio connection is tied to the event
+loop it was opened on, so the pool is kept per running loop: under ASGI that
+is one pool per worker process, shared by every socket and request.
+``async_to_sync`` calls from a WSGI worker or a management command get a
+short-lived pool for their own short-lived loop. That pool is closed when its
+loop shuts down, so connections don't pile up one pool per call.
+
+The returned object is a proxy. It resolves the client for the current loop
+on each attribute access, so it can be created at import time and held as a
+module global.
+
+Pool size and health checks come from ``CHAT_REDIS_MAX_CONNECTIONS`` and
+``CHAT_REDIS_HEALTH_CHECK_INTERVAL``. The pool blocks for up to
+``CHAT_REDIS_POOL_TIMEOUT`` seconds when it is exhausted instead of opening
+more connections. :func:`close_all` is called on server shutdown by
+``talkbuds.asgi``. :func:`stats` is exported as gauges on ``/metrics``.
+"""
+import asyncio
+import logging
+import os
+import weakref
+
+import redis.asyncio as redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+_clients = weakref.WeakKeyDictionary()  # loop -> {decode_responses: Redis}
+_closers = weakref.WeakKeyDictionary()  # loop -> _close_at_shutdown generator
+
+
+def _make_client(decode_responses: bool) -> redis.Redis:
+    pool = redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        decode_responses=decode_responses,
+        max_connections=settings.CHAT_REDIS_MAX_CONNECTIONS,
+        timeout=settings.CHAT_REDIS_POOL_TIMEOUT,
+        health_check_interval=settings.CHAT_REDIS_HEALTH_CHECK_INTERVAL,
+        retry_on_timeout=True,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+async def _close(clients: dict):
+    while clients:
+        _, client = clients.popitem()
+        try:
+            await client.aclose()
+            await client.connection_pool.disconnect()
+        except Exception as e:
+            logger.warning(f"Redis pool shutdown failed: {e}")
+
+
+async def _close_at_shutdown(clients: dict):
+    # loop.shutdown_asyncgens() closes every started async generator before the
+    # loop is closed. asyncio.run, and therefore every async_to_sync call made
+    # outside a server, calls it, which runs the finally below.
+    try:
+        yield
+    finally:
+        await _close(clients)
+
+
+def _watch(loop, clients: dict):
+    closer = _closers[loop] = _close_at_shutdown(clients)
+    try:
+        closer.asend(None).send(None)  # run to the yield; registers it with the loop
+    except StopIteration:
+        pass
+
+
+def client_for_loop(decode_responses: bool = False) -> redis.Redis:
+    loop = asyncio.get_running_loop()
+    clients = _clients.get(loop)
+    if clients is None:
+        clients = _clients[loop] = {}
+        _watch(loop, clients)
+    client = clients.get(decode_responses)
+    if client is None:
+        client = clients[decode_responses] = _make_client(decode_responses)
+    return client
+
+
+class SharedRedis:
+    """Proxy for the current loop's pooled client."""
+
+    def __init__(self, decode_responses: bool):
+        self._decode_responses = decode_responses
+
+    def __getattr__(self, name):
+        return getattr(client_for_loop(self._decode_responses), name)
+
+
+_shared = {False: SharedRedis(False), True: SharedRedis(True)}
+
+
+def get_redis(decode_responses: bool = False) -> SharedRedis:
+    return _shared[decode_responses]
+
+
+def stats() -> list[dict]:
+    """Connection usage for every live pool in this process."""
+    result = []
+    for clients in list(_clients.values()):
+        for decode_responses, client in clients.items():
+            pool = client.connection_pool
+            result.append({
+                "decode_responses": decode_responses,
+                "max_connections": pool.max_connections,
+                "in_use": len(getattr(pool, "_in_use_connections", ())),
+                "idle": len(getattr(pool, "_available_connections", ())),
+            })
+    return result
+
+
+async def close_all():
+    """Disconnect the pools that belong to the running loop."""
+    await _close(_clients.pop(asyncio.get_running_loop(), {}))
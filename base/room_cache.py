@@ -0,0 +1,189 @@
+"""
+Read-through cache of room metadata for the chat path.
+
+Two tiers sit in front of the database:
+* a per-process LRU of up to ``CHAT_ROOM_CACHE_SIZE`` rooms, each kept for
+  ``CHAT_ROOM_CACHE_LOCAL_TTL`` seconds
+* ``room:<id>:meta`` in Redis, a JSON copy of :data:`CACHED_FIELDS` kept for
+  ``CHAT_ROOM_CACHE_TTL`` seconds
+
+Hits come back as ``Room`` instances built with ``Room.from_db``. The fields
+that are not cached (``message_count``, ``search_vector``) are deferred and
+load on access. Concurrent misses for the same room share one query.
+
+The ``Room`` signal handlers call :func:`invalidate`. It deletes the Redis
+copy and publishes the room id on ``room_cache:invalidate``. ``ChatConsumer``
+starts a listener in each ASGI worker, and the listener drops the local copy
+when the message arrives. Processes without a listener, such as WSGI
+workers, rely on the short local TTL. Writes (``UpdateRoom`` and
+``DeleteRoom`` POSTs) still load the row from the database.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_datetime
+
+from .models import Room
+from .redis_pool import get_redis
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+INVALIDATE_CHANNEL = "room_cache:invalidate"
+CACHED_FIELDS = ("id", "host_id", "topic_id", "name", "description", "participant_count", "updated", "created")
+_DATETIME_FIELDS = ("updated", "created")
+# Room.from_db takes a partial row in model field order, whatever order the names are given in.
+_FIELD_ORDER = [f.attname for f in Room._meta.concrete_fields if f.attname in CACHED_FIELDS]
+
+_local = OrderedDict()  # room_id -> (expires at, fields)
+_local_lock = threading.Lock()
+_flights = SingleFlight()
+_listener = None
+
+
+def meta_key(room_id) -> str:
+    return f"room:{room_id}:meta"
+
+
+def _to_room(fields: dict) -> Room:
+    return Room.from_db(DEFAULT_DB_ALIAS, _FIELD_ORDER, [fields[name] for name in _FIELD_ORDER])
+
+
+def _encode(fields: dict) -> str:
+    return json.dumps({k: v.isoformat() if k in _DATETIME_FIELDS and v else v for k, v in fields.items()})
+
+
+def _decode(raw) -> dict:
+    fields = json.loads(raw)
+    for name in _DATETIME_FIELDS:
+        if fields.get(name):
+            fields[name] = parse_datetime(fields[name])
+    return fields
+
+
+def _local_get(room_id: int) -> dict | None:
+    with _local_lock:
+        entry = _local.get(room_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _local[room_id]
+            return None
+        _local.move_to_end(room_id)
+        return entry[1]
+
+
+def _local_put(room_id: int, fields: dict):
+    with _local_lock:
+        _local[room_id] = (time.monotonic() + settings.CHAT_ROOM_CACHE_LOCAL_TTL, fields)
+        _local.move_to_end(room_id)
+        while len(_local) > settings.CHAT_ROOM_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def _local_drop(room_id: int):
+    with _local_lock:
+        _local.pop(room_id, None)
+
+
+@database_sync_to_async
+def _fetch(room_id: int) -> dict | None:
+    return Room.objects.filter(pk=room_id).values(*CACHED_FIELDS).first()
+
+
+async def _load(r, room_id: int) -> dict | None:
+    try:
+        raw = await r.get(meta_key(room_id))
+        if raw is not None:
+            return _decode(raw)
+    except Exception as e:
+        logger.warning(f"Room cache read failed: {e}")
+
+    fields = await _fetch(room_id)
+    if fields is not None:
+        try:
+            await r.set(meta_key(room_id), _encode(fields), ex=settings.CHAT_ROOM_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Room cache fill failed: {e}")
+    return fields
+
+
+def prime(pipe, fields: dict):
+    """Queue the Redis copy of a room's ``CACHED_FIELDS`` on ``pipe``."""
+    pipe.set(meta_key(fields["id"]), _encode(fields), ex=settings.CHAT_ROOM_CACHE_TTL)
+
+
+async def aget(r, room_id) -> Room | None:
+    """The room, or ``None`` if it does not exist."""
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return None
+
+    fields = _local_get(room_id)
+    if fields is None:
+        fields = await _flights.do(room_id, lambda: _load(r, room_id))
+        if fields is None:
+            return None
+        _local_put(room_id, fields)
+    return _to_room(fields)
+
+
+def get(r, room_id) -> Room | None:
+    return async_to_sync(aget)(r, room_id)
+
+
+async def _listen():
+    while True:
+        pubsub = get_redis(decode_responses=True).pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            # Anything published while we were not subscribed was missed.
+            with _local_lock:
+                _local.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    _local_drop(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Room cache listener failed, resubscribing: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
+def ensure_listening():
+    """Start this process's invalidation listener on the running server loop."""
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.get_running_loop().create_task(_listen())
+
+
+async def _ainvalidate(room_ids):
+    r = get_redis(decode_responses=True)
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.delete(*[meta_key(room_id) for room_id in room_ids])
+        for room_id in room_ids:
+            pipe.publish(INVALIDATE_CHANNEL, room_id)
+        await pipe.execute()
+
+
+def invalidate(*room_ids):
+    room_ids = [room_id for room_id in room_ids if room_id is not None]
+    if not room_ids:
+        return
+    for room_id in room_ids:
+        _local_drop(room_id)
+    try:
+        async_to_sync(_ainvalidate)(room_ids)
+    except Exception as e:
+        logger.warning(f"Room cache invalidation failed: {e}")
@@ -0,0 +1,135 @@
+"""
+Ranked room search for the home, Topics and Activity pages.
+
+PostgreSQL: ``Room.search_vector`` is a weighted ``tsvector`` (room name and
+topic name at weight A, description at B) with a GIN index, plus a trigram
+index on ``name`` for partial words and typos. Results are ordered by
+``ts_rank`` and then by trigram similarity.
+
+SQLite (tests and dev): the same three columns are mirrored into the
+``base_room_fts`` FTS5 table and ranked with ``bm25``. The queryset joins the
+FTS table, so counts and pages cover every match.
+
+Any other backend, or SQLite without FTS5, falls back to the old ``icontains``
+filter. The index is kept current by the ``Room``/``Topic`` signal handlers in
+``base.signals``.
+"""
+import logging
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F, Q
+
+from .models import Room
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CONFIG = "english"
+
+PG_REINDEX_SQL = f"""
+UPDATE base_room SET search_vector =
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(base_room.name, '')), 'A') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(
+        (SELECT t.name FROM base_topic t WHERE t.id = base_room.topic_id), '')), 'A') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(base_room.description, '')), 'B')
+"""
+
+SQLITE_INSERT_SQL = """
+INSERT INTO base_room_fts (rowid, name, description, topic)
+SELECT r.id, r.name, coalesce(r.description, ''), coalesce(t.name, '')
+FROM base_room r LEFT JOIN base_topic t ON t.id = r.topic_id
+"""
+
+
+def _placeholders(values) -> str:
+    return ", ".join(["%s"] * len(values))
+
+
+def index_rooms(room_ids=None):
+    """Refresh the search index for the given rooms, or for every room."""
+    room_ids = list(room_ids) if room_ids is not None else None
+    if room_ids == []:
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                if room_ids is None:
+                    cursor.execute(PG_REINDEX_SQL)
+                else:
+                    cursor.execute(PG_REINDEX_SQL + " WHERE base_room.id = ANY(%s)", [room_ids])
+            elif connection.vendor == "sqlite":
+                if room_ids is None:
+                    cursor.execute("DELETE FROM base_room_fts")
+                    cursor.execute(SQLITE_INSERT_SQL)
+                else:
+                    cursor.execute(f"DELETE FROM base_room_fts WHERE rowid IN ({_placeholders(room_ids)})", room_ids)
+                    cursor.execute(SQLITE_INSERT_SQL + f" WHERE r.id IN ({_placeholders(room_ids)})", room_ids)
+    except DatabaseError as e:
+        logger.warning(f"Room search index update failed: {e}")
+
+
+def unindex_room(room_id):
+    if connection.vendor != "sqlite":
+        return  # the tsvector lives on the deleted row
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("DELETE FROM base_room_fts WHERE rowid = %s", [room_id])
+    except DatabaseError as e:
+        logger.warning(f"Room search index delete failed: {e}")
+
+
+def _fts5_query(q: str) -> str:
+    # Quote every term so user input can't inject FTS5 syntax; prefix-match each.
+    terms = [term.replace('"', '""') for term in q.split()]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def _icontains(q: str):
+    return Room.objects.filter(
+        Q(topic__name__icontains=q) |
+        Q(name__icontains=q) |
+        Q(description__icontains=q)
+    )
+
+
+def _search_postgres(q: str):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+
+    query = SearchQuery(q, search_type="websearch", config=SEARCH_CONFIG)
+    return (
+        Room.objects.annotate(
+            rank=SearchRank(F("search_vector"), query),
+            similarity=TrigramSimilarity("name", q),
+        )
+        .filter(Q(search_vector=query) | Q(name__trigram_similar=q))
+        .order_by("-rank", "-similarity", "-updated")
+    )
+
+
+def _search_sqlite(q: str):
+    match = _fts5_query(q)
+    with connection.cursor() as cursor:
+        # Fail here rather than at render time if FTS5 or the table is missing.
+        cursor.execute("SELECT rowid FROM base_room_fts WHERE base_room_fts MATCH %s LIMIT 1", [match])
+    # The ORM can't join a virtual table, hence extra().
+    return Room.objects.extra(
+        tables=["base_room_fts"],
+        where=["base_room_fts.rowid = base_room.id", "base_room_fts MATCH %s"],
+        params=[match],
+        select={"fts_rank": "bm25(base_room_fts, 10.0, 5.0, 10.0)"},
+        order_by=["fts_rank"],
+    )
+
+
+def search_rooms(q: str):
+    """Rooms matching ``q``, best match first. An empty query returns every room."""
+    q = (q or "").strip()
+    if not q:
+        return Room.objects.all()
+    if connection.vendor == "postgresql":
+        return _search_postgres(q)
+    if connection.vendor == "sqlite":
+        try:
+            return _search_sqlite(q)
+        except DatabaseError as e:
+            logger.warning(f"FTS5 search unavailable, falling back to icontains: {e}")
+    return _icontains(q)
@@ -0,0 +1,183 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import activity, archive, avatars, counters, fragments, history, membership, room_cache, search, unread
+from .models import Message, Room, Topic, User
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Rooms mid-delete; their cascaded messages skip per-message bookkeeping.
+_deleting_rooms = set()
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a user; pk_set holds room ids
+        if action == "pre_clear":
+            room_ids = list(instance.participating_rooms.values_list("id", flat=True))
+        elif action == "post_remove":
+            room_ids = pk_set
+        else:
+            return
+        changes = [(room_id, [instance.pk]) for room_id in room_ids]
+    elif action == "post_remove":
+        changes = [(instance.pk, list(pk_set))]
+    elif action == "post_clear":
+        changes = [(instance.pk, None)]
+    else:
+        return
+
+    try:
+        for room_id, user_ids in changes:
+            async_to_sync(membership.forget)(get_redis(decode_responses=True), room_id, user_ids)
+    except Exception as e:
+        logger.warning(f"Membership cache invalidation failed: {e}")
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def participant_count_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "post_add":
+        # pk_set only holds the rows that were actually inserted
+        if reverse:
+            counters.adjust_many(Room, {room_id: 1 for room_id in pk_set}, "participant_count")
+            room_cache.invalidate(*pk_set)
+            fragments.bump(fragments.FEED, *map(fragments.room_gen, pk_set))
+        else:
+            counters.adjust(Room, instance.pk, "participant_count", len(pk_set))
+            if pk_set:
+                room_cache.invalidate(instance.pk)
+                fragments.bump(fragments.FEED, fragments.room_gen(instance.pk))
+    elif action in ("pre_remove", "pre_clear"):
+        # remove() reports what was asked for, so count the rows that exist
+        rows = sender.objects.filter(**{"user_id" if reverse else "room_id": instance.pk})
+        if action == "pre_remove":
+            rows = rows.filter(**{"room_id__in" if reverse else "user_id__in": pk_set})
+        if reverse:
+            deltas = {room_id: -1 for room_id in rows.values_list("room_id", flat=True)}
+            counters.adjust_many(Room, deltas, "participant_count")
+            room_cache.invalidate(*deltas)
+            fragments.bump(fragments.FEED, *map(fragments.room_gen, deltas))
+        else:
+            counters.adjust(Room, instance.pk, "participant_count", -rows.count())
+            room_cache.invalidate(instance.pk)
+            fragments.bump(fragments.FEED, fragments.room_gen(instance.pk))
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # The participant rows go with the user without an m2m_changed signal.
+    deltas = {room_id: -1 for room_id in instance.participating_rooms.values_list("id", flat=True)}
+    counters.adjust_many(Room, deltas, "participant_count")
+    hosted = instance.hosted_rooms.values_list("id", flat=True)  # their cards lose the host
+    fragments.bump(fragments.FEED, *map(fragments.room_gen, {*deltas, *hosted}))
+
+
+@receiver(pre_save, sender=User)
+def user_saving(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and "avatar" not in update_fields:
+        return  # e.g. the last_login update on every login
+    instance._previous_avatar = (
+        User.objects.filter(pk=instance.pk).values_list("avatar", flat=True).first()
+        if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if hasattr(instance, "_previous_avatar"):
+        if (instance.avatar.name or None) != instance._previous_avatar:
+            avatars.refresh(instance)
+        del instance._previous_avatar
+    if created or (update_fields is not None and not {"username", "avatar"} & update_fields):
+        return
+    # Room cards show the host's username and avatar.
+    hosted = list(instance.hosted_rooms.values_list("id", flat=True))
+    if hosted:
+        fragments.bump(fragments.FEED, *map(fragments.room_gen, hosted))
+
+
+@receiver(pre_save, sender=Room)
+def room_saving(sender, instance, **kwargs):
+    instance._previous_topic_id = (
+        Room.objects.filter(pk=instance.pk).values_list("topic_id", flat=True).first()
+        if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, created, **kwargs):
+    search.index_rooms([instance.pk])
+    if not created:
+        room_cache.invalidate(instance.pk)
+
+    previous = None if created else getattr(instance, "_previous_topic_id", None)
+    if created or previous != instance.topic_id:
+        counters.adjust(Topic, previous, "room_count", -1)
+        counters.adjust(Topic, instance.topic_id, "room_count", 1)
+        fragments.bump(fragments.TOPICS)
+    fragments.bump(fragments.FEED, fragments.room_gen(instance.pk))
+
+
+@receiver(post_save, sender=Topic)
+def topic_saved(sender, instance, created, **kwargs):
+    if not created:
+        search.index_rooms(instance.rooms.values_list("id", flat=True))
+        fragments.bump(fragments.FEED, fragments.topic_gen(instance.pk))
+    fragments.bump(fragments.TOPICS)
+
+
+@receiver(post_delete, sender=Topic)
+def topic_deleted(sender, instance, **kwargs):
+    fragments.bump(fragments.TOPICS, fragments.FEED, fragments.topic_gen(instance.pk))
+
+
+@receiver(pre_delete, sender=Room)
+def room_deleting(sender, instance, **kwargs):
+    _deleting_rooms.add(instance.pk)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    _deleting_rooms.discard(instance.pk)
+    search.unindex_room(instance.pk)
+    counters.adjust(Topic, instance.topic_id, "room_count", -1)
+    room_cache.invalidate(instance.pk)
+    fragments.bump(fragments.TOPICS, fragments.FEED, fragments.room_gen(instance.pk))
+    try:
+        r = get_redis(decode_responses=True)
+        async_to_sync(history.drop)(r, instance.pk)
+        async_to_sync(membership.forget)(r, instance.pk)
+        async_to_sync(activity.drop)(r)
+        async_to_sync(unread.forget_room)(r, instance.pk)
+    except Exception as e:
+        logger.warning(f"Cache invalidation for deleted room failed: {e}")
+    try:
+        async_to_sync(get_channel_layer().group_send)(f"chat_{instance.pk}", {"type": "room_deleted"})
+    except Exception as e:
+        logger.warning(f"Closing sockets of deleted room {instance.pk} failed: {e}")
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if created:
+        counters.defer(Room, instance.room_id, ("message_count", "message_seq"), 1)
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    if instance.room_id in _deleting_rooms or archive.is_archiving(instance.room_id):
+        return
+    counters.defer(Room, instance.room_id, "message_count", -1)
+    try:
+        r = get_redis(decode_responses=True)
+        # Covers admin deletes and user cascades as well as DeleteChat.
+        async_to_sync(history.remove)(r, instance.room_id, instance.pk)
+        async_to_sync(activity.drop)(r)
+    except Exception as e:
+        logger.warning(f"Cache invalidation for deleted message failed: {e}")
@@ -0,0 +1,27 @@
+"""
+In-process request coalescing.
+
+``SingleFlight.do(key, fn)`` runs ``fn`` once per key at a time. Callers that
+arrive while a call for the same key is in flight await that call's result
+instead of starting their own. The shared call runs as its own task, so a
+caller that disconnects and is cancelled does not cancel it for everyone else.
+"""
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.get_running_loop().create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
@@ -0,0 +1,13 @@
+from django import template
+
+from base import avatars
+
+register = template.Library()
+
+
+@register.filter
+def avatar(user, size="small"):
+    """``{{ user|avatar:'medium' }}``: the URL of the user's avatar at that size."""
+    if not user:
+        return ""
+    return avatars.url_for(user, size)
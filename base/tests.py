@@ -1,3 +1,964 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.paginator import Paginator
+from django.db import DataError, OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+
+from . import (
+    activity, archive, counters, fragments, history, membership, metrics, outbox, presence, ratelimit,
+    redis_pool, room_cache, search, typing_indicators, unread, warmup, wire, write_behind, ws_auth,
+)
+from .models import Message, ReadState, Room, Topic, User
+from .routing import websocket_urlpatterns
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def fake_redis(test):
+    """Point every Redis pool at a private ``fakeredis`` server for the test."""
+    server = fakeredis.FakeServer()
+    patcher = mock.patch.object(
+        redis_pool, "_make_client",
+        lambda decode_responses: fakeredis.FakeAsyncRedis(server=server, decode_responses=decode_responses),
+    )
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def manual_counter_flush(test):
+    """Keep deferred counter deltas queued until the test calls ``counters.flush``."""
+    patcher = mock.patch.object(counters, "_ensure_started")
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def message_row(message_id: int, room_id: int, user_id: int, body: str = "hello") -> dict:
+    return {
+        "id": message_id,
+        "user_id": user_id,
+        "room_id": room_id,
+        "body": body,
+        "created": "2026-01-01T00:00:00+00:00",
+    }
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class WriteBehindPersistTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.user = User.objects.create(username="writer", email="writer@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+
+    def counts(self) -> tuple:
+        self.room.refresh_from_db()
+        return self.room.message_count, self.room.message_seq, self.room.participant_count
+
+    def test_replayed_rows_are_counted_once(self):
+        rows = [message_row(1000 + i, self.room.id, self.user.id) for i in range(3)]
+        self.assertEqual(write_behind.persist(rows), 3)
+        # A journal replay of rows another worker already stored.
+        self.assertEqual(write_behind.persist(rows), 0)
+        self.assertEqual(self.counts(), (3, 3, 1))
+        self.assertEqual(self.room.messages.count(), 3)
+
+    def test_partial_replay_counts_only_new_rows(self):
+        write_behind.persist([message_row(1000, self.room.id, self.user.id)])
+        write_behind.persist([message_row(1000, self.room.id, self.user.id), message_row(1001, self.room.id, self.user.id)])
+        self.assertEqual(self.counts(), (2, 2, 1))
+
+    def test_new_participants_invalidate_room_caches(self):
+        with mock.patch.object(write_behind.room_cache, "invalidate") as invalidate, \
+                mock.patch.object(write_behind.fragments, "bump") as bump:
+            write_behind.persist([message_row(1000, self.room.id, self.user.id)])
+            write_behind.persist([message_row(1001, self.room.id, self.user.id)])  # already a participant
+        invalidate.assert_called_once_with(self.room.id)
+        bump.assert_called_once_with(fragments.FEED, fragments.room_gen(self.room.id))
+
+    def test_rows_for_deleted_rooms_are_skipped(self):
+        self.assertEqual(write_behind.persist([message_row(1000, self.room.id + 1, self.user.id)]), 0)
+
+
+class WriteBehindFlushTests(SimpleTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.stored = []
+
+    async def fake_persist(self, rows):
+        if any(row["body"] == "bad" for row in rows):
+            raise DataError("invalid byte sequence")
+        self.stored.extend(row["id"] for row in rows)
+        return len(rows)
+
+    def make_buffer(self, rows: list[dict], durability: str = "memory") -> write_behind.WriteBehindBuffer:
+        buffer = write_behind.WriteBehindBuffer(batch_size=10, max_delay=1, durability=durability)
+        buffer._pending = [(row, json.dumps(row), write_behind.JOURNAL_KEY) for row in rows]
+        return buffer
+
+    def test_bad_row_is_dead_lettered_and_the_rest_persisted(self):
+        rows = [message_row(i, 1, 1, "bad" if i == 3 else "ok") for i in range(1, 8)]
+        buffer = self.make_buffer(rows, durability="redis")
+        with mock.patch.object(write_behind, "apersist", self.fake_persist):
+            async_to_sync(buffer.flush)()
+        self.assertEqual(sorted(self.stored), [1, 2, 4, 5, 6, 7])
+        self.assertEqual(buffer.stats.dead_letters, 1)
+        self.assertEqual(buffer._pending, [])
+
+        async def dead_letters():
+            return await redis_pool.get_redis().lrange(write_behind.DEAD_LETTER_KEY, 0, -1)
+
+        self.assertEqual([json.loads(p)["id"] for p in async_to_sync(dead_letters)()], [3])
+
+    def test_unavailable_database_keeps_the_batch(self):
+        async def down(rows):
+            raise OperationalError("connection refused")
+
+        buffer = self.make_buffer([message_row(i, 1, 1) for i in range(1, 4)])
+        with mock.patch.object(write_behind, "apersist", down):
+            async_to_sync(buffer.flush)()
+        self.assertEqual([row["id"] for row, _, _ in buffer._pending], [1, 2, 3])
+        self.assertEqual(buffer.stats.failures, 1)
+        self.assertEqual(buffer.stats.dead_letters, 0)
+
+    def test_ids_come_from_reserved_blocks_in_order(self):
+        blocks = iter([(101, 103), (150, 152)])
+
+        async def reserve(count):
+            return next(blocks)
+
+        buffer = write_behind.WriteBehindBuffer(batch_size=10, max_delay=1, durability="memory", id_block=3)
+
+        async def take(n):
+            return [await buffer._next_id() for _ in range(n)]
+
+        with mock.patch.object(write_behind, "_reserve_ids", reserve):
+            self.assertEqual(async_to_sync(take)(5), [101, 102, 103, 150, 151])
+
+    def test_stale_block_is_ignored(self):
+        async def run():
+            r = redis_pool.get_redis(decode_responses=False)
+            add = r.register_script(write_behind.ADD_BLOCK_SCRIPT)
+            keys = [write_behind.LAST_ID_KEY, write_behind.ID_CEILING_KEY]
+            self.assertEqual(await add(keys=keys, args=[200, 299]), 1)
+            # A block reserved earlier by a slower worker must not move the counter back.
+            self.assertEqual(await add(keys=keys, args=[100, 199]), 0)
+            return await r.register_script(write_behind.TAKE_ID_SCRIPT)(keys=keys)
+
+        self.assertEqual(async_to_sync(run)(), 200)
+
+    def test_journal_is_claimed_by_one_worker(self):
+        rows = [message_row(i, 1, 1) for i in range(1, 4)]
+        first = write_behind.WriteBehindBuffer(batch_size=10, max_delay=1, durability="redis")
+        second = write_behind.WriteBehindBuffer(batch_size=10, max_delay=1, durability="redis")
+        second.processing_key += ":second"
+
+        async def run():
+            r = redis_pool.get_redis(decode_responses=False)
+            await r.rpush(write_behind.JOURNAL_KEY, *[json.dumps(row) for row in rows])
+            await first._recover()
+            await second._recover()
+            claimed = await r.llen(first.processing_key)
+            with mock.patch.object(write_behind, "apersist", self.fake_persist):
+                await first.flush()
+            return claimed, await r.llen(first.processing_key), await r.llen(write_behind.JOURNAL_KEY)
+
+        self.assertEqual(async_to_sync(run)(), (3, 0, 0))
+        self.assertEqual(second._pending, [])
+        self.assertEqual(self.stored, [1, 2, 3])
+
+
+@override_settings(CHAT_HISTORY_WINDOW=3)
+class HistoryWindowTests(SimpleTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.r = redis_pool.get_redis()
+
+    async def append(self, *ids):
+        for message_id in ids:
+            await history.append(self.r, 1, message_id, f"m{message_id}")
+
+    def test_appends_without_a_floor_are_only_a_partial_tail(self):
+        async def run():
+            await self.append(5, 6)
+            return await history.read(self.r, 1, limit=2)
+
+        self.assertIsNone(async_to_sync(run)())
+
+    def test_complete_fill_answers_short_pages(self):
+        async def run():
+            await history.fill(self.r, 1, [(1, "m1"), (2, "m2")], complete=True)
+            return await history.read(self.r, 1, limit=50), await history.read_after(self.r, 1, 1)
+
+        self.assertEqual(async_to_sync(run)(), (["m1", "m2"], ["m2"]))
+
+    def test_trimming_raises_the_floor(self):
+        async def run():
+            await history.fill(self.r, 1, [(1, "m1"), (2, "m2")], complete=True)
+            await self.append(3, 4, 5)
+            floor = await self.r.get(history.floor_key(1))
+            return (
+                int(floor),
+                await history.read(self.r, 1, limit=2),
+                await history.read(self.r, 1, limit=5),  # reaches below the window
+                await history.read_after(self.r, 1, 3),
+                await history.read_after(self.r, 1, 1),  # message 2 was trimmed
+            )
+
+        self.assertEqual(async_to_sync(run)(), (3, ["m4", "m5"], None, ["m4", "m5"], None))
+
+    def test_fill_keeps_entries_appended_meanwhile(self):
+        async def run():
+            await self.append(4)
+            await history.fill(self.r, 1, [(2, "m2"), (3, "m3"), (4, "stale")], complete=True)
+            return await history.read(self.r, 1, limit=50)
+
+        self.assertEqual(async_to_sync(run)(), ["m2", "m3", "m4"])
+
+    def test_page_before_the_floor_misses(self):
+        async def run():
+            await history.fill(self.r, 1, [(10, "m10"), (11, "m11"), (12, "m12")], complete=False)
+            return await history.read(self.r, 1, limit=2, before_id=12), await history.read(self.r, 1, limit=2, before_id=11)
+
+        self.assertEqual(async_to_sync(run)(), (["m10", "m11"], None))
+
+    def test_removed_message_leaves_the_window(self):
+        async def run():
+            await history.fill(self.r, 1, [(1, "m1"), (2, "m2")], complete=True)
+            await history.remove(self.r, 1, 1)
+            return await history.read(self.r, 1, limit=50)
+
+        self.assertEqual(async_to_sync(run)(), ["m2"])
+
+
+@override_settings(CHAT_HISTORY_WINDOW=3, CHAT_HISTORY_LOCK=True, CHAT_HISTORY_LOCK_TTL=1.0)
+class HistoryMissTests(SimpleTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.r = redis_pool.get_redis()
+        self.queries = 0
+
+    async def fetch(self, room_id, limit, before_id=None):
+        self.queries += 1
+        await asyncio.sleep(0.01)
+        return []
+
+    def test_concurrent_misses_share_one_query(self):
+        async def run():
+            return await asyncio.gather(*[history.load(self.r, 1, limit=2) for _ in range(5)])
+
+        with mock.patch.object(history, "afetch_messages_db", self.fetch):
+            self.assertEqual(async_to_sync(run)(), [[]] * 5)
+        self.assertEqual(self.queries, 1)
+
+    def test_waits_for_a_fill_by_another_process(self):
+        async def run():
+            await self.r.set(history.lock_key(1), "other-process")
+
+            async def other_process_fills():
+                await asyncio.sleep(0.1)
+                await history.fill(self.r, 1, [(1, "m1")], complete=True)
+
+            filler = asyncio.ensure_future(other_process_fills())
+            entries = await history.load(self.r, 1, limit=2)
+            await filler
+            return entries, await self.r.get(history.lock_key(1))
+
+        with mock.patch.object(history, "afetch_messages_db", self.fetch):
+            # The waiter must not release a lock it does not hold.
+            self.assertEqual(async_to_sync(run)(), (["m1"], b"other-process"))
+        self.assertEqual(self.queries, 0)
+
+    def test_fill_lock_is_released_after_a_failed_query(self):
+        async def down(room_id, limit, before_id=None):
+            raise OperationalError("connection refused")
+
+        async def run():
+            with self.assertRaises(OperationalError):
+                await history.load(self.r, 1, limit=2)
+            return await self.r.exists(history.lock_key(1))
+
+        with mock.patch.object(history, "afetch_messages_db", down):
+            self.assertEqual(async_to_sync(run)(), 0)
+
+
+class TypingSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch.object(typing_indicators, "get_channel_layer", return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def aggregator(self) -> typing_indicators.TypingAggregator:
+        aggregator = typing_indicators.TypingAggregator(interval=0.5, ttl=5)
+        aggregator._ensure_started = lambda: None
+        return aggregator
+
+    def broadcasts(self) -> list:
+        return [json.loads(c.args[1]["frame"])["users"] for c in self.layer.group_send.await_args_list]
+
+    def test_keypresses_are_coalesced_into_one_snapshot(self):
+        aggregator = self.aggregator()
+        for _ in range(20):
+            aggregator.note(1, "chat_1", 7, "ann", True)
+        async_to_sync(aggregator.tick)()
+        async_to_sync(aggregator.tick)()  # nothing changed
+        self.assertEqual(self.broadcasts(), [[{"user_id": 7, "username": "ann"}]])
+        self.assertEqual(aggregator.stats(), {"events": 20, "broadcasts": 1})
+
+    def test_stopping_broadcasts_an_empty_snapshot(self):
+        aggregator = self.aggregator()
+        aggregator.note(1, "chat_1", 7, "ann", True)
+        async_to_sync(aggregator.tick)()
+        aggregator.note(1, "chat_1", 7, "ann", False)
+        async_to_sync(aggregator.tick)()
+        self.assertEqual(self.broadcasts(), [[{"user_id": 7, "username": "ann"}], []])
+
+    def test_workers_share_one_room_wide_snapshot(self):
+        first, second = self.aggregator(), self.aggregator()
+        first.note(1, "chat_1", 7, "ann", True)
+        async_to_sync(first.tick)()
+        second.note(1, "chat_1", 8, "bob", True)
+        async_to_sync(second.tick)()
+        async_to_sync(first.tick)()  # already sent by the second worker
+        self.assertEqual(self.broadcasts(), [
+            [{"user_id": 7, "username": "ann"}],
+            [{"user_id": 7, "username": "ann"}, {"user_id": 8, "username": "bob"}],
+        ])
+
+
+class PresenceDiffTests(SimpleTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch.object(presence, "get_channel_layer", return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tracker(self) -> presence.PresenceTracker:
+        tracker = presence.PresenceTracker(tick=1, ttl=30)
+        tracker._ensure_started = lambda: None
+        return tracker
+
+    def broadcasts(self) -> list:
+        frames = [json.loads(c.args[1]["frame"]) for c in self.layer.group_send.await_args_list]
+        return [([u["username"] for u in f["joined"]], [u["username"] for u in f["left"]]) for f in frames]
+
+    def test_user_stays_online_until_the_last_tab_leaves(self):
+        tracker = self.tracker()
+
+        async def run():
+            roster = await tracker.join(1, "chat_1", "tab-1", 7, "ann")
+            await tracker.join(1, "chat_1", "tab-2", 7, "ann")
+            await tracker.tick()
+            still_here = await tracker.leave(1, "tab-1")
+            await tracker.tick()
+            gone = not await tracker.leave(1, "tab-2")
+            await tracker.tick()
+            return roster, still_here, gone
+
+        self.assertEqual(async_to_sync(run)(), ([{"user_id": 7, "username": "ann"}], True, True))
+        self.assertEqual(self.broadcasts(), [(["ann"], []), ([], ["ann"])])
+
+    def test_a_change_is_broadcast_by_one_worker_only(self):
+        first, second = self.tracker(), self.tracker()
+
+        async def run():
+            await first.join(1, "chat_1", "tab-1", 7, "ann")
+            await second.join(1, "chat_1", "tab-2", 8, "bob")
+            await first.tick()
+            await second.tick()
+
+        async_to_sync(run)()
+        self.assertEqual(len(self.broadcasts()), 1)
+        self.assertEqual(sorted(self.broadcasts()[0][0]), ["ann", "bob"])
+
+    def test_sockets_of_a_dead_worker_expire(self):
+        tracker = self.tracker()
+
+        async def run():
+            await tracker.join(1, "chat_1", "tab-1", 7, "ann")
+            await tracker.tick()
+            # Another worker registered bob and died without heartbeating.
+            r = redis_pool.get_redis(decode_responses=True)
+            await r.zadd(presence.conns_key(1), {"dead-tab": 1})
+            await r.hset(presence.users_key(1), "dead-tab", "8:bob")
+            await r.sadd(presence.last_key(1), "8:bob")
+            await tracker.tick()
+            return await presence.roster(r, 1)
+
+        self.assertEqual(async_to_sync(run)(), [{"user_id": 7, "username": "ann"}])
+        self.assertEqual(self.broadcasts(), [(["ann"], []), ([], ["bob"])])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SqliteSearchTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        if connection.vendor != "sqlite":
+            self.skipTest("FTS5 fallback only")
+        topic = Topic.objects.create(name="General")
+        Room.objects.bulk_create([Room(name=f"python room {i}", topic=topic) for i in range(1205)])
+        Room.objects.create(name="Other", topic=topic, description="python on the side")
+        search.index_rooms()
+
+    def test_every_match_is_counted_and_paged(self):
+        paginator = Paginator(search.search_rooms("pyth"), 20)
+        self.assertEqual(paginator.count, 1206)
+        # Description matches rank below name matches, so the extra room is last.
+        last_page = paginator.page(paginator.num_pages)
+        self.assertEqual(len(last_page), 6)
+        self.assertEqual(last_page[-1].name, "Other")
+
+    def test_usable_as_a_subquery(self):
+        matches = Room.objects.filter(pk__in=search.search_rooms("side").values("pk"))
+        self.assertEqual([room.name for room in matches], ["Other"])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHAT_ACTIVITY_FEED_SIZE=5)
+class ActivityFeedTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.r = redis_pool.get_redis()
+        user = User.objects.create(username="writer", email="writer@example.com")
+        room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+        self.ids = [Message.objects.create(room=room, user=user, body=f"m{i}").id for i in range(7)]
+
+    def read_all(self, limit: int) -> list[list[int]]:
+        pages, cursor = [], None
+        while True:
+            entries, cursor = activity.page(self.r, cursor=cursor, limit=limit)
+            pages.append([e["id"] for e in entries])
+            if cursor is None:
+                return pages
+
+    def test_pages_continue_past_the_cached_feed(self):
+        newest_first = self.ids[::-1]
+        self.assertEqual(self.read_all(3), [newest_first[:3], newest_first[3:6], newest_first[6:]])
+
+    def test_no_cursor_when_the_last_page_is_full(self):
+        Message.objects.filter(id=self.ids[0]).delete()
+        newest_first = self.ids[:0:-1]
+        self.assertEqual(self.read_all(3), [newest_first[:3], newest_first[3:]])
+
+    def test_complete_cached_feed_answers_every_page(self):
+        Message.objects.filter(id__in=self.ids[:3]).delete()
+        activity.page(self.r, limit=2)  # fills the feed with all four messages
+        with self.assertNumQueries(0):
+            self.assertEqual(self.read_all(2)[1:], [self.ids[4:2:-1]])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class MessageHistoryApiTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        manual_counter_flush(self)
+        self.user = User.objects.create(username="reader", email="reader@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+        self.ids = [Message.objects.create(room=self.room, user=self.user, body=f"m{i}").id for i in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, room_id=None, **params):
+        return self.client.get(f"/api/rooms/{room_id or self.room.id}/messages/", params)
+
+    def page(self, **params) -> dict:
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return {**body, "messages": [m["message_id"] for m in body["messages"]]}
+
+    def test_pages_backwards_by_key(self):
+        latest = self.page(limit=2)
+        self.assertEqual((latest["messages"], latest["has_more"]), (self.ids[3:], True))
+        older = self.page(limit=2, before_id=latest["next_before_id"])
+        self.assertEqual((older["messages"], older["has_more"]), (self.ids[1:3], True))
+        oldest = self.page(limit=2, before_id=older["next_before_id"])
+        self.assertEqual(oldest["messages"], self.ids[:1])
+        self.assertEqual((oldest["has_more"], oldest["next_before_id"]), (False, None))
+
+    def test_no_more_when_exactly_limit_messages_remain(self):
+        older = self.page(limit=2, before_id=self.ids[2])
+        self.assertEqual((older["messages"], older["has_more"]), (self.ids[:2], False))
+        newer = self.page(limit=2, after_id=self.ids[2])
+        self.assertEqual((newer["messages"], newer["has_more"]), (self.ids[3:], False))
+        self.assertEqual(newer["next_after_id"], self.ids[4])
+
+    def test_syncs_forwards_from_after_id(self):
+        newer = self.page(limit=3, after_id=self.ids[0])
+        self.assertEqual((newer["messages"], newer["has_more"]), (self.ids[1:4], True))
+        caught_up = self.page(after_id=self.ids[4])
+        self.assertEqual((caught_up["messages"], caught_up["next_after_id"]), ([], self.ids[4]))
+
+    def test_unchanged_page_is_not_modified(self):
+        etag = self.get()["ETag"]
+        self.assertEqual(self.client.get(f"/api/rooms/{self.room.id}/messages/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        message = Message.objects.create(room=self.room, user=self.user, body="new")
+        async_to_sync(history.append)(
+            redis_pool.get_redis(), self.room.id, message.id, json.dumps(history.serialize_message(message))
+        )
+        response = self.client.get(f"/api/rooms/{self.room.id}/messages/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_missing_room_is_not_found_on_every_path(self):
+        missing = self.room.id + 100
+        for params in ({}, {"after_id": 1}, {"before_id": 10}):
+            with self.subTest(**params):
+                self.assertEqual(self.get(room_id=missing, **params).status_code, 404)
+
+    def test_rejects_bad_parameters(self):
+        self.assertEqual(self.get(before_id="x").status_code, 400)
+        self.assertEqual(self.get(before_id=3, after_id=1).status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHAT_COUNTER_FLUSH_INTERVAL=1.0)
+class DeferredCounterTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        manual_counter_flush(self)
+        self.user = User.objects.create(username="poster", email="poster@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+
+    def test_message_deltas_are_summed_into_one_update(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            messages = [Message.objects.create(room=self.room, user=self.user, body="hi") for _ in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            messages[0].delete()
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.message_seq), (0, 0))
+
+        with self.assertNumQueries(2):  # one UPDATE per field set, not one per message
+            counters.flush()
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.message_seq), (2, 3))
+
+    def test_rolled_back_deltas_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            Message.objects.create(room=self.room, user=self.user, body="hi")
+        self.assertEqual(len(callbacks), 1)  # never run: the transaction did not commit
+        counters.flush()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 0)
+
+
+class RedisPoolTests(SimpleTestCase):
+    def test_async_to_sync_pools_are_closed_with_their_loop(self):
+        clients = []
+
+        def make_client(decode_responses):
+            client = mock.AsyncMock()
+            clients.append(client)
+            return client
+
+        async def call():
+            await redis_pool.get_redis().get("key")
+
+        with mock.patch.object(redis_pool, "_make_client", make_client):
+            for _ in range(3):
+                async_to_sync(call)()
+        self.assertEqual(len(clients), 3)  # one pool per short-lived loop...
+        for client in clients:  # ...each closed when its loop shut down
+            client.aclose.assert_awaited_once()
+            client.connection_pool.disconnect.assert_awaited_once()
+
+
+class MetricsTests(SimpleTestCase):
+    def test_recording_does_not_start_the_flusher(self):
+        metrics.inc("chat_ws_events_total", type="chat")
+        metrics.observe("chat_ws_db_seconds", 0.01)
+        self.assertIsNone(metrics._flusher)
+
+
+class WireTests(SimpleTestCase):
+    def test_broadcasts_are_packed_once_per_frame(self):
+        event = wire.group_event({"type": "chat_message", "message": "hi"})
+        self.assertNotIn("packed", event)
+        copies = [json.loads(json.dumps(event)) for _ in range(3)]  # one per recipient
+        with mock.patch.object(wire.msgpack, "packb", wraps=wire.msgpack.packb) as packb:
+            frames = {wire.packed_frame(copy) for copy in copies}
+        self.assertEqual(packb.call_count, 1)
+        self.assertEqual([wire.unpack(frame) for frame in frames], [{"type": "chat_message", "message": "hi"}])
+
+
+class OutboxTests(SimpleTestCase):
+    def test_blocked_put_raises_once_the_writer_has_died(self):
+        async def broken_send(text_data=None, bytes_data=None):
+            raise ConnectionResetError("peer went away")
+
+        async def scenario():
+            box = outbox.Outbox(broken_send, size=1, policy="block")
+            await box.put("chat_message", text_data="first")
+            box.start()
+            await box.put("chat_message", text_data="second")  # the writer dies sending "first"
+            with self.assertRaises(outbox.SlowConsumer):
+                await asyncio.wait_for(box.put("chat_message", text_data="third"), timeout=1)
+
+        with self.assertLogs("base.outbox", "INFO"):
+            async_to_sync(scenario)()
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.r = redis_pool.get_redis(decode_responses=True)
+        self.now = 1_000_000.0
+        patcher = mock.patch.object(ratelimit.time, "time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check(self, limiter, user_id=1, room_id=1) -> ratelimit.Verdict:
+        return async_to_sync(limiter.check)(self.r, "chat_message", user_id, room_id)
+
+    def test_burst_then_refusal_until_refill(self):
+        limiter = ratelimit.RateLimiter({"chat_message": {"user": (1, 3)}})
+        self.assertEqual([self.check(limiter).allowed for _ in range(3)], [True] * 3)
+        self.assertEqual(self.check(limiter), ratelimit.Verdict(False, "user", 1.0))
+        self.now += 1
+        self.assertTrue(self.check(limiter).allowed)
+        self.assertFalse(self.check(limiter).allowed)
+
+    def test_workers_draw_from_one_bucket(self):
+        first = ratelimit.RateLimiter({"chat_message": {"user": (1, 3)}})
+        second = ratelimit.RateLimiter({"chat_message": {"user": (1, 3)}})
+        self.assertTrue(self.check(first).allowed)
+        self.assertTrue(self.check(first).allowed)
+        self.assertTrue(self.check(second).allowed)
+        refused = self.check(second)
+        self.assertEqual((refused.allowed, refused.scope), (False, "user"))
+        # Blocked locally until the retry time, without asking Redis again.
+        self.check(second)
+        self.assertEqual(second.stats(), {"local_refusals": 1, "redis_checks": 2})
+
+    def test_refused_event_is_not_charged_to_other_buckets(self):
+        limiter = ratelimit.RateLimiter({"chat_message": {"user": (1, 5), "room": (1, 1)}})
+        self.assertTrue(self.check(limiter, user_id=1).allowed)
+        self.assertEqual(self.check(limiter, user_id=2).scope, "room")
+
+        async def tokens():
+            return await self.r.hget(ratelimit.bucket_key("chat_message", "user", 2), "tokens")
+
+        self.assertIsNone(async_to_sync(tokens)())
+
+    def test_unreachable_redis_allows_events(self):
+        limiter = ratelimit.RateLimiter({"chat_message": {"user": (1, 3)}})
+        unreachable = mock.Mock(register_script=mock.Mock(side_effect=ConnectionError("refused")))
+        self.assertTrue(async_to_sync(limiter.check)(unreachable, "chat_message", 1, 1).allowed)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHE,
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class SubprotocolAuthTests(TransactionTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.user = User.objects.create(username="socket", email="socket@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+        self.app = ws_auth.TicketAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def handshake(self, subprotocols: list[str]):
+        async def connect():
+            communicator = WebsocketCommunicator(self.app, f"room/{self.room.id}/", subprotocols=subprotocols)
+            connected, subprotocol = await communicator.connect()
+            await communicator.disconnect()
+            return connected, subprotocol
+
+        return async_to_sync(connect)()
+
+    def test_ticket_protocol_is_accepted_with_the_marker_echoed(self):
+        ticket = ws_auth.issue_ticket(self.user)
+        self.assertEqual(self.handshake([ws_auth.SUBPROTOCOL_AUTH, f"ticket.{ticket}"]), (True, "chat.auth"))
+
+    def test_ticket_protocol_without_the_marker_is_ignored(self):
+        ticket = ws_auth.issue_ticket(self.user)
+        with override_settings(CHAT_WS_SESSION_AUTH=False):
+            connected, _ = self.handshake([f"ticket.{ticket}"])
+        self.assertFalse(connected)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHE,
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class ConsumerEventTests(TransactionTestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.user = User.objects.create(username="socket", email="socket@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+        self.app = ws_auth.TicketAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def send_event(self, event: dict) -> list[dict]:
+        """Send one event after the connect frames and return what the socket sent back."""
+        async def run():
+            ticket = ws_auth.issue_ticket(self.user)
+            communicator = WebsocketCommunicator(self.app, f"room/{self.room.id}/?ticket={ticket}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()  # message_history
+            await communicator.receive_json_from()  # presence_roster
+            await communicator.send_json_to(event)
+            outputs = []
+            while not await communicator.receive_nothing(timeout=0.2):
+                outputs.append(await communicator.receive_output())
+            await communicator.disconnect()
+            return outputs
+
+        return async_to_sync(run)()
+
+    def test_mark_read_in_a_deleted_room_closes_the_socket(self):
+        with mock.patch.object(unread, "mark_read", side_effect=Room.DoesNotExist):
+            outputs = self.send_event({"type": "mark_read", "message_id": 1})
+        self.assertEqual(outputs, [{"type": "websocket.close", "code": 4404}])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class RoomCacheTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        room_cache._local.clear()
+        self.addCleanup(room_cache._local.clear)
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+
+    def get(self) -> Room | None:
+        return room_cache.get(redis_pool.get_redis(decode_responses=True), self.room.id)
+
+    def test_hits_skip_the_database(self):
+        self.get()
+        room_cache._local.clear()  # still in Redis
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get().name, "Room")
+            self.assertEqual(self.get().name, "Room")
+
+    def test_cached_room_has_its_own_field_values(self):
+        self.room.refresh_from_db()
+        cached = self.get()
+        self.assertEqual(
+            [getattr(cached, name) for name in room_cache.CACHED_FIELDS],
+            [getattr(self.room, name) for name in room_cache.CACHED_FIELDS],
+        )
+
+    def test_saving_the_room_invalidates_both_tiers(self):
+        self.get()
+        self.room.name = "Renamed"
+        self.room.save()
+        self.assertEqual(self.get().name, "Renamed")
+
+    def test_participant_changes_refresh_the_count(self):
+        user = User.objects.create(username="joiner", email="joiner@example.com")
+        self.assertEqual(self.get().participant_count, 0)
+        self.room.participants.add(user)
+        self.assertEqual(self.get().participant_count, 1)
+        user.participating_rooms.remove(self.room)
+        self.assertEqual(self.get().participant_count, 0)
+
+    def test_deleted_room_is_gone(self):
+        self.get()
+        self.room.delete()
+        self.assertIsNone(self.get())
+
+    def test_listener_drops_copies_invalidated_by_other_processes(self):
+        fields = {"id": 99, "name": "Other"}
+
+        async def run():
+            listener = asyncio.ensure_future(room_cache._listen())
+            await asyncio.sleep(0.05)  # subscribed
+            room_cache._local_put(99, fields)
+            await redis_pool.get_redis().publish(room_cache.INVALIDATE_CHANNEL, 99)
+            await asyncio.sleep(0.05)
+            listener.cancel()
+            return room_cache._local_get(99)
+
+        self.assertIsNone(async_to_sync(run)())
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHAT_HISTORY_WINDOW=3)
+class WarmupTests(TransactionTestCase):
+    def setUp(self):
+        fake_redis(self)
+        manual_counter_flush(self)
+        self.user = User.objects.create(username="warm", email="warm@example.com")
+        topic = Topic.objects.create(name="Topic")
+        self.busy = Room.objects.create(name="Busy", topic=topic)
+        self.quiet = Room.objects.create(name="Quiet", topic=topic)
+        self.busy.participants.add(self.user)
+        for i in range(5):
+            Message.objects.create(room=self.busy, user=self.user, body=f"m{i}")
+        Room.objects.filter(id=self.busy.id).update(message_seq=5)
+
+    def test_busiest_rooms_rank_first(self):
+        self.assertEqual(warmup.rank_rooms(limit=2, hours=1), [self.busy.id, self.quiet.id])
+
+    def test_primes_every_room_key_in_one_pass(self):
+        async def run():
+            r = redis_pool.get_redis(decode_responses=True)
+            await r.set(unread.seq_key(self.quiet.id), 7)  # bumped live since the database read
+            totals = await warmup.warm(r, [self.busy.id, self.quiet.id])
+            keys = {}
+            for room in (self.busy, self.quiet):
+                keys[room.name] = (
+                    await r.exists(room_cache.meta_key(room.id)),
+                    await r.smembers(membership.participants_key(room.id)),
+                    await r.get(history.floor_key(room.id)),
+                    await r.get(unread.seq_key(room.id)),
+                    await r.ttl(unread.seq_key(room.id)) > 0,
+                )
+            return totals, keys
+
+        totals, keys = async_to_sync(run)()
+        self.assertEqual((totals["rooms"], totals["messages"], totals["failed_batches"]), (2, 3, 0))
+        newest = list(self.busy.messages.order_by("id").values_list("id", flat=True))[-3]
+        self.assertEqual(keys["Busy"], (1, {str(self.user.id)}, str(newest), "5", True))
+        self.assertEqual(keys["Quiet"], (1, set(), "0", "7", False))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ArchiveTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        manual_counter_flush(self)
+        self.user = User.objects.create(username="old", email="old@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+
+    def test_archived_messages_are_still_counted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            messages = [Message.objects.create(room=self.room, user=self.user, body=f"m{i}") for i in range(5)]
+        counters.flush()
+        with self.captureOnCommitCallbacks(execute=True):
+            moved = archive.archive_room(self.room.id, messages[2].id, segment_size=10)
+        counters.flush()
+        self.assertEqual(moved, 3)
+        self.assertFalse(archive.is_archiving(self.room.id))
+        self.assertEqual(self.room.messages.count(), 2)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 5)
+        self.assertEqual([m.body for m in archive.fetch_before(self.room.id, None, 10)], ["m0", "m1", "m2"])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ReadStateTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        manual_counter_flush(self)
+        self.user = User.objects.create(username="reader", email="reader@example.com")
+        self.room = Room.objects.create(name="Room", topic=Topic.objects.create(name="Topic"))
+        self.messages = [Message.objects.create(room=self.room, user=self.user, body=f"m{i}") for i in range(3)]
+        Room.objects.filter(pk=self.room.pk).update(message_count=3, message_seq=3)
+
+    def run_async(self, fn, *args):
+        async def call():
+            return await fn(redis_pool.get_redis(), *args)
+
+        return async_to_sync(call)()
+
+    def test_mark_read_is_clamped_to_the_newest_message(self):
+        state = self.run_async(unread.mark_read, self.user.id, self.room.id, 2 ** 70)
+        self.assertEqual(state, {"room_id": self.room.id, "last_read_id": self.messages[-1].id, "unread": 0})
+
+    def test_mark_read_counts_newer_messages_in_the_window(self):
+        state = self.run_async(unread.mark_read, self.user.id, self.room.id, self.messages[0].id)
+        self.assertEqual(state["unread"], 2)
+
+    def test_mark_read_on_a_warm_room_skips_the_database(self):
+        self.run_async(unread.mark_read, self.user.id, self.room.id, self.messages[0].id)
+        with self.assertNumQueries(0):
+            state = self.run_async(unread.mark_read, self.user.id, self.room.id, self.messages[1].id)
+        self.assertEqual(state["unread"], 1)
+
+    def test_room_sequence_copy_expires(self):
+        self.run_async(unread.room_seqs, [self.room.id])
+
+        async def ttl(r):
+            return await r.ttl(unread.seq_key(self.room.id))
+
+        self.assertGreater(self.run_async(ttl), 0)
+
+    def test_persist_never_moves_a_pointer_back(self):
+        newest = self.messages[-1].id
+        async_to_sync(unread._persist)({(self.user.id, self.room.id): (newest, 3)})
+        async_to_sync(unread._persist)({(self.user.id, self.room.id): (newest - 1, 2)})
+        state = ReadState.objects.get(user=self.user, room=self.room)
+        self.assertEqual((state.last_read_id, state.read_seq), (newest, 3))
+
+    def test_persist_drops_pointers_that_cannot_be_stored(self):
+        with self.assertLogs("base.unread", "ERROR"):
+            stored = async_to_sync(unread._persist)({(self.user.id, self.room.id): (2 ** 63, 3)})
+        self.assertEqual(stored, 0)
+        self.assertFalse(ReadState.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class UserSignalTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        self.user = User.objects.create(username="host", email="host@example.com")
+        Room.objects.create(name="Room", host=self.user, topic=Topic.objects.create(name="Topic"))
+
+    def test_unrelated_field_updates_skip_the_room_cards(self):
+        with mock.patch.object(fragments, "bump") as bump, self.assertNumQueries(1):
+            self.user.save(update_fields=["last_login"])
+        bump.assert_not_called()
+
+    def test_username_changes_refresh_the_room_cards(self):
+        self.user.username = "renamed"
+        with mock.patch.object(fragments, "bump") as bump:
+            self.user.save(update_fields=["username"])
+        bump.assert_called_once()
+
+
+def image_upload(color: str) -> SimpleUploadedFile:
+    out = io.BytesIO()
+    Image.new("RGB", (300, 300), color).save(out, "PNG")
+    return SimpleUploadedFile(f"{color}.png", out.getvalue(), content_type="image/png")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AvatarVariantTests(TestCase):
+    def setUp(self):
+        fake_redis(self)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = override_settings(MEDIA_ROOT=Path(media.name))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def user_with_avatar(self, username: str, color: str) -> User:
+        user = User.objects.create(username=username, email=f"{username}@example.com")
+        user.avatar = image_upload(color)
+        user.save()
+        return user
+
+    def stored(self, user) -> list[bool]:
+        return [default_storage.exists(path) for path in user.avatar_variants.values()]
+
+    def test_replaced_variants_are_deleted(self):
+        user = self.user_with_avatar("ann", "red")
+        old = dict(user.avatar_variants)
+        self.assertEqual(self.stored(user), [True, True, True])
+        user.avatar = image_upload("blue")
+        user.save()
+        self.assertNotEqual(user.avatar_variants, old)
+        self.assertEqual(self.stored(user), [True, True, True])
+        self.assertEqual([default_storage.exists(path) for path in old.values()], [False, False, False])
+
+    def test_variants_shared_with_another_user_are_kept(self):
+        user = self.user_with_avatar("ann", "red")
+        twin = self.user_with_avatar("bob", "red")
+        self.assertEqual(user.avatar_variants, twin.avatar_variants)
+        user.avatar = image_upload("blue")
+        user.save()
+        twin.refresh_from_db()
+        self.assertEqual(self.stored(twin), [True, True, True])
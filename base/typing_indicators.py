@@ -0,0 +1,164 @@
+"""
+Server-side typing indicator aggregation.
+
+Clients send a ``typing`` event on every keypress. Rather than broadcasting
+each one, ``ChatConsumer`` hands them to a per-process ``TypingAggregator``:
+
+* Repeated "still typing" events only extend the user's expiry and do not
+  cause a broadcast. Only start/stop transitions mark the room dirty.
+* Every ``CHAT_TYPING_INTERVAL`` seconds the aggregator pushes the changes
+  for dirty rooms to a Redis sorted set (``room:<id>:typing``, scored by
+  expiry time), which merges typists from all workers.
+* If the room-wide set differs from the last snapshot sent by any worker,
+  one combined ``{"type": "typing", "users": [...]}`` frame is broadcast.
+
+A user who stops sending events drops out after ``CHAT_TYPING_TTL`` seconds.
+"""
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics, wire
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS: typing set, last snapshot. ARGV: now, ttl.
+# Returns the sorted members if the snapshot changed, otherwise false.
+SNAPSHOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local members = redis.call('ZRANGE', KEYS[1], 0, -1)
+table.sort(members)
+local snapshot = table.concat(members, '\\n')
+if redis.call('GET', KEYS[2]) == snapshot then
+  return false
+end
+redis.call('SET', KEYS[2], snapshot, 'EX', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return members
+"""
+
+
+def typing_key(room_id) -> str:
+    return f"room:{room_id}:typing"
+
+
+class TypingAggregator:
+    def __init__(self, interval: float, ttl: float):
+        self.interval = interval
+        self.ttl = ttl
+        self.events = 0
+        self.broadcasts = 0
+        self._groups = {}     # room_id -> channel group
+        self._typing = {}     # room_id -> {user_id: (member, expires_at)}
+        self._changes = {}    # room_id -> {member: expires_at, or None to remove}
+        self._watch = {}      # room_id -> time until which the room is re-checked
+        self._task = None
+
+    async def _get_redis(self):
+        return get_redis(decode_responses=True)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def note(self, room_id, group: str, user_id: int, username: str, is_typing: bool):
+        """Record a typing event. Cheap enough to call on every keypress."""
+        self._ensure_started()
+        self.events += 1
+        now = time.time()
+        self._groups[room_id] = group
+        users = self._typing.setdefault(room_id, {})
+        member = f"{user_id}:{username}"
+        current = users.get(user_id)
+
+        if is_typing:
+            # Only refresh the shared expiry once half of it has been used up.
+            if current is None or current[1] - now < self.ttl / 2:
+                users[user_id] = (member, now + self.ttl)
+                self._changes.setdefault(room_id, {})[member] = now + self.ttl
+        elif current is not None:
+            del users[user_id]
+            self._changes.setdefault(room_id, {})[member] = None
+        self._watch[room_id] = now + self.ttl * 2
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Typing aggregator tick failed")
+
+    async def tick(self):
+        now = time.time()
+        for room_id, users in self._typing.items():
+            for user_id, (member, expires_at) in list(users.items()):
+                if expires_at <= now:
+                    del users[user_id]
+                    self._changes.setdefault(room_id, {})[member] = None
+
+        rooms = set(self._changes)
+        for room_id, until in list(self._watch.items()):
+            if until > now:
+                rooms.add(room_id)
+            elif room_id not in self._changes:
+                del self._watch[room_id]
+                self._typing.pop(room_id, None)
+                self._groups.pop(room_id, None)
+        if not rooms:
+            return
+
+        changes, self._changes = self._changes, {}
+        r = await self._get_redis()
+        snapshot = r.register_script(SNAPSHOT_SCRIPT)
+        channel_layer = get_channel_layer()
+
+        for room_id in rooms:
+            key = typing_key(room_id)
+            room_changes = changes.get(room_id, {})
+            if room_changes:
+                async with r.pipeline(transaction=False) as pipe:
+                    for member, expires_at in room_changes.items():
+                        if expires_at is None:
+                            pipe.zrem(key, member)
+                        else:
+                            pipe.zadd(key, {member: expires_at})
+                    await pipe.execute()
+
+            members = await snapshot(keys=[key, f"{key}:last"], args=[now, int(self.ttl * 2)])
+            group = self._groups.get(room_id)
+            if members is None or group is None:
+                continue
+            users = []
+            for m in members:
+                user_id, _, username = m.partition(":")
+                users.append({"user_id": int(user_id), "username": username})
+            await channel_layer.group_send(group, wire.group_event({"type": "typing", "users": users}))
+            self.broadcasts += 1
+
+    def stats(self) -> dict:
+        return {"events": self.events, "broadcasts": self.broadcasts}
+
+
+_aggregator = None
+
+
+def get_typing_aggregator() -> TypingAggregator:
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = TypingAggregator(
+            interval=settings.CHAT_TYPING_INTERVAL, ttl=settings.CHAT_TYPING_TTL
+        )
+    return _aggregator
+
+
+@metrics.register
+def _collect() -> dict:
+    if _aggregator is None:
+        return {}
+    return {f"chat_typing_{name}_total": value for name, value in _aggregator.stats().items()}
@@ -0,0 +1,304 @@
+"""
+Read pointers and unread counts.
+
+Every room has a message sequence number, ``Room.message_seq``, which counts
+the messages ever posted and never goes down. Redis keeps a copy per room in
+``room:<id>:seq``. ``bump`` advances it as messages are broadcast, but only
+for rooms whose copy exists. A missing room is loaded from the database on
+its next read. The database value trails the live one by the counter and
+write-behind flush delays, and a message bumped between that read and the
+load is missed. The copy therefore expires ``CHAT_UNREAD_SEQ_TTL`` seconds
+after it was loaded (bumps don't extend it), so such drift lasts one TTL at
+most.
+
+A user's read state lives in ``user:<id>:read``, a hash mapping room id to
+``"<last read message id>:<sequence at that message>"``. The unread count for
+a room is then the current sequence minus the stored one. A page of counts
+for hundreds of rooms is one ``HGETALL`` and one ``MGET``. ``mark_read``
+only moves a pointer forward, and never past the room's newest message, so
+a client can't mark messages that don't exist yet. It turns the message id
+into a sequence number by counting the newer messages in the room's history
+window, so the socket path never queries the database itself. A window that
+has expired is refilled through ``history.load``. For a message older than
+the window only the window's messages count as newer, so that room's unread
+count is a lower bound until the user reads further. Marking the latest
+message, the usual case, counts nothing.
+
+The hash is the live copy. Changes are queued in a per-process
+``ReadStateFlusher`` and upserted into ``ReadState`` every
+``CHAT_READ_FLUSH_INTERVAL`` seconds. The upsert only moves stored pointers
+forward, so a flush that races another process's newer one can't undo it.
+A user's hash is loaded back from ``ReadState`` when Redis no longer has it.
+Counts are approximate at the edges: a deleted unread message is still
+counted, and counts are clamped at zero after a Redis flush.
+"""
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from . import history
+from .models import ReadState, Room, User
+
+logger = logging.getLogger(__name__)
+
+LOADED_FIELD = "_"  # marks a read hash loaded from the database, even if empty
+MAX_ID = 2 ** 63 - 1  # BigIntegerField
+
+# KEYS: seq key. INCR keeps the key's TTL.
+BUMP_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return redis.call('INCR', KEYS[1])
+end
+return false
+"""
+
+# KEYS: read hash. ARGV: room id, message id, sequence, ttl.
+# Returns {1 if the pointer moved, the stored "<id>:<seq>"}.
+MARK_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+local moved = 0
+if not current or tonumber(string.match(current, '^(%d+)')) < tonumber(ARGV[2]) then
+  current = ARGV[2] .. ':' .. ARGV[3]
+  redis.call('HSET', KEYS[1], ARGV[1], current)
+  moved = 1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {moved, current}
+"""
+
+
+def read_key(user_id) -> str:
+    return f"user:{user_id}:read"
+
+
+def seq_key(room_id) -> str:
+    return f"room:{room_id}:seq"
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _parse(value) -> tuple[int, int]:
+    last_read_id, read_seq = _decode(value).split(":")
+    return int(last_read_id), int(read_seq)
+
+
+async def bump(r, room_id):
+    """Count a new message in the room's cached sequence."""
+    try:
+        await r.register_script(BUMP_SCRIPT)(keys=[seq_key(room_id)])
+    except Exception as e:
+        logger.warning(f"Unread sequence bump failed: {e}")
+
+
+def prime(pipe, room_id, seq: int):
+    """Queue a room's sequence copy on ``pipe``, unless a live copy exists."""
+    pipe.set(seq_key(room_id), seq, nx=True, ex=settings.CHAT_UNREAD_SEQ_TTL)
+
+
+@database_sync_to_async
+def _db_seqs(room_ids) -> dict[int, int]:
+    return dict(Room.objects.filter(id__in=room_ids).values_list("id", "message_seq"))
+
+
+async def room_seqs(r, room_ids) -> dict[int, int]:
+    """Current sequence of each room that exists."""
+    room_ids = [int(room_id) for room_id in room_ids]
+    if not room_ids:
+        return {}
+    seqs = {}
+    for room_id, value in zip(room_ids, await r.mget([seq_key(room_id) for room_id in room_ids])):
+        if value is not None:
+            seqs[room_id] = int(value)
+    missing = [room_id for room_id in room_ids if room_id not in seqs]
+    if missing:
+        loaded = await _db_seqs(missing)
+        async with r.pipeline(transaction=False) as pipe:
+            for room_id, seq in loaded.items():
+                prime(pipe, room_id, seq)
+            await pipe.execute()
+        seqs.update(loaded)
+    return seqs
+
+
+@database_sync_to_async
+def _db_read_state(user_id) -> dict[int, str]:
+    return {
+        room_id: f"{last_read_id}:{read_seq}"
+        for room_id, last_read_id, read_seq in ReadState.objects.filter(user_id=user_id).values_list(
+            "room_id", "last_read_id", "read_seq"
+        )
+    }
+
+
+async def read_state(r, user_id) -> dict[int, tuple[int, int]]:
+    """``{room id: (last read message id, sequence)}`` for the user."""
+    key = read_key(user_id)
+    raw = await r.hgetall(key)
+    if not raw:
+        raw = {LOADED_FIELD: "", **await _db_read_state(user_id)}
+        async with r.pipeline(transaction=False) as pipe:
+            # HSETNX so a concurrent mark_read is not overwritten with older state.
+            for field, value in raw.items():
+                pipe.hsetnx(key, field, value)
+            pipe.expire(key, settings.CHAT_READ_STATE_TTL)
+            await pipe.execute()
+    return {int(_decode(field)): _parse(value) for field, value in raw.items() if _decode(field) != LOADED_FIELD}
+
+
+async def _window_position(r, room_id, message_id: int) -> tuple[int, int] | None:
+    """``(newest message id, messages newer than message_id)`` from the history window, if it is cached."""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.get(history.floor_key(room_id))
+        pipe.zrevrange(history.history_key(room_id), 0, 0, withscores=True)
+        pipe.zcount(history.history_key(room_id), f"({message_id}", "+inf")
+        floor, newest, newer = await pipe.execute()
+    if floor is None:
+        return None
+    return (int(newest[0][1]) if newest else 0), newer
+
+
+async def mark_read(r, user_id, room_id, message_id: int) -> dict:
+    """Move the user's pointer in the room up to ``message_id``. Returns the resulting state."""
+    seqs = await room_seqs(r, [room_id])
+    if not seqs:
+        raise Room.DoesNotExist(f"Room {room_id} does not exist")
+    seq = seqs[int(room_id)]
+    position = await _window_position(r, room_id, message_id)
+    if position is None:
+        await history.load(r, room_id, 1)  # refills the whole window
+        position = await _window_position(r, room_id, message_id)
+    # Without a window the pointer is clamped to 0, which leaves it where it is.
+    newest, newer = position or (0, 0)
+    message_id = max(0, min(message_id, newest))
+    if not await r.exists(read_key(user_id)):
+        await read_state(r, user_id)  # load stored pointers before comparing against them
+    read_seq = max(0, seq - newer)
+
+    moved, stored = await r.register_script(MARK_SCRIPT)(
+        keys=[read_key(user_id)], args=[room_id, message_id, read_seq, settings.CHAT_READ_STATE_TTL]
+    )
+    last_read_id, read_seq = _parse(stored)
+    if moved:
+        get_read_flusher().note(user_id, room_id, last_read_id, read_seq)
+    return {"room_id": int(room_id), "last_read_id": last_read_id, "unread": max(0, seq - read_seq)}
+
+
+@database_sync_to_async
+def _participating(user_id) -> list[int]:
+    return list(Room.objects.filter(Q(participants=user_id) | Q(host_id=user_id)).values_list("id", flat=True))
+
+
+async def unread_counts(r, user_id, room_ids=None) -> dict[int, int]:
+    """Unread messages per room, for ``room_ids`` or every room the user is in or has read."""
+    state = await read_state(r, user_id)
+    if room_ids is None:
+        room_ids = set(await _participating(user_id)) | set(state)
+    seqs = await room_seqs(r, room_ids)
+    return {room_id: max(0, seq - state.get(room_id, (0, 0))[1]) for room_id, seq in seqs.items()}
+
+
+async def forget_room(r, room_id):
+    await r.delete(seq_key(room_id))
+
+
+def _storable(*values) -> bool:
+    return all(0 <= value <= MAX_ID for value in values)
+
+
+def _upsert_forward(rows: list[tuple]):
+    """Upsert ``(user_id, room_id, last_read_id, read_seq, updated)`` rows, never moving a pointer back."""
+    table = connection.ops.quote_name(ReadState._meta.db_table)
+    values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (user_id, room_id, last_read_id, read_seq, updated) VALUES {values} "
+            f"ON CONFLICT (user_id, room_id) DO UPDATE SET last_read_id = excluded.last_read_id, "
+            f"read_seq = excluded.read_seq, updated = excluded.updated "
+            f"WHERE excluded.last_read_id > {table}.last_read_id",
+            [value for row in rows for value in row],
+        )
+
+
+@database_sync_to_async
+def _persist(states: dict) -> int:
+    unstorable = [key for key, state in states.items() if not _storable(*key, *state)]
+    if unstorable:
+        logger.error(f"Dropping {len(unstorable)} read pointers out of range, e.g. {unstorable[0]}")
+    live_rooms = set(Room.objects.filter(id__in={room_id for _, room_id in states}).values_list("id", flat=True))
+    live_users = set(User.objects.filter(id__in={user_id for user_id, _ in states}).values_list("id", flat=True))
+    now = timezone.now()
+    rows = [
+        (user_id, room_id, last_read_id, read_seq, now)
+        for (user_id, room_id), (last_read_id, read_seq) in states.items()
+        if room_id in live_rooms and user_id in live_users and _storable(user_id, room_id, last_read_id, read_seq)
+    ]
+    if rows:
+        _upsert_forward(rows)
+    return len(rows)
+
+
+class ReadStateFlusher:
+    """Per-process queue of moved read pointers and the task that upserts them."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending = {}  # (user id, room id) -> (last read id, sequence)
+        self._task = None
+
+    def note(self, user_id, room_id, last_read_id: int, read_seq: int):
+        key = (int(user_id), int(room_id))
+        if key not in self._pending or self._pending[key][0] < last_read_id:
+            self._pending[key] = (last_read_id, read_seq)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        states, self._pending = self._pending, {}
+        if not states:
+            return
+        try:
+            await _persist(states)
+        except asyncio.CancelledError:
+            self._requeue(states)
+            raise
+        except Exception:
+            logger.exception(f"Read state flush of {len(states)} pointers failed")
+            self._requeue(states)
+
+    def _requeue(self, states: dict):
+        for key, state in states.items():
+            if key not in self._pending or self._pending[key][0] < state[0]:
+                self._pending[key] = state
+
+    async def aclose(self):
+        """Stop the flusher and persist whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+_flusher = None
+
+
+def get_read_flusher() -> ReadStateFlusher:
+    global _flusher
+    if _flusher is None:
+        _flusher = ReadStateFlusher(settings.CHAT_READ_FLUSH_INTERVAL)
+    return _flusher
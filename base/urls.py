@@ -32,6 +32,11 @@ urlpatterns = [
 
     # API Endpoints for scaling chat (used by WebSocket + caching)
     path('api/messages/<str:room_id>/', views.api_get_recent_messages, name="api-get-recent-messages"),
+    path('api/rooms/<int:room_id>/messages/', views.api_message_history, name="api-message-history"),
+    path('api/unread/', views.api_unread_counts, name="api-unread-counts"),
+
+    # Signed connect ticket for the chat WebSocket
+    path('ws-ticket/', views.ws_ticket, name="ws-ticket"),
 
     # JWT Auth for API/WebSocket use
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
@@ -1,11 +1,12 @@
+import hashlib
 import json
-import redis.asyncio as redis
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
+from django.core.paginator import Paginator
+from django.utils.functional import SimpleLazyObject
 from django.db import IntegrityError
 from django.contrib.auth import authenticate, login, logout
 from django.views.decorators.http import require_http_methods
@@ -13,16 +14,26 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from .models import Room, Topic, Message, User
 from .forms import MyUserCreationForm, RoomForm, UserForm
+from . import activity, fragments, history, membership, metrics, redis_pool, room_cache, search, unread
+from .ws_auth import issue_ticket
 
-# Redis connection settings
-REDIS_URL = "redis://localhost:6379"
-REDIS_ROOM_CACHE_PREFIX = "room_messages:"
-MAX_CACHED_MESSAGES = 50
+MAX_CACHED_MESSAGES = history.HISTORY_PAGE_SIZE
+ROOMS_PER_PAGE = 20
+HOME_ACTIVITY_COUNT = 5
+MAX_HISTORY_PAGE = 200
+MAX_UNREAD_ROOMS = 1000
 
 
 def get_redis():
-    """Return a Redis connection."""
-    return redis.from_url(REDIS_URL, decode_responses=True)
+    """Return the process-wide pooled Redis client."""
+    return redis_pool.get_redis(decode_responses=True)
+
+
+def get_cached_room_or_404(r, pk) -> Room:
+    room = room_cache.get(r, pk)
+    if room is None:
+        raise Http404("No Room matches the given query.")
+    return room
 
 
 @require_http_methods(["GET", "POST"])
@@ -83,40 +94,44 @@ def RegisterUser(request):
     return render(request, 'base/login_register.html', {'form': form})
 
 
+@metrics.instrument_view("home")
 def home(request):
     q = request.GET.get('q') or ''
 
-    rooms = Room.objects.filter(
-        Q(topic__name__icontains=q) |
-        Q(name__icontains=q) |
-        Q(description__icontains=q)
-    )
+    page_number = request.GET.get('page') or '1'
+
+    def rooms_page():
+        rooms = search.search_rooms(q).select_related('host', 'topic')
+        page = Paginator(rooms, ROOMS_PER_PAGE).get_page(page_number)
+        page.object_list = fragments.annotate_rooms(page.object_list)
+        return page
 
+    # Only evaluated if the cached room list fragment misses.
+    page = SimpleLazyObject(rooms_page)
     topics = Topic.objects.all()
-    room_count = rooms.count()
+    chats, _ = activity.page(get_redis(), limit=HOME_ACTIVITY_COUNT)
 
     context = {
-        'rooms': rooms,
+        'rooms': page,
+        'page': page,
+        'page_number': page_number,
+        'q': q,
         'topics': topics,
-        'room_count': room_count
+        'chats': chats,
+        'activity_key': fragments.activity_key(chats),
+        'room_count': SimpleLazyObject(lambda: page.paginator.count),
     }
     return render(request, 'base/home.html', context)
 
 
+@metrics.instrument_view("room")
 @login_required(login_url='login')
 def room(request, pk):
-    room = get_object_or_404(Room, id=pk)
     r = get_redis()
+    room = get_cached_room_or_404(r, pk)
 
-    cached_messages = async_to_sync(r.lrange)(f"{REDIS_ROOM_CACHE_PREFIX}{pk}", -MAX_CACHED_MESSAGES, -1)
-    if cached_messages:
-        chats = [json.loads(msg) for msg in cached_messages]
-    else:
-        chats_qs = room.messages.all().order_by('-created')[:MAX_CACHED_MESSAGES]
-        chats = [
-            {"user": m.user.username, "body": m.body, "created": m.created.isoformat()}
-            for m in chats_qs
-        ]
+    entries = async_to_sync(history.load)(r, room.id, MAX_CACHED_MESSAGES)
+    chats = [json.loads(entry) for entry in entries]
 
     participants = room.participants.all()
 
@@ -124,18 +139,16 @@ def room(request, pk):
         body = request.POST.get('body')
         if body:
             chat = Message.objects.create(user=request.user, room=room, body=body)
-            room.participants.add(request.user)
-
-            payload = {
-                "user": request.user.username,
-                "body": chat.body,
-                "created": chat.created.isoformat(),
-                "room_id": room.id
-            }
+            async_to_sync(membership.ensure)(
+                r, room.id, request.user.id,
+                sync_to_async(lambda: room.participants.add(request.user)),
+            )
 
-            async_to_sync(r.rpush)(f"{REDIS_ROOM_CACHE_PREFIX}{pk}", json.dumps(payload))
-            async_to_sync(r.ltrim)(f"{REDIS_ROOM_CACHE_PREFIX}{pk}", -MAX_CACHED_MESSAGES, -1)
-            async_to_sync(r.publish)(f"room_{pk}", json.dumps(payload))
+            entry = json.dumps(history.serialize_message(chat))
+            async_to_sync(history.append)(r, room.id, chat.id, entry)
+            async_to_sync(unread.bump)(r, room.id)
+            async_to_sync(activity.push)(r, activity.entry_for_message(chat))
+            async_to_sync(r.publish)(f"room_{pk}", entry)
 
             return redirect('room', pk=room.id)
     
@@ -144,38 +157,44 @@ def room(request, pk):
         'chats': chats,
         'participants': participants,
         'user_id': request.user.id,
-        'username': request.user.username
+        'username': request.user.username,
+        'ws_ticket': issue_ticket(request.user),
     }
     return render(request, 'base/room.html', context)
 
 
+@login_required(login_url='login')
+def ws_ticket(request):
+    """A fresh WebSocket connect ticket, for reconnecting after the page's one expires."""
+    return JsonResponse({'ticket': issue_ticket(request.user)})
+
+
+@metrics.instrument_view("profile")
 def profile(request, pk):
     user = get_object_or_404(User, id=pk)
-    rooms = user.rooms.all()
-    chats = user.messages.all().order_by('-created')
+    rooms = fragments.annotate_rooms(user.hosted_rooms.select_related('host', 'topic'))
+    chats = activity.from_messages(
+        user.messages.select_related('user', 'room').order_by('-created', '-id')[:activity.ACTIVITY_PAGE_SIZE]
+    )
     topics = Topic.objects.all()
-    context = {'user': user, 'rooms': rooms, 'chats': chats, 'topics': topics}
+    context = {'user': user, 'rooms': rooms, 'chats': chats, 'topics': topics, 'room_count': len(rooms)}
     return render(request, 'base/profile.html', context)
 
 
 def Topics(request):
     q = request.GET.get('q') or ''
-    rooms = Room.objects.filter(Q(topic__name__icontains=q))
+    rooms = search.search_rooms(q)
     topics = Topic.objects.all()
     context = {'rooms': rooms, 'topics': topics, 'room_count': rooms.count()}
     return render(request, 'base/topics.html', context)
 
 
+@metrics.instrument_view("activity")
 def Activity(request):
     q = request.GET.get('q') or ''
-    rooms = Room.objects.filter(
-        Q(topic__name__icontains=q) |
-        Q(name__icontains=q) |
-        Q(description__icontains=q)
-    )
     topics = Topic.objects.all()
-    chats = Message.objects.all()
-    context = {'rooms': rooms, 'topics': topics, 'chats': chats}
+    chats, next_cursor = activity.page(get_redis(), q, request.GET.get('cursor'))
+    context = {'topics': topics, 'chats': chats, 'q': q, 'next_cursor': next_cursor}
     return render(request, 'base/activity.html', context)
 
 
@@ -198,11 +217,12 @@ def CreateRoom(request):
 
 @login_required(login_url='login')
 def UpdateRoom(request, pk):
-    room = get_object_or_404(Room, id=pk)
+    room = get_cached_room_or_404(get_redis(), pk)
     form = RoomForm(instance=room)
     topics = Topic.objects.all()
 
     if request.method == 'POST':
+        room = get_object_or_404(Room, id=pk)
         topic_name = request.POST.get('topic')
         topic, _ = Topic.objects.get_or_create(name=topic_name)
         room.name = request.POST.get('name')
@@ -215,11 +235,12 @@ def UpdateRoom(request, pk):
 
 @login_required(login_url='login')
 def DeleteRoom(request, pk):
-    room = get_object_or_404(Room, id=pk)
-    if request.user != room.host:
+    room = get_cached_room_or_404(get_redis(), pk)
+    if request.user.id != room.host_id:
         return HttpResponse('You are not allowed here !!')
 
     if request.method == 'POST':
+        room = get_object_or_404(Room, id=pk)
         room.delete()
         return redirect('home')
     return render(request, 'base/delete.html', {'obj': room})
@@ -252,18 +273,92 @@ def UpdateUser(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def api_get_recent_messages(request, room_id):
-    """Return last 50 messages for a room, preferring Redis cache."""
-    r = get_redis()
-    cached_messages = async_to_sync(r.lrange)(f"{REDIS_ROOM_CACHE_PREFIX}{room_id}", -MAX_CACHED_MESSAGES, -1)
+    """Return last 50 messages for a room, oldest first, from the shared history window."""
+    entries = async_to_sync(history.load)(get_redis(), room_id, MAX_CACHED_MESSAGES)
+    if not entries:
+        get_object_or_404(Room, id=room_id)
+    # Keep the response shape this endpoint had before the history window.
+    messages_list = [
+        {"user": m["username"], "body": m["message"], "created": m["timestamp"]}
+        for m in map(json.loads, entries)
+    ]
+    return JsonResponse(messages_list, safe=False)
+
+
+def _int_param(request, name):
+    value = request.GET.get(name)
+    return None if value in (None, '') else int(value)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def api_message_history(request, room_id):
+    """
+    Keyset-paginated room history, oldest first.
+
+    ``?before_id=`` pages backwards, ``?after_id=`` syncs forwards, and neither
+    returns the latest page. Responses carry a strong ETag, so polling clients
+    that send ``If-None-Match`` get ``304 Not Modified`` when nothing changed.
+    """
+    try:
+        before_id = _int_param(request, 'before_id')
+        after_id = _int_param(request, 'after_id')
+        limit = _int_param(request, 'limit') or MAX_CACHED_MESSAGES
+    except ValueError:
+        return JsonResponse({'detail': 'before_id, after_id and limit must be integers.'}, status=400)
+    if before_id is not None and after_id is not None:
+        return JsonResponse({'detail': 'Use either before_id or after_id, not both.'}, status=400)
+    limit = min(max(limit, 1), MAX_HISTORY_PAGE)
 
-    if cached_messages:
-        messages_list = [json.loads(msg) for msg in cached_messages]
+    r = get_redis()
+    get_cached_room_or_404(r, room_id)
+    # One message past the page tells whether there is another page.
+    if after_id is not None:
+        entries = async_to_sync(history.load_after)(r, room_id, after_id, limit + 1)
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+    else:
+        entries = async_to_sync(history.load)(r, room_id, limit + 1, before_id)
+        has_more = len(entries) > limit
+        entries = entries[-limit:]
+
+    first_id = json.loads(entries[0])['message_id'] if entries else None
+    last_id = json.loads(entries[-1])['message_id'] if entries else after_id
+    body = (
+        f'{{"messages": [{", ".join(entries)}], '
+        f'"next_before_id": {json.dumps(first_id if has_more and after_id is None else None)}, '
+        f'"next_after_id": {json.dumps(last_id)}, '
+        f'"has_more": {json.dumps(has_more)}}}'
+    ).encode()
+
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponseNotModified()
     else:
-        room = get_object_or_404(Room, id=room_id)
-        chats_qs = room.messages.all().order_by('-created')[:MAX_CACHED_MESSAGES]
-        messages_list = [
-            {"user": m.user.username, "body": m.body, "created": m.created.isoformat()}
-            for m in chats_qs
-        ]
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
-    return JsonResponse(messages_list, safe=False)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def api_unread_counts(request):
+    """
+    Unread message counts for every room the user is in or has read.
+
+    ``?rooms=1,2,3`` limits the answer to those rooms. Rooms are marked read
+    over the socket with ``{"type": "mark_read", "message_id": ...}``.
+    """
+    room_ids = None
+    if request.GET.get('rooms'):
+        try:
+            room_ids = [int(room_id) for room_id in request.GET['rooms'].split(',')][:MAX_UNREAD_ROOMS]
+        except ValueError:
+            return JsonResponse({'detail': 'rooms must be a comma-separated list of integers.'}, status=400)
+
+    counts = async_to_sync(unread.unread_counts)(get_redis(), request.user.id, room_ids)
+    return JsonResponse({
+        'rooms': {str(room_id): count for room_id, count in counts.items()},
+        'total': sum(counts.values()),
+    })
@@ -0,0 +1,124 @@
+"""
+Cache warmup for deploys and Redis flushes.
+
+``manage.py warm_chat_cache`` ranks rooms by messages sent in the last
+``--hours``, topped up with the most recently updated rooms. It then preloads
+the rooms' Redis state, so the first wave of connects after a cold start does
+not all land on the database:
+
+* the history window (``room:<id>:history`` and its floor), as
+  :func:`history.load` would fill it
+* the metadata copy from ``room_cache``, which includes
+  ``participant_count``
+* the membership set from ``membership``
+* the message sequence copy (``room:<id>:seq``) from ``unread``, unless a
+  live one exists
+* the global ``activity:feed`` list
+
+Rooms are handled in batches. Each batch is read with a few queries and
+written in one Redis pipeline. Up to ``concurrency`` batches are in flight,
+each reading on its own database thread. Existing keys are safe to
+overwrite: the history fill merges with whatever a live append already
+wrote.
+"""
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from . import activity, history, membership, room_cache, unread
+from .models import Message, Room
+
+
+def _db(func):
+    # Not thread-sensitive: concurrent batches query on separate connections.
+    return database_sync_to_async(func, thread_sensitive=False)
+
+
+def rank_rooms(limit: int, hours: float) -> list[int]:
+    """Room ids, busiest first over the last ``hours``, then most recently updated."""
+    since = timezone.now() - timedelta(hours=hours)
+    counts = (
+        Message.objects.filter(created__gte=since)
+        .values("room_id")
+        .annotate(n=Count("id"))
+        .order_by("-n")[:limit]
+    )
+    busy = [row["room_id"] for row in counts]
+    if len(busy) < limit:
+        seen = set(busy)
+        for room_id in Room.objects.order_by("-updated").values_list("id", flat=True)[:limit]:
+            if len(busy) >= limit:
+                break
+            if room_id not in seen:
+                busy.append(room_id)
+    return busy
+
+
+def _read_batch(room_ids: list[int]) -> dict:
+    window = settings.CHAT_HISTORY_WINDOW
+    metas = list(Room.objects.filter(id__in=room_ids).values(*room_cache.CACHED_FIELDS, "message_seq"))
+    members = {}
+    for room_id, user_id in Room.participants.through.objects.filter(room_id__in=room_ids).values_list(
+        "room_id", "user_id"
+    ):
+        members.setdefault(room_id, []).append(user_id)
+    windows = {}
+    for meta in metas:
+        msgs = history.fetch_messages_db(meta["id"], window)
+        windows[meta["id"]] = (
+            [(m.id, json.dumps(history.serialize_message(m))) for m in msgs],
+            len(msgs) < window,
+        )
+    return {"metas": metas, "members": members, "windows": windows}
+
+
+async def warm_batch(r, room_ids: list[int]) -> dict:
+    batch = await _db(_read_batch)(room_ids)
+    async with r.pipeline(transaction=False) as pipe:
+        for meta in batch["metas"]:
+            room_id = meta["id"]
+            unread.prime(pipe, room_id, meta.pop("message_seq"))
+            room_cache.prime(pipe, meta)
+            membership.prime(pipe, room_id, batch["members"].get(room_id))
+            entries, complete = batch["windows"][room_id]
+            await history.fill(pipe, room_id, entries, complete)  # queued, not run, on a pipeline
+        await pipe.execute()
+    return {
+        "rooms": len(batch["metas"]),
+        "messages": sum(len(entries) for entries, _ in batch["windows"].values()),
+    }
+
+
+async def warm(r, room_ids: list[int], batch_size: int = 50, concurrency: int = 4, progress=None) -> dict:
+    """Warm ``room_ids`` in order. ``progress(done dict)`` is called after each batch."""
+    totals = {"rooms": 0, "messages": 0, "failed_batches": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(chunk):
+        async with semaphore:
+            try:
+                done = await warm_batch(r, chunk)
+            except Exception as e:
+                totals["failed_batches"] += 1
+                totals["last_error"] = str(e)
+                done = {}
+            totals["rooms"] += done.get("rooms", 0)
+            totals["messages"] += done.get("messages", 0)
+            totals["seconds"] = round(time.perf_counter() - started, 2)
+            if progress is not None:
+                progress(totals)
+
+    chunks = [room_ids[i:i + batch_size] for i in range(0, len(room_ids), batch_size)]
+    await asyncio.gather(*(run(chunk) for chunk in chunks))
+
+    feed = await _db(activity.latest_entries)()
+    await activity.fill_feed(r, feed)
+    totals["seconds"] = round(time.perf_counter() - started, 2)
+    return totals
@@ -0,0 +1,64 @@
+"""
+WebSocket wire formats.
+
+JSON text frames are the default. A client that offers the
+``chat.msgpack.v1`` subprotocol in ``Sec-WebSocket-Protocol`` gets binary
+MessagePack frames with the same shapes instead, and may send MessagePack
+itself.
+
+Room broadcasts carry the JSON text only (see :func:`group_event`), so rooms
+without binary sockets never pay for MessagePack. The first binary recipient
+in a process packs the frame and :func:`packed_frame` caches the bytes by
+frame text, so each event is packed once per process. Binary sockets also
+coalesce the live events that arrive within ``CHAT_MSGPACK_BATCH_DELAY``
+into one ``{"type": "batch", "events": [...]}`` frame. :func:`pack_batch`
+builds that frame around the already-packed events, so nothing is
+re-encoded.
+"""
+import json
+import struct
+from functools import lru_cache
+
+import msgpack
+
+SUBPROTOCOL_MSGPACK = "chat.msgpack.v1"
+MAX_INBOUND_BATCH = 50
+
+_BATCH_PREFIX = msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("events")
+
+
+def group_event(data: dict) -> dict:
+    """A ``broadcast_frame`` channel-layer event carrying ``data`` as JSON text."""
+    return {"type": "broadcast_frame", "kind": data["type"], "frame": json.dumps(data)}
+
+
+@lru_cache(maxsize=1024)
+def _pack_frame(frame: str) -> bytes:
+    return msgpack.packb(json.loads(frame))
+
+
+def packed_frame(event: dict) -> bytes:
+    """The event's frame as MessagePack, packed once per process however many sockets receive it."""
+    # Every recipient deserializes its own copy of the event, so cache by frame text.
+    return _pack_frame(event["frame"])
+
+
+def _array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 1 << 16:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+
+def pack_batch(packed_events: list[bytes]) -> bytes:
+    """``{"type": "batch", "events": [...]}`` from events that are already packed."""
+    return b"\x82" + _BATCH_PREFIX + _array_header(len(packed_events)) + b"".join(packed_events)
+
+
+def pack(data: dict) -> bytes:
+    return msgpack.packb(data)
+
+
+def unpack(data: bytes) -> dict:
+    return msgpack.unpackb(data, raw=False)
@@ -0,0 +1,390 @@
+"""
+Write-behind persistence for chat messages.
+
+With ``CHAT_WRITE_BEHIND`` enabled, ``ChatConsumer`` no longer inserts each
+message on its own thread hop. Instead a message takes its primary key from a
+Redis counter, is broadcast straight away, and is queued here. A per-process
+flusher persists the queue with one multi-row ``INSERT`` whenever
+``CHAT_WRITE_BEHIND_BATCH_SIZE`` messages are waiting or
+``CHAT_WRITE_BEHIND_MAX_DELAY`` seconds have passed, whichever comes first.
+
+All workers share the one counter, so IDs follow send order across workers
+just as plain inserts do. History, read pointers and the archive all rely on
+that. The counter hands out blocks of ``CHAT_WRITE_BEHIND_ID_BLOCK`` IDs
+reserved from the ``base_message`` sequence, so plain inserts never collide
+with it. Only the worker that finds a block used up goes to the database;
+every other message costs one Redis call.
+
+Crash safety is controlled by ``CHAT_WRITE_BEHIND_DURABILITY``:
+
+* ``"memory"``: the queue only lives in the worker. A crash loses at most
+  the messages received since the last flush.
+* ``"redis"``: each message is appended to a Redis journal before it is
+  broadcast and removed once committed. A starting flusher claims what is in
+  the journal by moving it, entry by entry, into its own processing list
+  (``chat:write_behind:processing:<host>:<pid>``), so each entry is replayed
+  by one worker only. The journal is shared, so a claim can include rows
+  another live worker still has queued. Rows carry their final IDs and the
+  counters only count rows that were actually inserted, so persisting a row
+  twice is harmless.
+
+A batch that fails on bad data (a constraint or value error) is split in
+half until the offending row is found. That row is logged, pushed to the
+``chat:write_behind:dead`` list and removed from the history window, and
+the rest is persisted. Any other error, e.g. the database being down, puts
+the batch back to be retried on the next tick.
+
+``Message.created`` is ``auto_now_add``, so the stored timestamp is the flush
+time. That is at most one flush interval after the broadcast timestamp.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import counters, fragments, history, metrics, room_cache
+from .models import Message, Room, User
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_KEY = "chat:write_behind:journal"
+PROCESSING_KEY = "chat:write_behind:processing"
+DEAD_LETTER_KEY = "chat:write_behind:dead"
+LAST_ID_KEY = "chat:write_behind:last_id"
+ID_CEILING_KEY = "chat:write_behind:id_ceiling"
+
+# KEYS: last id, ceiling. Returns the next ID, or 0 once the reserved block is used up.
+TAKE_ID_SCRIPT = """
+local last = tonumber(redis.call('GET', KEYS[1]) or '0')
+local ceiling = tonumber(redis.call('GET', KEYS[2]) or '0')
+if last >= ceiling then
+  return 0
+end
+return redis.call('INCR', KEYS[1])
+"""
+
+# KEYS: last id, ceiling. ARGV: first, last id of a reserved block.
+# Ignored if another worker has already added a block, so IDs never go backwards.
+ADD_BLOCK_SCRIPT = """
+local last = tonumber(redis.call('GET', KEYS[1]) or '0')
+local ceiling = tonumber(redis.call('GET', KEYS[2]) or '0')
+if last < ceiling or tonumber(ARGV[1]) <= ceiling then
+  return 0
+end
+redis.call('SET', KEYS[1], tonumber(ARGV[1]) - 1)
+redis.call('SET', KEYS[2], ARGV[2])
+return 1
+"""
+
+# Errors caused by the rows themselves rather than by the database being unavailable.
+ROW_ERRORS = (DataError, IntegrityError, ValueError)
+
+
+def write_behind_enabled() -> bool:
+    """Write-behind needs sequence reservation, which only PostgreSQL offers here."""
+    return settings.CHAT_WRITE_BEHIND and connection.vendor == "postgresql"
+
+
+@database_sync_to_async
+def _reserve_ids(count: int) -> tuple[int, int]:
+    """Take ``count`` values from the ``base_message`` sequence and return the top contiguous run.
+
+    Plain inserts can take values at the same time, so the values are not
+    always contiguous. Anything below the last gap is left unused.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [Message._meta.db_table, count],
+        )
+        ids = sorted(row[0] for row in cursor.fetchall())
+    first = ids[-1]
+    for value in reversed(ids[:-1]):
+        if value != first - 1:
+            break
+        first = value
+    return first, ids[-1]
+
+
+class FlushStats:
+    """Batch size and latency figures for the flusher, also recorded in ``base.metrics``."""
+
+    def __init__(self):
+        self.flushes = 0
+        self.messages = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def record(self, batch_size: int, latency: float):
+        self.flushes += 1
+        self.messages += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        metrics.observe("chat_write_behind_batch_size", batch_size)
+        metrics.observe("chat_write_behind_flush_seconds", latency)
+
+    def record_failure(self):
+        self.failures += 1
+        metrics.inc("chat_write_behind_failures_total")
+
+    def record_dead_letter(self):
+        self.dead_letters += 1
+        metrics.inc("chat_write_behind_dead_letters_total")
+
+    def as_dict(self) -> dict:
+        return {
+            "flushes": self.flushes,
+            "messages": self.messages,
+            "failures": self.failures,
+            "dead_letters": self.dead_letters,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.messages / self.flushes if self.flushes else 0.0,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.total_latency / self.flushes if self.flushes else 0.0,
+        }
+
+
+def _insert_new(model, columns: tuple, rows: list[tuple], conflict: tuple) -> list:
+    """Insert ``rows``, skipping conflicts. Returns the first column of each row actually inserted."""
+    table = connection.ops.quote_name(model._meta.db_table)
+    values = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values} "
+            f"ON CONFLICT ({', '.join(conflict)}) DO NOTHING RETURNING {columns[0]}",
+            [value for row in rows for value in row],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def persist(rows: list[dict]) -> int:
+    """Insert a batch of messages and their participant rows in one transaction.
+
+    Counters only move for rows this call inserted, so a batch that was
+    partly or wholly persisted already (a journal replay) is harmless.
+    """
+    live_rooms = set(
+        Room.objects.filter(id__in={r["room_id"] for r in rows}).values_list("id", flat=True)
+    )
+    live_users = set(
+        User.objects.filter(id__in={r["user_id"] for r in rows}).values_list("id", flat=True)
+    )
+    rows = [r for r in rows if r["room_id"] in live_rooms and r["user_id"] in live_users]
+    if not rows:
+        return 0
+
+    now = timezone.now()
+    pairs = sorted({(r["room_id"], r["user_id"]) for r in rows})
+    with transaction.atomic():
+        inserted_rooms = _insert_new(
+            Message,
+            ("room_id", "id", "user_id", "body", "created", "updated"),
+            [(r["room_id"], r["id"], r["user_id"], r["body"], now, now) for r in rows],
+            conflict=("id",),
+        )
+        joined_rooms = _insert_new(Room.participants.through, ("room_id", "user_id"), pairs, ("room_id", "user_id"))
+        counters.adjust_many(Room, Counter(inserted_rooms), ("message_count", "message_seq"))
+        counters.adjust_many(Room, Counter(joined_rooms), "participant_count")
+    if joined_rooms:
+        # Raw inserts send no m2m_changed, so do what participant_count_changed would.
+        joined = set(joined_rooms)
+        room_cache.invalidate(*joined)
+        fragments.bump(fragments.FEED, *map(fragments.room_gen, joined))
+    return len(inserted_rooms)
+
+
+apersist = database_sync_to_async(persist)
+
+
+class WriteBehindBuffer:
+    """Per-process message queue and the task that flushes it."""
+
+    def __init__(self, batch_size: int, max_delay: float, durability: str, id_block: int = 1000):
+        if durability not in ("memory", "redis"):
+            raise ValueError(f"Unknown write-behind durability: {durability}")
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.durability = durability
+        self.id_block = id_block
+        self.stats = FlushStats()
+        self.processing_key = f"{PROCESSING_KEY}:{socket.gethostname()}:{os.getpid()}"
+        self._pending = []  # (row, journal payload, journal key)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._id_lock = asyncio.Lock()
+        self._task = None
+
+    async def _get_redis(self):
+        return get_redis(decode_responses=False)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _take_id(self, r) -> int:
+        return await r.register_script(TAKE_ID_SCRIPT)(keys=[LAST_ID_KEY, ID_CEILING_KEY])
+
+    async def _next_id(self) -> int:
+        """Take the next message ID, reserving a new block from the database when the current one runs out."""
+        r = await self._get_redis()
+        while True:
+            message_id = await self._take_id(r)
+            if message_id:
+                return message_id
+            async with self._id_lock:
+                # Another task in this process may have added a block while we waited.
+                message_id = await self._take_id(r)
+                if message_id:
+                    return message_id
+                first, last = await _reserve_ids(self.id_block)
+                await r.register_script(ADD_BLOCK_SCRIPT)(keys=[LAST_ID_KEY, ID_CEILING_KEY], args=[first, last])
+                metrics.inc("chat_write_behind_id_blocks_total")
+
+    async def submit(self, user_id: int, room_id, body: str) -> dict:
+        """Assign an ID to a new message and queue it. Returns the message row."""
+        self._ensure_started()
+        row = {
+            "id": await self._next_id(),
+            "user_id": user_id,
+            "room_id": int(room_id),
+            "body": body,
+            "created": timezone.now().isoformat(),
+        }
+        payload = json.dumps(row)
+        if self.durability == "redis":
+            r = await self._get_redis()
+            await r.rpush(JOURNAL_KEY, payload)
+        self._pending.append((row, payload, JOURNAL_KEY))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return row
+
+    async def _run(self):
+        if self.durability == "redis":
+            await self._recover()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _recover(self):
+        """Claim and persist journal entries left behind by a worker that died mid-batch.
+
+        Each entry is moved into this worker's processing list on its own, so
+        workers starting together split the journal instead of all replaying it.
+        """
+        r = await self._get_redis()
+        claimed = []
+        try:
+            while (payload := await r.lmove(JOURNAL_KEY, self.processing_key, "LEFT", "RIGHT")) is not None:
+                claimed.append((json.loads(payload), payload, self.processing_key))
+        except Exception as e:
+            logger.warning(f"Write-behind journal unavailable: {e}")
+        if claimed:
+            logger.info(f"Replaying {len(claimed)} journaled messages")
+            self._pending[:0] = claimed
+
+    async def flush(self):
+        """Persist everything queued so far, one ``batch_size`` chunk at a time."""
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                try:
+                    await self._persist_batch(batch)
+                except asyncio.CancelledError:
+                    self._pending[:0] = batch
+                    raise
+                except Exception:
+                    self.stats.record_failure()
+                    logger.exception(f"Write-behind flush of {len(batch)} messages failed")
+                    self._pending[:0] = batch  # retried on the next tick; persisting is idempotent
+                    return
+
+    async def _persist_batch(self, batch):
+        """Persist ``batch``, halving it on bad data until the bad row can be set aside."""
+        started = time.perf_counter()
+        try:
+            await apersist([row for row, _, _ in batch])
+        except ROW_ERRORS as e:
+            if len(batch) == 1:
+                await self._dead_letter(batch[0], e)
+                return
+            middle = len(batch) // 2
+            await self._persist_batch(batch[:middle])
+            await self._persist_batch(batch[middle:])
+            return
+        self.stats.record(len(batch), time.perf_counter() - started)
+        await self._after_flush(batch)
+
+    async def _dead_letter(self, item, error: Exception):
+        row, payload, _ = item
+        self.stats.record_dead_letter()
+        logger.error(f"Write-behind dropped message {row['id']} in room {row['room_id']}: {error}: {payload}")
+        try:
+            await history.remove(get_redis(), row["room_id"], row["id"])
+            if self.durability == "redis":
+                await (await self._get_redis()).rpush(DEAD_LETTER_KEY, payload)
+        except Exception as e:
+            logger.warning(f"Write-behind dead letter bookkeeping failed: {e}")
+        await self._after_flush([item])
+
+    async def _after_flush(self, batch):
+        if self.durability != "redis":
+            return
+        r = await self._get_redis()
+        try:
+            async with r.pipeline(transaction=False) as pipe:
+                for _, payload, key in batch:
+                    pipe.lrem(key, 1, payload)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Write-behind journal cleanup failed: {e}")
+
+    async def aclose(self):
+        """Stop the flusher and persist whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+_buffer = None
+
+
+def get_write_behind() -> WriteBehindBuffer:
+    global _buffer
+    if _buffer is None:
+        _buffer = WriteBehindBuffer(
+            batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            max_delay=settings.CHAT_WRITE_BEHIND_MAX_DELAY,
+            durability=settings.CHAT_WRITE_BEHIND_DURABILITY,
+            id_block=settings.CHAT_WRITE_BEHIND_ID_BLOCK,
+        )
+    return _buffer
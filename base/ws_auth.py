@@ -0,0 +1,138 @@
+"""
+WebSocket authentication without database queries.
+
+``TicketAuthMiddleware`` accepts either credential, from the query string
+(``?ticket=`` / ``?token=``) or as a ``Sec-WebSocket-Protocol`` entry
+(``ticket.<ticket>`` / ``jwt.<token>``):
+
+* a connect ticket, signed with ``SECRET_KEY``, that the room page embeds
+  and ``ws-ticket/`` reissues. It is valid for ``CHAT_WS_TICKET_TTL``
+  seconds.
+* a simplejwt access token. Tokens issued by ``api/token/`` carry
+  ``username`` and ``avatar_url`` claims (see ``ChatTokenObtainPairSerializer``).
+  Older tokens without them cost one user lookup.
+
+Both are verified from their signatures alone, and ``scope["user"]`` becomes
+a :class:`TicketUser` holding what ``ChatConsumer`` needs. A connection
+with neither credential falls back to the session cookie when
+``CHAT_WS_SESSION_AUTH`` is on. That costs the usual session and user
+queries.
+
+A browser fails the handshake unless the server echoes one of the protocols
+it offered, and the server can't echo a credential back. A client that sends
+one as a protocol must therefore also offer the fixed
+:data:`SUBPROTOCOL_AUTH` (``chat.auth``), which ``ChatConsumer`` selects
+when MessagePack isn't negotiated, e.g.
+``new WebSocket(url, ["chat.auth", "ticket." + ticket])``. Without
+``chat.auth``, ``ticket.``/``jwt.`` protocols are ignored.
+"""
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .activity import avatar_url
+from .models import User
+
+SUBPROTOCOL_AUTH = "chat.auth"
+TICKET_SALT = "base.ws_auth.ticket"
+# "." rather than ":" so tickets are valid Sec-WebSocket-Protocol tokens.
+_signer = signing.TimestampSigner(salt=TICKET_SALT, sep=".")
+
+
+class TicketUser:
+    """The parts of a ``User`` the chat socket needs, taken from a verified credential."""
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id: int, username: str, avatar_url: str = ""):
+        self.id = self.pk = user_id
+        self.username = username
+        self.avatar_url = avatar_url
+
+    def __repr__(self):
+        return f"<TicketUser {self.id} {self.username}>"
+
+
+def issue_ticket(user: User) -> str:
+    return _signer.sign_object({"id": user.id, "un": user.username, "av": avatar_url(user)}, compress=True)
+
+
+def read_ticket(ticket: str) -> TicketUser | None:
+    try:
+        data = _signer.unsign_object(ticket, max_age=settings.CHAT_WS_TICKET_TTL)
+    except signing.BadSignature:  # includes SignatureExpired
+        return None
+    return TicketUser(data["id"], data["un"], data.get("av", ""))
+
+
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Adds the claims ``TicketAuthMiddleware`` needs to skip the user lookup."""
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token["username"] = user.username
+        token["avatar_url"] = avatar_url(user)
+        return token
+
+
+@database_sync_to_async
+def _load_user(user_id) -> TicketUser | None:
+    user = User.objects.filter(pk=user_id, is_active=True).first()
+    return TicketUser(user.id, user.username, avatar_url(user)) if user else None
+
+
+async def read_jwt(raw: str) -> TicketUser | None:
+    try:
+        token = AccessToken(raw)
+    except TokenError:
+        return None
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    if user_id is None:
+        return None
+    if "username" not in token:
+        return await _load_user(user_id)
+    return TicketUser(user_id, token["username"], token.get("avatar_url", ""))
+
+
+def _credentials(scope) -> tuple[str | None, str | None]:
+    query = parse_qs(scope.get("query_string", b"").decode())
+    ticket = (query.get("ticket") or [None])[0]
+    token = (query.get("token") or [None])[0]
+    subprotocols = scope.get("subprotocols", [])
+    if SUBPROTOCOL_AUTH not in subprotocols:
+        return ticket, token  # the handshake could not complete in a browser
+    for protocol in subprotocols:
+        if protocol.startswith("ticket."):
+            ticket = ticket or protocol[len("ticket."):]
+        elif protocol.startswith("jwt."):
+            token = token or protocol[len("jwt."):]
+    return ticket, token
+
+
+class TicketAuthMiddleware(BaseMiddleware):
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        ticket, token = _credentials(scope)
+        user = None
+        if ticket:
+            user = read_ticket(ticket)
+        if user is None and token:
+            user = await read_jwt(token)
+
+        if user is None and settings.CHAT_WS_SESSION_AUTH:
+            return await self.session_auth(scope, receive, send)
+        return await super().__call__({**scope, "user": user or AnonymousUser()}, receive, send)
@@ -0,0 +1,169 @@
+"""
+Benchmark: message table and index size before and after archiving.
+
+Creates a throwaway test database (``test_<NAME>``), writes ``--messages``
+messages spread over ``--rooms`` rooms, backdates the oldest ``--cold``
+fraction past ``CHAT_ARCHIVE_AFTER_DAYS`` and runs the archiver. It reports
+the size of ``base_message`` and its indexes before and after (compacted
+with ``VACUUM FULL`` on PostgreSQL, ``VACUUM`` on SQLite), the size of the
+archive table, and the time to read a history page from each tier. SQLite
+sizes need the ``dbstat`` virtual table.
+
+Usage:
+    python benchmarks/archive.py
+    python benchmarks/archive.py --rooms 200 --messages 1000000 --cold 0.9 --json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "talkbuds.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import OperationalError, connection  # noqa: E402
+from django.db.models import F  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from base import archive, history  # noqa: E402
+from base.models import Message, MessageArchive, Room, User  # noqa: E402
+
+BATCH_SIZE = 5000
+PAGE_SIZE = history.HISTORY_PAGE_SIZE
+WORDS = (
+    "anyone up for a study session on graph algorithms tonight the exam is next week "
+    "can someone share notes from the lecture about dynamic programming and recursion "
+    "thanks that helps a lot see you in the library later"
+).split()
+
+
+def seed(rooms: int, messages: int, rng: random.Random) -> list[Room]:
+    users = User.objects.bulk_create([User(username=f"bench{i}", email=f"bench{i}@example.com") for i in range(50)])
+    room_objs = Room.objects.bulk_create([Room(name=f"Room {i}") for i in range(rooms)])
+    written = 0
+    while written < messages:
+        batch = min(messages - written, BATCH_SIZE)
+        Message.objects.bulk_create([
+            Message(
+                user=rng.choice(users),
+                room=rng.choice(room_objs),
+                body=" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))),
+            )
+            for _ in range(batch)
+        ])
+        written += batch
+    return room_objs
+
+
+def sizes() -> dict:
+    """Bytes used by the message table, its indexes, and the archive table."""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM FULL ANALYZE base_message")
+            cursor.execute(
+                "SELECT pg_relation_size('base_message'), pg_indexes_size('base_message'), "
+                "pg_total_relation_size('base_messagearchive')"
+            )
+            table, indexes, archived = cursor.fetchone()
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
+            try:
+                cursor.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+            except OperationalError:
+                return {"table_bytes": None, "index_bytes": None, "archive_bytes": None}
+            used = dict(cursor.fetchall())
+            cursor.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'")
+            index_tables = dict(cursor.fetchall())
+        table = used.get("base_message", 0)
+        indexes = sum(size for name, size in used.items() if index_tables.get(name) == "base_message")
+        archived = sum(
+            size for name, size in used.items()
+            if name == "base_messagearchive" or index_tables.get(name) == "base_messagearchive"
+        )
+    return {"table_bytes": table, "index_bytes": indexes, "archive_bytes": archived}
+
+
+def time_page(room_id, before_id: int | None, repeat: int) -> float:
+    """Median milliseconds to read one history page ending before ``before_id``."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        history.fetch_messages_db(room_id, PAGE_SIZE, before_id)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--cold", type=float, default=0.9, help="fraction of messages old enough to archive")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        rooms = seed(args.rooms, args.messages, rng)
+        ids = Message.objects.order_by("id").values_list("id", flat=True)
+        boundary = ids[int(args.messages * args.cold) - 1] if args.cold > 0 else 0
+        Message.objects.filter(id__lte=boundary).update(
+            created=F("created") - timedelta(days=settings.CHAT_ARCHIVE_AFTER_DAYS + 1)
+        )
+        room_id = rooms[0].id
+        cold_before = Message.objects.filter(room_id=room_id, id__lte=boundary).order_by("-id").values_list("id", flat=True)[PAGE_SIZE]
+
+        before = sizes()
+        hot_ms_before = time_page(room_id, None, args.repeat)
+        cold_ms_before = time_page(room_id, cold_before, args.repeat)
+
+        started = time.perf_counter()
+        stats = archive.archive_before(timezone.now() - timedelta(days=settings.CHAT_ARCHIVE_AFTER_DAYS))
+        archive_s = time.perf_counter() - started
+
+        after = sizes()
+        result = {
+            "vendor": connection.vendor,
+            "messages": args.messages,
+            "rooms": args.rooms,
+            "archived": stats["messages"],
+            "segments": MessageArchive.objects.count(),
+            "archive_seconds": round(archive_s, 2),
+            "before": before,
+            "after": after,
+            "hot_page_ms": [round(hot_ms_before, 3), round(time_page(room_id, None, args.repeat), 3)],
+            "cold_page_ms": [round(cold_ms_before, 3), round(time_page(room_id, cold_before, args.repeat), 3)],
+        }
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f"{result['vendor']}: archived {result['archived']} of {result['messages']} messages "
+          f"into {result['segments']} segments in {result['archive_seconds']}s")
+    print(f"{'':<22} {'before':>12} {'after':>12}")
+    for label, key in (("message table bytes", "table_bytes"), ("message index bytes", "index_bytes"),
+                       ("archive bytes", "archive_bytes")):
+        print(f"{label:<22} {str(before[key]):>12} {str(after[key]):>12}")
+    print(f"{'latest page ms':<22} {result['hot_page_ms'][0]:>12} {result['hot_page_ms'][1]:>12}")
+    print(f"{'archived page ms':<22} {result['cold_page_ms'][0]:>12} {result['cold_page_ms'][1]:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark: Redis cost of group_send on the core and pub/sub channel layers.
+
+Simulates ``--nodes`` worker processes, each one a separate layer instance
+with its own Redis connections. Each node has ``--members`` channels in one
+room group. One node sends ``--messages`` group messages, and every channel
+on every node receives them. Both layers run against the same Redis server
+(``--redis``, default ``$REDIS_URL``). The Redis work is measured from the
+server's ``total_commands_processed`` and network input counters, so run it
+on an otherwise idle Redis.
+
+Usage:
+    python benchmarks/channel_layer.py
+    python benchmarks/channel_layer.py --nodes 8 --members 100 1000 --messages 20 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import redis.asyncio as redis
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer
+
+LAYERS = {"core": RedisChannelLayer, "pubsub": RedisPubSubChannelLayer}
+GROUP = "chat_bench"
+FRAME = json.dumps({
+    "type": "chat_message",
+    "message_id": 123456,
+    "user_id": 42,
+    "username": "ayush",
+    "message": "Anyone up for a study session on graph algorithms tonight?",
+    "timestamp": "2024-05-01T18:30:00+00:00",
+})
+
+
+async def server_counters(r) -> tuple[int, int]:
+    stats = await r.info("stats")
+    return stats["total_commands_processed"], stats["total_net_input_bytes"]
+
+
+async def receive_all(layer, channel: str, count: int):
+    for _ in range(count):
+        await layer.receive(channel)
+
+
+async def run(layer_cls, url: str, nodes: int, members: int, messages: int) -> dict:
+    prefix = f"bench-{uuid.uuid4().hex[:8]}"
+    layers = [layer_cls(hosts=[url], prefix=prefix, capacity=messages + 10) for _ in range(nodes)]
+    channels = []
+    for layer in layers:
+        for _ in range(members):
+            channel = await layer.new_channel()
+            await layer.group_add(GROUP, channel)
+            channels.append((layer, channel))
+    await asyncio.sleep(0.2)  # let pub/sub subscriptions settle
+
+    r = redis.from_url(url)
+    commands_before, bytes_before = await server_counters(r)
+    receivers = [asyncio.ensure_future(receive_all(layer, ch, messages)) for layer, ch in channels]
+    started = time.perf_counter()
+    for _ in range(messages):
+        await layers[0].group_send(GROUP, {"type": "broadcast_frame", "frame": FRAME})
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - started
+    commands_after, bytes_after = await server_counters(r)
+
+    for layer in layers:
+        await layer.flush()
+        if hasattr(layer, "close_pools"):
+            await layer.close_pools()
+    await r.aclose()
+
+    deliveries = messages * len(channels)
+    return {
+        "nodes": nodes,
+        "members_per_node": members,
+        "messages": messages,
+        "ms_per_message": round(elapsed * 1000 / messages, 2),
+        "deliveries_per_s": round(deliveries / elapsed, 1),
+        # Includes the receivers' polling commands, which the core layer needs per channel.
+        "redis_commands_per_message": round((commands_after - commands_before) / messages, 1),
+        "redis_bytes_in_per_message": round((bytes_after - bytes_before) / messages),
+    }
+
+
+async def main_async(args) -> list[dict]:
+    results = []
+    for members in args.members:
+        for name in args.layers:
+            row = await run(LAYERS[name], args.redis, args.nodes, members, args.messages)
+            results.append({"layer": name, **row})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis", default=os.getenv("REDIS_URL", "redis://127.0.0.1:6380"))
+    parser.add_argument("--layers", nargs="+", choices=sorted(LAYERS), default=["core", "pubsub"])
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000], help="channels per node")
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'layer':<7} {'nodes':>5} {'members':>8} {'ms/msg':>8} {'deliveries/s':>13} {'cmds/msg':>9} {'bytes/msg':>10}")
+    for row in results:
+        print(
+            f"{row['layer']:<7} {row['nodes']:>5} {row['members_per_node']:>8} {row['ms_per_message']:>8} "
+            f"{row['deliveries_per_s']:>13} {row['redis_commands_per_message']:>9} "
+            f"{row['redis_bytes_in_per_message']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
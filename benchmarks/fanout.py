@@ -0,0 +1,136 @@
+"""
+Micro-benchmark: CPU cost of fanning one chat message out to a room.
+
+Compares the per-recipient path (every consumer rebuilds the frame and calls
+``json.dumps``) with the pre-encoded path (the sender encodes once and every
+consumer forwards ``event["frame"]``). Each recipient also decodes the group
+payload with msgpack, the way ``channels_redis`` delivers it, and hands the
+frame to its own ``Outbox`` writer task, whose socket send is a no-op.
+
+Usage:
+    python benchmarks/fanout.py
+    python benchmarks/fanout.py --sizes 10 100 1000 5000 --rounds 20 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import msgpack
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "talkbuds.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from base.consumers import ChatConsumer  # noqa: E402
+from base.outbox import Outbox  # noqa: E402
+
+ENTRY = {
+    "message_id": 123456,
+    "user_id": 42,
+    "username": "ayush",
+    "message": "Anyone up for a study session on graph algorithms tonight?",
+    "timestamp": "2024-05-01T18:30:00+00:00",
+}
+
+
+async def make_consumers(count: int) -> list[ChatConsumer]:
+    """JSON consumers in the state ``connect`` leaves them in; must run on the measuring loop."""
+    async def send(text_data=None, bytes_data=None, close=False):
+        pass
+
+    consumers = []
+    for _ in range(count):
+        consumer = ChatConsumer()
+        consumer.send = send
+        consumer.binary = False
+        consumer._pending = []
+        consumer._flush_task = None
+        consumer._outbox = Outbox(send, settings.CHAT_SEND_QUEUE_SIZE, settings.CHAT_SLOW_CONSUMER_POLICY)
+        consumer._outbox.start()
+        consumers.append(consumer)
+    return consumers
+
+
+def close_consumers(consumers):
+    for consumer in consumers:
+        consumer._outbox.close()
+
+
+async def per_recipient(consumers):
+    packed = msgpack.packb({"type": "chat_message", **ENTRY})
+    for consumer in consumers:
+        event = msgpack.unpackb(packed)
+        frame = json.dumps({"type": "chat_message", **{key: event[key] for key in ENTRY}})
+        await consumer.queue_send("chat_message", text_data=frame)
+
+
+async def pre_encoded(consumers):
+    frame = json.dumps({"type": "chat_message", **ENTRY})
+    packed = msgpack.packb({"type": "broadcast_frame", "frame": frame})
+    for consumer in consumers:
+        await consumer.broadcast_frame(msgpack.unpackb(packed))
+
+
+async def deliver(fn, consumers):
+    await fn(consumers)
+    await asyncio.sleep(0)  # let every writer task send its frame
+
+
+def measure(fn, size: int, rounds: int) -> float:
+    """CPU microseconds per message, best of ``rounds``."""
+    loop = asyncio.new_event_loop()
+    best = float("inf")
+    consumers = loop.run_until_complete(make_consumers(size))
+    try:
+        for _ in range(rounds):
+            started = time.process_time()
+            loop.run_until_complete(deliver(fn, consumers))
+            best = min(best, time.process_time() - started)
+    finally:
+        close_consumers(consumers)
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        legacy = measure(per_recipient, size, args.rounds)
+        shared = measure(pre_encoded, size, args.rounds)
+        results.append({
+            "room_size": size,
+            "per_recipient_us": round(legacy, 1),
+            "pre_encoded_us": round(shared, 1),
+            "speedup": round(legacy / shared, 2) if shared else None,
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'room size':>10} {'per-recipient µs':>18} {'pre-encoded µs':>16} {'speedup':>8}")
+    for row in results:
+        print(
+            f"{row['room_size']:>10} {row['per_recipient_us']:>18} "
+            f"{row['pre_encoded_us']:>16} {row['speedup']:>7}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark: home page render time and queries with and without fragment caching.
+
+Creates a throwaway test database (``test_<NAME>``) with ``--rooms`` rooms
+over ``--topics`` topics, then requests the home page ``--requests`` times
+in each mode:
+
+* ``uncached``: ``DummyCache`` with ``CHAT_FRAGMENT_CACHE_TTL = 0``, so every
+  fragment renders from the database as before
+* ``cached``: the configured default cache (``--locmem`` for a local one)
+
+With ``--churn`` a fraction of the requests is preceded by a room edit,
+which bumps that room's card and the room list, so the numbers include
+re-rendering after invalidation. The chat Redis (activity feed) is a
+``fakeredis`` server in both modes.
+
+Usage:
+    python benchmarks/home_render.py
+    python benchmarks/home_render.py --rooms 5000 --requests 500 --churn 0.05 --locmem --json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import fakeredis
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "talkbuds.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import AnonymousUser  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import CaptureQueriesContext, override_settings  # noqa: E402
+
+from base import redis_pool, views  # noqa: E402
+from base.models import Room, Topic, User  # noqa: E402
+
+DUMMY_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "bench"}}
+
+
+def use_fake_redis():
+    server = fakeredis.FakeServer()
+    redis_pool._make_client = lambda decode_responses: fakeredis.FakeAsyncRedis(
+        server=server, decode_responses=decode_responses
+    )
+
+
+def seed(rooms: int, topics: int, rng: random.Random) -> list[Room]:
+    hosts = User.objects.bulk_create([User(username=f"host{i}", email=f"host{i}@example.com") for i in range(50)])
+    topic_objs = Topic.objects.bulk_create([Topic(name=f"topic {i}") for i in range(topics)])
+    return Room.objects.bulk_create([
+        Room(host=rng.choice(hosts), topic=rng.choice(topic_objs), name=f"Room {i}", description="bench")
+        for i in range(rooms)
+    ])
+
+
+def run(requests: int, churn: float, room_ids: list[int], rng: random.Random) -> dict:
+    factory = RequestFactory()
+    samples, queries = [], []
+    for i in range(requests + 1):
+        if churn and rng.random() < churn:
+            room = Room.objects.get(pk=rng.choice(room_ids))
+            room.description = f"edited {i}"
+            room.save()
+        request = factory.get("/")
+        request.user = AnonymousUser()
+        with CaptureQueriesContext(connection) as ctx:
+            started = time.perf_counter()
+            views.home(request)
+            elapsed = (time.perf_counter() - started) * 1000
+        if i:  # the first request fills the caches
+            samples.append(elapsed)
+            queries.append(len(ctx.captured_queries))
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 2),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 2),
+        "queries_per_request": round(statistics.mean(queries), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--topics", type=int, default=40)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--churn", type=float, default=0.0, help="fraction of requests preceded by a room edit")
+    parser.add_argument("--locmem", action="store_true", help="use a local-memory cache for the cached run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    use_fake_redis()
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    results = []
+    try:
+        room_ids = [room.id for room in seed(args.rooms, args.topics, random.Random(args.seed))]
+        modes = [
+            ("uncached", override_settings(CACHES=DUMMY_CACHE, CHAT_FRAGMENT_CACHE_TTL=0)),
+            ("cached", override_settings(CACHES=LOCMEM_CACHE) if args.locmem else override_settings()),
+        ]
+        for mode, overrides in modes:
+            with overrides:
+                row = run(args.requests, args.churn, room_ids, random.Random(args.seed))
+            results.append({"mode": mode, "vendor": connection.vendor, "rooms": args.rooms, **row})
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'mode':<9} {'rooms':>7} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for row in results:
+        print(f"{row['mode']:<9} {row['rooms']:>7} {row['p50_ms']:>8} {row['p99_ms']:>8} {row['queries_per_request']:>8}")
+
+
+if __name__ == "__main__":
+    main()
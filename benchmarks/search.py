@@ -0,0 +1,126 @@
+"""
+Benchmark: ranked room search against the old ``icontains`` filter.
+
+Creates a throwaway test database (``test_<NAME>``), grows it to each room
+count in turn, rebuilds the search index, and times the first page of
+results (rows plus total count) for a fixed set of queries. Run it against
+PostgreSQL for production numbers; on SQLite it measures the FTS5 fallback.
+
+Usage:
+    python benchmarks/search.py
+    python benchmarks/search.py --sizes 10000 100000 1000000 --repeat 5 --json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "talkbuds.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.db.models import Q  # noqa: E402
+
+from base import search  # noqa: E402
+from base.models import Room, Topic  # noqa: E402
+
+PAGE_SIZE = 20
+BATCH_SIZE = 5000
+QUERIES = ["python", "graph algorithms", "study group", "machine learn", "zzzz-no-match"]
+WORDS = (
+    "python django react rust golang algorithms graph study group exam calculus physics "
+    "chemistry biology history music guitar piano design startup interview career cloud "
+    "devops security linux kernel compilers databases postgres redis machine learning "
+    "statistics art drawing photography travel cooking fitness running chess books"
+).split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def grow_to(size: int, topics: list[Topic], rng: random.Random):
+    missing = size - Room.objects.count()
+    while missing > 0:
+        batch = min(missing, BATCH_SIZE)
+        Room.objects.bulk_create([
+            Room(
+                topic=rng.choice(topics),
+                name=sentence(rng, 3).title(),
+                description=sentence(rng, 20),
+            )
+            for _ in range(batch)
+        ])
+        missing -= batch
+    search.index_rooms()
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE base_room")
+
+
+def old_filter(q: str):
+    return Room.objects.filter(
+        Q(topic__name__icontains=q) |
+        Q(name__icontains=q) |
+        Q(description__icontains=q)
+    )
+
+
+def time_page(build, q: str, repeat: int) -> float:
+    """Median milliseconds to fetch the first page and the total count."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        qs = build(q)
+        list(qs[:PAGE_SIZE])
+        qs.count()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    results = []
+    try:
+        topics = Topic.objects.bulk_create([Topic(name=word) for word in WORDS])
+        for size in sorted(args.sizes):
+            grow_to(size, topics, rng)
+            for q in QUERIES:
+                results.append({
+                    "vendor": connection.vendor,
+                    "rooms": size,
+                    "query": q,
+                    "icontains_ms": round(time_page(old_filter, q, args.repeat), 2),
+                    "search_ms": round(time_page(search.search_rooms, q, args.repeat), 2),
+                })
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'rooms':>9} {'query':<18} {'icontains ms':>13} {'search ms':>10}")
+    for row in results:
+        print(f"{row['rooms']:>9} {row['query']:<18} {row['icontains_ms']:>13} {row['search_ms']:>10}")
+
+
+if __name__ == "__main__":
+    main()
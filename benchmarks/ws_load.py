@@ -0,0 +1,267 @@
+"""
+Load benchmark: what ``ChatConsumer`` sustains under simulated room traffic.
+
+Opens ``--rooms`` x ``--clients`` sockets with ``WebsocketCommunicator``
+against the in-memory channel layer. Redis is a ``fakeredis`` server shared by
+every pool, and the database is a throwaway test database (``test_<NAME>``).
+Each client sends ``--messages`` events at ``--rate`` per second, mixing chat
+messages with typing and ``load_more`` traffic by the given ratios. Sockets
+connect the way the room page does: through ``TicketAuthMiddleware`` with a
+``?ticket=`` connect ticket, and every frame goes out through the consumer's
+send queue. Django's cache is a local-memory cache.
+
+Reported: connect latency (socket open to history and roster received),
+end-to-end chat latency from send to delivery on every socket in the room
+(p50/p99), chat messages and deliveries per second, and database queries per
+chat message. Chat messages refused by ``CHAT_RATE_LIMITS`` are reported
+separately and not expected on the other sockets. With ``--json`` the run settings are included so results can be
+compared across commits.
+
+Needs ``fakeredis`` with Lua support (``pip install "fakeredis[lua]"``).
+
+Usage:
+    python benchmarks/ws_load.py
+    python benchmarks/ws_load.py --rooms 20 --clients 50 --messages 20 --rate 2 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+import fakeredis
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "talkbuds.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+
+from django.test.utils import override_settings  # noqa: E402
+
+from base import redis_pool  # noqa: E402
+from base.models import Room, Topic, User  # noqa: E402
+from base.routing import websocket_urlpatterns  # noqa: E402
+from base.ws_auth import TicketAuthMiddleware, issue_ticket  # noqa: E402
+
+MARKER = "bench"
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "bench"}}
+
+
+class QueryCounter:
+    """Counts queries on every database connection, in every thread."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def use_fake_redis():
+    server = fakeredis.FakeServer()
+    redis_pool._make_client = lambda decode_responses: fakeredis.FakeAsyncRedis(
+        server=server, decode_responses=decode_responses
+    )
+
+
+def use_memory_layer():
+    settings.CHANNEL_LAYERS = {
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 100_000}},
+    }
+
+
+def seed(rooms: int, clients: int) -> list[tuple[Room, list[User]]]:
+    topic = Topic.objects.create(name="benchmark")
+    layout = []
+    for r in range(rooms):
+        room = Room.objects.create(topic=topic, name=f"Bench room {r}")
+        users = User.objects.bulk_create([
+            User(username=f"bench-{r}-{c}", email=f"bench-{r}-{c}@example.com")
+            for c in range(clients)
+        ])
+        layout.append((room, users))
+    return layout
+
+
+def percentile(samples: list[float], pct: int) -> float | None:
+    if not samples:
+        return None
+    if len(samples) == 1:
+        return round(samples[0], 2)
+    return round(statistics.quantiles(samples, n=100, method="inclusive")[pct - 1], 2)
+
+
+class Client:
+    def __init__(self, app, room: Room, user: User):
+        self.room = room
+        self.user = user
+        self.communicator = WebsocketCommunicator(app, f"room/{room.id}/?ticket={issue_ticket(user)}")
+        self.latencies = []
+        self.received = 0
+        self.refused = 0
+
+    async def connect(self, timeout: float) -> float:
+        started = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if not connected:
+            raise RuntimeError(f"{self.user.username} could not connect to room {self.room.id}")
+        await self.communicator.receive_from(timeout=timeout)  # message_history
+        await self.communicator.receive_from(timeout=timeout)  # presence_roster
+        return (time.perf_counter() - started) * 1000
+
+    async def listen(self):
+        # Read the output queue directly: a receive_from() timeout would kill the consumer.
+        while True:
+            message = await self.communicator.output_queue.get()
+            frame = json.loads(message.get("text") or "{}")
+            if frame.get("code") == "rate_limited" and frame.get("event") == "chat_message":
+                self.refused += 1
+                continue
+            if frame.get("type") != "chat_message":
+                continue
+            marker, _, sent = frame["message"].partition(":")
+            if marker == MARKER:
+                self.latencies.append((time.perf_counter() - float(sent)) * 1000)
+                self.received += 1
+
+    async def talk(self, rng: random.Random, args) -> int:
+        sent = 0
+        for _ in range(args.messages):
+            await asyncio.sleep(rng.expovariate(args.rate))
+            roll = rng.random()
+            if roll < args.typing_ratio:
+                await self.communicator.send_json_to({"type": "typing", "is_typing": rng.random() < 0.5})
+            elif roll < args.typing_ratio + args.load_more_ratio:
+                await self.communicator.send_json_to({"type": "load_more"})
+            else:
+                await self.communicator.send_json_to(
+                    {"type": "chat_message", "message": f"{MARKER}:{time.perf_counter()!r}"}
+                )
+                sent += 1
+        return sent
+
+
+def expected_deliveries(clients: list[Client], sent: int, room_size: int) -> int:
+    return (sent - sum(c.refused for c in clients)) * room_size
+
+
+async def wait_for_deliveries(clients: list[Client], sent: int, room_size: int, idle_timeout: float):
+    """Wait until every delivery arrived, or none has for ``idle_timeout`` seconds."""
+    received, idle_since = -1, time.perf_counter()
+    while True:
+        now_received = sum(c.received for c in clients)
+        # Refusals arrive asynchronously too, so recompute what is still owed.
+        if now_received >= expected_deliveries(clients, sent, room_size):
+            return
+        if now_received != received:
+            received, idle_since = now_received, time.perf_counter()
+        elif time.perf_counter() - idle_since > idle_timeout:
+            return
+        await asyncio.sleep(0.05)
+
+
+async def run(args, layout) -> dict:
+    app = TicketAuthMiddleware(URLRouter(websocket_urlpatterns))
+    rooms = [[Client(app, room, user) for user in users] for room, users in layout]
+    clients = [c for room in rooms for c in room]
+
+    counter = QueryCounter()
+    connection_created.connect(counter.install)
+    try:
+        connect_ms = await asyncio.gather(*(c.connect(args.idle_timeout) for c in clients))
+        connect_queries = counter.count
+
+        rng = random.Random(args.seed)
+        rngs = [random.Random(rng.random()) for _ in clients]
+        listeners = [asyncio.create_task(c.listen()) for c in clients]
+        counter.count = 0
+        started = time.perf_counter()
+        sent = await asyncio.gather(*(c.talk(r, args) for c, r in zip(clients, rngs)))
+        await wait_for_deliveries(clients, sum(sent), args.clients, args.idle_timeout)
+        expected = expected_deliveries(clients, sum(sent), args.clients)
+        elapsed = time.perf_counter() - started
+        traffic_queries = counter.count
+
+        for task in listeners:
+            task.cancel()
+        for c in clients:
+            await c.communicator.disconnect()
+    finally:
+        connection_created.disconnect(counter.install)
+
+    latencies = [ms for c in clients for ms in c.latencies]
+    messages = sum(sent)
+    refused = sum(c.refused for c in clients)
+    return {
+        "connect_ms": {"p50": percentile(connect_ms, 50), "p99": percentile(connect_ms, 99)},
+        "latency_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+        "messages": messages,
+        "rate_limited": refused,
+        "deliveries": len(latencies),
+        "lost_deliveries": expected - len(latencies),
+        "messages_per_s": round(messages / elapsed, 1),
+        "deliveries_per_s": round(len(latencies) / elapsed, 1),
+        "queries_per_connect": round(connect_queries / len(clients), 2),
+        "queries_per_message": round(traffic_queries / (messages - refused), 2) if messages > refused else None,
+        "elapsed_s": round(elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=20, help="sockets per room")
+    parser.add_argument("--messages", type=int, default=10, help="events sent per socket")
+    parser.add_argument("--rate", type=float, default=5.0, help="events per second per socket")
+    parser.add_argument("--typing-ratio", type=float, default=0.3)
+    parser.add_argument("--load-more-ratio", type=float, default=0.05)
+    parser.add_argument("--idle-timeout", type=float, default=5.0, help="seconds to wait for stragglers")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    use_fake_redis()
+    use_memory_layer()
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(CACHES=LOCMEM_CACHE):
+            layout = seed(args.rooms, args.clients)
+            result = asyncio.run(run(args, layout))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.json:
+        print(json.dumps({"vendor": connection.vendor, "settings": vars(args), **result}, indent=2))
+        return
+
+    print(f"{args.rooms} rooms x {args.clients} clients, {result['messages']} chat messages in {result['elapsed_s']}s")
+    print(f"connect       p50 {result['connect_ms']['p50']} ms   p99 {result['connect_ms']['p99']} ms")
+    print(f"end-to-end    p50 {result['latency_ms']['p50']} ms   p99 {result['latency_ms']['p99']} ms")
+    print(f"throughput    {result['messages_per_s']} msg/s, {result['deliveries_per_s']} deliveries/s")
+    print(f"lost          {result['lost_deliveries']} deliveries ({result['rate_limited']} messages rate limited)")
+    print(f"db queries    {result['queries_per_connect']} per connect, {result['queries_per_message']} per message")
+
+
+if __name__ == "__main__":
+    main()
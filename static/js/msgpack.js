@@ -0,0 +1,170 @@
+// Minimal MessagePack codec for the chat socket's chat.msgpack.v1 frames
+// (base/wire.py). Served from our own static files rather than a CDN.
+// Covers what the server sends and the client needs: nil, booleans, integers,
+// floats, strings, binary, arrays and maps with string keys.
+(function (global) {
+  "use strict";
+
+  const textEncoder = new TextEncoder();
+  const textDecoder = new TextDecoder();
+
+  function encode(value) {
+    const bytes = [];
+
+    function pushUint(n, size) {
+      for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+        bytes.push(Math.floor(n / 2 ** shift) & 0xff);
+      }
+    }
+
+    function writeLength(length, fix, fixMax, codes) {
+      if (fix !== null && length <= fixMax) {
+        bytes.push(fix | length);
+      } else if (codes[0] !== null && length < 0x100) {
+        bytes.push(codes[0], length);
+      } else if (length < 0x10000) {
+        bytes.push(codes[1]);
+        pushUint(length, 2);
+      } else {
+        bytes.push(codes[2]);
+        pushUint(length, 4);
+      }
+    }
+
+    function writeNumber(n) {
+      if (!Number.isSafeInteger(n)) {
+        const view = new DataView(new ArrayBuffer(8));
+        view.setFloat64(0, n);
+        bytes.push(0xcb, ...new Uint8Array(view.buffer));
+      } else if (n >= 0) {
+        if (n < 0x80) bytes.push(n);
+        else if (n < 0x100) bytes.push(0xcc, n);
+        else if (n < 0x10000) { bytes.push(0xcd); pushUint(n, 2); }
+        else if (n < 0x100000000) { bytes.push(0xce); pushUint(n, 4); }
+        else { bytes.push(0xcf); pushUint(n, 8); }
+      } else if (n >= -0x20) {
+        bytes.push(n & 0xff);
+      } else {
+        const view = new DataView(new ArrayBuffer(8));
+        view.setBigInt64(0, BigInt(n));
+        bytes.push(0xd3, ...new Uint8Array(view.buffer));
+      }
+    }
+
+    function write(v) {
+      if (v === null || v === undefined) {
+        bytes.push(0xc0);
+      } else if (v === false || v === true) {
+        bytes.push(v ? 0xc3 : 0xc2);
+      } else if (typeof v === "number") {
+        writeNumber(v);
+      } else if (typeof v === "string") {
+        const data = textEncoder.encode(v);
+        writeLength(data.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+        for (const b of data) bytes.push(b);
+      } else if (v instanceof Uint8Array) {
+        writeLength(v.length, null, 0, [0xc4, 0xc5, 0xc6]);
+        for (const b of v) bytes.push(b);
+      } else if (Array.isArray(v)) {
+        writeLength(v.length, 0x90, 15, [null, 0xdc, 0xdd]);
+        v.forEach(write);
+      } else {
+        const keys = Object.keys(v).filter((key) => v[key] !== undefined);
+        writeLength(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+        keys.forEach((key) => { write(key); write(v[key]); });
+      }
+    }
+
+    write(value);
+    return new Uint8Array(bytes);
+  }
+
+  function decode(buffer) {
+    const data = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+    const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+    let pos = 0;
+
+    function uint(size) {
+      let n = 0;
+      for (let i = 0; i < size; i++) n = n * 256 + data[pos++];
+      return n;
+    }
+
+    function int(size) {
+      const n = uint(size);
+      return n >= 2 ** (size * 8 - 1) ? n - 2 ** (size * 8) : n;
+    }
+
+    function str(length) {
+      const s = textDecoder.decode(data.subarray(pos, pos + length));
+      pos += length;
+      return s;
+    }
+
+    function bin(length) {
+      const b = data.slice(pos, pos + length);
+      pos += length;
+      return b;
+    }
+
+    function array(length) {
+      const result = new Array(length);
+      for (let i = 0; i < length; i++) result[i] = read();
+      return result;
+    }
+
+    function map(length) {
+      const result = {};
+      for (let i = 0; i < length; i++) {
+        const key = read();
+        result[key] = read();
+      }
+      return result;
+    }
+
+    function float(size) {
+      const value = size === 4 ? view.getFloat32(pos) : view.getFloat64(pos);
+      pos += size;
+      return value;
+    }
+
+    function read() {
+      const code = data[pos++];
+      if (code < 0x80) return code;
+      if (code < 0x90) return map(code & 0x0f);
+      if (code < 0xa0) return array(code & 0x0f);
+      if (code < 0xc0) return str(code & 0x1f);
+      if (code >= 0xe0) return code - 0x100;
+      switch (code) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return bin(uint(1));
+        case 0xc5: return bin(uint(2));
+        case 0xc6: return bin(uint(4));
+        case 0xca: return float(4);
+        case 0xcb: return float(8);
+        case 0xcc: return uint(1);
+        case 0xcd: return uint(2);
+        case 0xce: return uint(4);
+        case 0xcf: return uint(8);
+        case 0xd0: return int(1);
+        case 0xd1: return int(2);
+        case 0xd2: return int(4);
+        case 0xd3: return int(8);
+        case 0xd9: return str(uint(1));
+        case 0xda: return str(uint(2));
+        case 0xdb: return str(uint(4));
+        case 0xdc: return array(uint(2));
+        case 0xdd: return array(uint(4));
+        case 0xde: return map(uint(2));
+        case 0xdf: return map(uint(4));
+        default: throw new Error(`Unsupported MessagePack type 0x${code.toString(16)}`);
+      }
+    }
+
+    return read();
+  }
+
+  global.MessagePack = { encode, decode };
+})(window);
@@ -7,10 +7,11 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
 
+import asyncio
 import os
+import sys
 import django
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 from base.routing import websocket_urlpatterns
@@ -18,11 +19,50 @@ from base.routing import websocket_urlpatterns
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "talkbuds.settings")
 django.setup()
 
+from base import metrics, redis_pool  # noqa: E402
+from base.unread import get_read_flusher  # noqa: E402
+from base.write_behind import get_write_behind  # noqa: E402
+from base.ws_auth import TicketAuthMiddleware  # noqa: E402
+
+
+async def shutdown():
+    """Flush buffered messages and read pointers, then close the Redis pools."""
+    await get_write_behind().aclose()
+    await get_read_flusher().aclose()
+    await redis_pool.close_all()
+
+
+async def lifespan(scope, receive, send):
+    """Run :func:`shutdown` under servers that send lifespan events (uvicorn, hypercorn)."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+if "daphne.server" in sys.modules:
+    # Daphne (and its runserver) never sends lifespan events. It runs on the
+    # asyncio reactor, so hook the reactor's shutdown, which waits for the
+    # returned Deferred before stopping the loop.
+    from twisted.internet import defer, reactor
+
+    reactor.addSystemEventTrigger(
+        "before", "shutdown", lambda: defer.Deferred.fromFuture(asyncio.ensure_future(shutdown()))
+    )
+
+
+metrics.start()
+
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
+    "lifespan": lifespan,
 
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        TicketAuthMiddleware(
             URLRouter(websocket_urlpatterns)
         )
     ),
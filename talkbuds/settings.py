@@ -36,6 +36,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "base.apps.BaseConfig",
     "django.contrib.sites",
     "allauth",
@@ -65,6 +66,8 @@ SIMPLE_JWT = {
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
+    # Adds username/avatar_url claims so WebSocket auth needs no user lookup.
+    "TOKEN_OBTAIN_SERIALIZER": "base.ws_auth.ChatTokenObtainPairSerializer",
 }
 
 # === Social Auth ===
@@ -103,6 +106,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "base.fragments.context",
             ],
         },
     },
@@ -112,9 +116,17 @@ TEMPLATES = [
 ASGI_APPLICATION = "talkbuds.asgi.application"
 
 # Use Memurai (Redis protocol compatible)
+# "core" (default): group_send pushes one message per channel in the group onto Redis lists.
+# "pubsub" (opt-in): group_send is one PUBLISH per group; every node subscribed to the group
+# fans it out to its own sockets in memory. Delivery is at-most-once: a frame published while
+# a node is resubscribing is lost, and presence, typing and room_deleted frames are not replayed.
+CHANNEL_LAYER_BACKENDS = {
+    "pubsub": "channels_redis.pubsub.RedisPubSubChannelLayer",
+    "core": "channels_redis.core.RedisChannelLayer",
+}
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": CHANNEL_LAYER_BACKENDS[os.getenv("CHAT_CHANNEL_LAYER", "core")],
         "CONFIG": {
             "hosts": [(os.environ.get("REDIS_HOST", "127.0.0.1"), 6380)],
         },
@@ -197,4 +209,100 @@ LOGGING = {
         "console": {"class": "logging.StreamHandler"},
     },
     "root": {"handlers": ["console"], "level": os.getenv("DJANGO_LOG_LEVEL", "INFO")},
-}
\ No newline at end of file
+}
+
+# === Chat ===
+# Write-behind persistence: messages are broadcast immediately and inserted
+# in batches by a per-process flusher (PostgreSQL only).
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "False").lower() == "true"
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", "200"))
+CHAT_WRITE_BEHIND_MAX_DELAY = float(os.getenv("CHAT_WRITE_BEHIND_MAX_DELAY", "0.25"))  # seconds
+# Message IDs are handed out from Redis in blocks of this many reserved from the sequence.
+CHAT_WRITE_BEHIND_ID_BLOCK = int(os.getenv("CHAT_WRITE_BEHIND_ID_BLOCK", "1000"))
+# "memory": buffered messages are lost if the worker dies before a flush.
+# "redis":  messages are journaled to Redis before broadcast and replayed on startup.
+CHAT_WRITE_BEHIND_DURABILITY = os.getenv("CHAT_WRITE_BEHIND_DURABILITY", "redis")
+
+# Room message counters: per-message deltas are summed per process and applied together,
+# so a busy room's row is not locked once per message. 0 applies each delta immediately.
+CHAT_COUNTER_FLUSH_INTERVAL = float(os.getenv("CHAT_COUNTER_FLUSH_INTERVAL", "1.0"))  # seconds
+
+# Per-room history window shared by the WebSocket and HTTP paths.
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "200"))
+CHAT_HISTORY_TTL = int(os.getenv("CHAT_HISTORY_TTL", str(60 * 60)))  # seconds
+# Cross-process fill lock so one worker reloads a cold room while the others wait.
+CHAT_HISTORY_LOCK = os.getenv("CHAT_HISTORY_LOCK", "True").lower() == "true"
+CHAT_HISTORY_LOCK_TTL = float(os.getenv("CHAT_HISTORY_LOCK_TTL", "2.0"))  # seconds
+
+# Typing indicators: one combined snapshot per room per interval.
+CHAT_TYPING_INTERVAL = float(os.getenv("CHAT_TYPING_INTERVAL", "0.5"))  # seconds
+CHAT_TYPING_TTL = float(os.getenv("CHAT_TYPING_TTL", "5"))  # seconds
+
+# Presence: heartbeat expiry per socket and the join/leave diff tick.
+CHAT_PRESENCE_TICK = float(os.getenv("CHAT_PRESENCE_TICK", "2"))  # seconds
+CHAT_PRESENCE_TTL = float(os.getenv("CHAT_PRESENCE_TTL", "30"))  # seconds
+
+# Cached room membership so repeat senders skip the participants M2M table.
+CHAT_MEMBERSHIP_TTL = int(os.getenv("CHAT_MEMBERSHIP_TTL", str(60 * 60 * 24)))  # seconds
+
+# Cached activity feed: newest messages across all rooms, ready to render.
+CHAT_ACTIVITY_FEED_SIZE = int(os.getenv("CHAT_ACTIVITY_FEED_SIZE", "500"))
+CHAT_ACTIVITY_FEED_TTL = int(os.getenv("CHAT_ACTIVITY_FEED_TTL", str(60 * 10)))  # seconds
+
+# Shared Redis pools (one per process and event loop) for views, consumers and caches.
+CHAT_REDIS_MAX_CONNECTIONS = int(os.getenv("CHAT_REDIS_MAX_CONNECTIONS", "50"))
+CHAT_REDIS_POOL_TIMEOUT = float(os.getenv("CHAT_REDIS_POOL_TIMEOUT", "5"))  # seconds to wait for a free connection
+CHAT_REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("CHAT_REDIS_HEALTH_CHECK_INTERVAL", "30"))  # seconds
+
+# Metrics: per-process counters are pushed to Redis and served at /metrics.
+CHAT_METRICS_FLUSH_INTERVAL = float(os.getenv("CHAT_METRICS_FLUSH_INTERVAL", "5"))  # seconds
+CHAT_METRICS_TOKEN = os.getenv("CHAT_METRICS_TOKEN", "")  # bearer token required by /metrics, if set
+# Without a token, /metrics only answers these client addresses.
+CHAT_METRICS_ALLOWED_IPS = os.getenv("CHAT_METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+
+# MessagePack sockets: live events arriving within the delay go out as one batch frame.
+CHAT_MSGPACK_BATCH_DELAY = float(os.getenv("CHAT_MSGPACK_BATCH_DELAY", "0.02"))  # seconds; 0 disables batching
+CHAT_MSGPACK_BATCH_MAX = int(os.getenv("CHAT_MSGPACK_BATCH_MAX", "100"))
+
+# Per-socket send queue. When it is full, typing and then presence frames are dropped;
+# if only chat frames are queued the socket is a slow consumer ("disconnect" or "block").
+CHAT_SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "256"))
+CHAT_SLOW_CONSUMER_POLICY = os.getenv("CHAT_SLOW_CONSUMER_POLICY", "disconnect")
+CHAT_SLOW_CONSUMER_CLOSE_CODE = int(os.getenv("CHAT_SLOW_CONSUMER_CLOSE_CODE", "4008"))
+
+# Token buckets per event type: scope -> (tokens per second, burst). "user" is per user,
+# "room" is shared by the whole room. Remove an event type to stop limiting it.
+CHAT_RATE_LIMITS = {
+    "chat_message": {"user": (1.0, 10), "room": (50.0, 200)},
+    "typing": {"user": (2.0, 5)},
+    "load_more": {"user": (0.5, 5)},
+    "mark_read": {"user": (2.0, 10)},
+}
+
+# WebSocket auth: signed connect tickets / JWTs verified without DB queries.
+CHAT_WS_TICKET_TTL = int(os.getenv("CHAT_WS_TICKET_TTL", str(60 * 10)))  # seconds
+# Fall back to the session cookie (two queries per connect) when no ticket or token is given.
+CHAT_WS_SESSION_AUTH = os.getenv("CHAT_WS_SESSION_AUTH", "True").lower() == "true"
+
+# Room metadata cache: per-process LRU in front of a Redis copy, invalidated by Room signals.
+CHAT_ROOM_CACHE_SIZE = int(os.getenv("CHAT_ROOM_CACHE_SIZE", "10000"))
+CHAT_ROOM_CACHE_LOCAL_TTL = float(os.getenv("CHAT_ROOM_CACHE_LOCAL_TTL", "30"))  # seconds
+CHAT_ROOM_CACHE_TTL = int(os.getenv("CHAT_ROOM_CACHE_TTL", str(60 * 10)))  # seconds
+
+# Message archive: "manage.py archive_messages" moves older messages into compressed
+# per-room segments; history reads continue into them transparently.
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "90"))
+CHAT_ARCHIVE_SEGMENT_SIZE = int(os.getenv("CHAT_ARCHIVE_SEGMENT_SIZE", "500"))  # messages
+
+# Read pointers: live in Redis per user, upserted into ReadState by a per-process flusher.
+CHAT_READ_FLUSH_INTERVAL = float(os.getenv("CHAT_READ_FLUSH_INTERVAL", "5.0"))  # seconds
+CHAT_READ_STATE_TTL = int(os.getenv("CHAT_READ_STATE_TTL", str(60 * 60 * 24 * 7)))  # seconds
+# Redis copy of each room's message sequence; reloaded from the database when it expires.
+CHAT_UNREAD_SEQ_TTL = int(os.getenv("CHAT_UNREAD_SEQ_TTL", str(60 * 10)))  # seconds
+
+# Template fragments (topics, room list, room cards, activity) cached under generation
+# counters that model signals bump. 0 renders everything fresh.
+CHAT_FRAGMENT_CACHE_TTL = int(os.getenv("CHAT_FRAGMENT_CACHE_TTL", str(60 * 5)))  # seconds
+
+# Avatar variants built on upload: size name -> square edge in pixels (about 2x the CSS size).
+AVATAR_SIZES = {"small": 64, "medium": 96, "large": 192}
@@ -15,14 +15,25 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path,include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from base import avatars
+from base.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('',include('base.urls')),
     path('accounts/',include("allauth.urls")),
 ]
 
+if settings.DEBUG:
+    # Content-hashed avatar variants, cached by browsers for a year. Like the rest of the
+    # media, production serves them from the web server or storage instead.
+    urlpatterns.append(
+        re_path(rf'^{settings.MEDIA_URL.lstrip("/")}{avatars.AVATAR_DIR}/(?P<path>.+)$', avatars.serve, name='avatar')
+    )
+
 urlpatterns += static(settings.MEDIA_URL, document_root = settings.MEDIA_ROOT)
\ No newline at end of file
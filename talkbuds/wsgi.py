@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'talkbuds.settings')
 
 application = get_wsgi_application()
+
+from base import metrics  # noqa: E402
+
+metrics.start()